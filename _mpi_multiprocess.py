@@ -0,0 +1,307 @@
+"""This implements a COMM that mimics the subset of mpi4py used in iceberk with
+local processes, so that the mpi algorithms can use all the cores of a single
+machine when one cannot install mpi or mpi4py.
+
+The processes are started by mprun.py, which tells each of them its rank, the
+number of processes, and a private directory in which each process listens on
+a unix socket. Every pair of processes is connected with a
+multiprocessing.connection, over which python objects are pickled and buffers
+are sent as raw bytes. The collectives are carried out by the root of the
+operation, and are meant for convenience rather than for speed.
+"""
+
+import numpy as np
+import operator
+import os
+import socket
+import time
+from multiprocessing.connection import Client, Listener
+
+_ENV_RANK = 'ICEBERK_MP_RANK'
+_ENV_SIZE = 'ICEBERK_MP_SIZE'
+_ENV_DIR = 'ICEBERK_MP_DIR'
+# the tag used by the collectives. Since the messages between two processes
+# arrive in order and every process calls the collectives in the same order,
+# one tag is enough.
+_COLL_TAG = -100
+# the time we wait between two polls when waiting for any source
+_POLL_SLEEP = 0.001
+
+
+def is_worker():
+    """Returns True if the current process is started by mprun.py.
+    """
+    return _ENV_RANK in os.environ
+
+
+def address(dirname, rank):
+    """Returns the unix socket address of the given rank.
+    """
+    return os.path.join(dirname, 'rank-%05d' % rank)
+
+
+class Op(object):
+    """A reduction operation. array_func is a numpy ufunc used for buffers,
+    and obj_func is a binary function used for python objects.
+    """
+    def __init__(self, name, array_func, obj_func):
+        self.name = name
+        self.array_func = array_func
+        self.obj_func = obj_func
+
+    def __repr__(self):
+        return '<Op %s>' % self.name
+
+
+class Status(object):
+    """The status of a received message.
+    """
+    def __init__(self):
+        self.source = -1
+        self.tag = -1
+
+    def Get_source(self):
+        return self.source
+
+    def Get_tag(self):
+        return self.tag
+
+
+class Request(object):
+    """The request returned by isend. As messages are sent eagerly, the
+    request is always completed.
+    """
+    def Wait(self, status = None):
+        return None
+
+    def Test(self, status = None):
+        return True
+
+    @staticmethod
+    def Waitall(requests, statuses = None):
+        return None
+
+
+class MPI(object):
+    """The stand-in for the constants and classes of the mpi4py MPI module
+    that iceberk uses.
+    """
+    SUM = Op('SUM', np.add, operator.add)
+    PROD = Op('PROD', np.multiply, operator.mul)
+    MAX = Op('MAX', np.maximum, max)
+    MIN = Op('MIN', np.minimum, min)
+    LAND = Op('LAND', np.logical_and, lambda a, b: a and b)
+    LOR = Op('LOR', np.logical_or, lambda a, b: a or b)
+    ANY_SOURCE = -1
+    ANY_TAG = -1
+    Request = Request
+    Status = Status
+
+    def __init__(self):
+        raise RuntimeError, "MPI should not be instantiated."
+
+
+def _as_buffer(buf):
+    """Returns the ndarray of a buffer specification, which could be an
+    ndarray or a list [ndarray, ...] as in mpi4py.
+    """
+    if type(buf) is list or type(buf) is tuple:
+        buf = buf[0]
+    return buf
+
+
+class COMM(object):
+    """The communicator of the processes started by mprun.py.
+    """
+    def __init__(self, rank = None, size = None, dirname = None):
+        if rank is None:
+            rank = int(os.environ[_ENV_RANK])
+            size = int(os.environ[_ENV_SIZE])
+            dirname = os.environ[_ENV_DIR]
+        self._rank = rank
+        self._size = size
+        self._conns = [None] * size
+        # messages that have been read but not received yet, per source, as
+        # (tag, is_bytes, payload)
+        self._pending = [[] for i in range(size)]
+        listener = Listener(address(dirname, rank), 'AF_UNIX',
+                            backlog = size)
+        # we connect to the higher ranks, and accept the lower ones. Since
+        # the highest rank only accepts, this does not deadlock.
+        for other in range(rank + 1, size):
+            while True:
+                try:
+                    conn = Client(address(dirname, other), 'AF_UNIX')
+                    break
+                except socket.error:
+                    time.sleep(_POLL_SLEEP)
+            conn.send(rank)
+            self._conns[other] = conn
+        for i in range(rank):
+            conn = listener.accept()
+            self._conns[conn.recv()] = conn
+        listener.close()
+
+    def Get_rank(self):
+        return self._rank
+
+    def Get_size(self):
+        return self._size
+
+    # point to point communication
+    def _send(self, dest, tag, obj = None, buf = None):
+        conn = self._conns[dest]
+        if buf is None:
+            conn.send((tag, False, obj))
+        else:
+            buf = np.ascontiguousarray(_as_buffer(buf))
+            conn.send((tag, True, buf.nbytes))
+            conn.send_bytes(buf)
+
+    def _read(self, source):
+        """Reads the next message from source into the pending list.
+        """
+        conn = self._conns[source]
+        tag, is_bytes, payload = conn.recv()
+        if is_bytes:
+            payload = conn.recv_bytes()
+        self._pending[source].append((tag, is_bytes, payload))
+
+    def _match(self, source, tag):
+        """Returns the index of the first pending message from source that
+        matches tag, or -1.
+        """
+        for i, message in enumerate(self._pending[source]):
+            if tag == MPI.ANY_TAG or message[0] == tag:
+                return i
+        return -1
+
+    def _probe(self, source, tag, block):
+        """Returns the (source, index) of a pending message that matches
+        source and tag, reading from the connections as needed. Returns None
+        if block is False and there is no such message.
+        """
+        if source == MPI.ANY_SOURCE:
+            sources = [i for i in range(self._size) if i != self._rank]
+        else:
+            sources = [source]
+        while True:
+            for src in sources:
+                idx = self._match(src, tag)
+                if idx >= 0:
+                    return src, idx
+            if len(sources) == 1 and block:
+                # we can simply block on the only connection
+                self._read(sources[0])
+                continue
+            received = False
+            for src in sources:
+                while self._conns[src].poll(0):
+                    self._read(src)
+                    received = True
+            if not received:
+                if not block:
+                    return None
+                time.sleep(_POLL_SLEEP)
+
+    def _recv(self, source, tag, status, buf = None):
+        src, idx = self._probe(source, tag, True)
+        msg_tag, is_bytes, payload = self._pending[src].pop(idx)
+        if status is not None:
+            status.source = src
+            status.tag = msg_tag
+        if buf is None:
+            return payload
+        buf = _as_buffer(buf)
+        if not is_bytes or len(payload) != buf.nbytes:
+            raise ValueError, "The message does not match the receive buffer."
+        buf[...] = np.frombuffer(payload, dtype = buf.dtype).reshape(buf.shape)
+
+    def send(self, obj, dest, tag = 0):
+        self._send(dest, tag, obj = obj)
+
+    def isend(self, obj, dest, tag = 0):
+        self._send(dest, tag, obj = obj)
+        return Request()
+
+    def recv(self, buf = None, source = 0, tag = 0, status = None):
+        return self._recv(source, tag, status)
+
+    def Send(self, buf, dest, tag = 0):
+        self._send(dest, tag, buf = buf)
+
+    def Recv(self, buf, source = 0, tag = 0, status = None):
+        self._recv(source, tag, status, buf = buf)
+
+    def Iprobe(self, source = 0, tag = 0, status = None):
+        result = self._probe(source, tag, False)
+        if result is not None and status is not None:
+            status.source = result[0]
+            status.tag = self._pending[result[0]][result[1]][0]
+        return result is not None
+
+    # collectives
+    def bcast(self, obj, root = 0):
+        if self._rank == root:
+            for i in range(self._size):
+                if i != root:
+                    self._send(i, _COLL_TAG, obj = obj)
+            return obj
+        else:
+            return self._recv(root, _COLL_TAG, None)
+
+    def Bcast(self, buf, root = 0):
+        if self._rank == root:
+            for i in range(self._size):
+                if i != root:
+                    self._send(i, _COLL_TAG, buf = buf)
+        else:
+            self._recv(root, _COLL_TAG, None, buf = buf)
+
+    def gather(self, sendobj, root = 0):
+        if self._rank == root:
+            return [sendobj if i == root else self._recv(i, _COLL_TAG, None)
+                    for i in range(self._size)]
+        else:
+            self._send(root, _COLL_TAG, obj = sendobj)
+            return None
+
+    def allgather(self, sendobj):
+        return self.bcast(self.gather(sendobj))
+
+    def allreduce(self, sendobj, op = None):
+        values = self.gather(sendobj)
+        if self._rank == 0:
+            if op is None:
+                op = MPI.SUM
+            if isinstance(op, Op):
+                op = op.obj_func
+            result = reduce(op, values)
+        else:
+            result = None
+        return self.bcast(result)
+
+    def Reduce(self, sendbuf, recvbuf, op = None, root = 0):
+        sendbuf = _as_buffer(sendbuf)
+        if self._rank == root:
+            if op is None:
+                op = MPI.SUM
+            recvbuf = _as_buffer(recvbuf)
+            result = np.array(sendbuf)
+            temp = np.empty_like(result)
+            for i in range(self._size):
+                if i != root:
+                    self._recv(i, _COLL_TAG, None, buf = temp)
+                    op.array_func(result, temp, out = result)
+            recvbuf[...] = result
+        else:
+            self._send(root, _COLL_TAG, buf = sendbuf)
+
+    def Allreduce(self, sendbuf, recvbuf, op = None):
+        self.Reduce(sendbuf, recvbuf, op, 0)
+        self.Bcast(recvbuf, 0)
+
+    def Barrier(self):
+        self.bcast(self.gather(None))
+
+    barrier = Barrier
@@ -24,6 +24,9 @@ from scipy import optimize
 from sklearn import metrics
 
 _FMIN = optimize.fmin_l_bfgs_b
+# SolverMC.obj reduces the gradient over the nodes in blocks of about this
+# size, overlapping the reduction of a block with the computation of the next.
+_GRADIENT_BLOCK_BYTES = 1 << 22
 
 def to_one_of_k_coding(Y, fill = -1, K = None):
     '''Convert the vector Y into one-of-K coding. The element will be either
@@ -33,7 +36,7 @@ def to_one_of_k_coding(Y, fill = -1, K = None):
     if Y.ndim > 1:
         raise ValueError, "The input Y should be a vector."
     if K is None:
-        K = mpi.COMM.allreduce(Y.max(), op=max) + 1
+        K = mpi.allreduce_scalar(Y.max(), op=max) + 1
     Yout = np.ones((len(Y), K)) * fill
     Yout[np.arange(len(Y)), Y.astype(int)] = 1
     return Yout
@@ -148,6 +151,7 @@ class SolverMC(Solver):
         self._g = None
         self._gpred = None
         self._gpredcache = []
+        self._Xchunk = None
 
     @staticmethod
     def flatten_params(params):
@@ -162,7 +166,7 @@ class SolverMC(Solver):
         self._iter = 0
         self._X = X.reshape((X.shape[0],np.prod(X.shape[1:])))
         if len(Y.shape) == 1:
-            self._K = mpi.COMM.allreduce(Y.max(), op=max) + 1
+            self._K = mpi.allreduce_scalar(Y.max(), op=max) + 1
         else:
             # We treat Y as a two-dimensional matrix
             Y = Y.reshape((Y.shape[0],np.prod(Y.shape[1:])))
@@ -171,10 +175,26 @@ class SolverMC(Solver):
         self._weight = weight
         # compute the number of data
         if weight is None:
-            self._num_data = mpi.COMM.allreduce(X.shape[0])
+            self._num_data = mpi.allreduce_scalar(X.shape[0])
         else:
-            self._num_data = mpi.COMM.allreduce(weight.sum())
+            self._num_data = mpi.allreduce_scalar(weight.sum())
         self._dim = self._X.shape[1]
+        # obj() computes the gradient of w in blocks of rows, i.e. blocks of
+        # columns of X. These are not contiguous, so they are copied chunk by
+        # chunk into a small Fortran-ordered buffer that is reused by the
+        # later calls.
+        self._gradient_block = max(_GRADIENT_BLOCK_BYTES / \
+                (self._K * np.dtype(np.float64).itemsize), 1)
+        if self._gradient_block < self._dim:
+            chunk = max(_GRADIENT_BLOCK_BYTES / \
+                    (max(self._X.shape[0], 1) * self._X.itemsize), 1)
+            chunk = min(chunk, self._gradient_block)
+            shape = (self._X.shape[0], chunk)
+            if self._Xchunk is None or self._Xchunk.shape != shape \
+                    or self._Xchunk.dtype != self._X.dtype:
+                self._Xchunk = np.empty(shape, dtype=self._X.dtype, order='F')
+        else:
+            self._Xchunk = None
         if self._pred is None:
             self._pred = np.empty((X.shape[0], self._K), dtype = X.dtype)
         else:
@@ -202,8 +222,10 @@ class SolverMC(Solver):
                 self._gpred.resize(X.shape[0], self._K)
         else:
             self.gpredcache = False
-        # just to make sure every node is on the same page
-        mpi.COMM.Bcast(param_init)
+        # just to make sure every node is on the same page. The parameters
+        # are shared within each machine, and the memory is reused by the
+        # next presolve.
+        param_init = mpi.shared_bcast(param_init, key = 'SolverMC.param')
         # for debugging, we report the initial function value.
         #f = SolverMC.obj(param_init, self)[0]
         #logging.debug("Initial function value: %f." % f)
@@ -241,23 +263,42 @@ class SolverMC(Solver):
         else:
             flocal,gpred = solver.loss(solver._Y, solver._pred, solver._weight,
                                        **solver._lossargs)
-        mathutil.dot(solver._X.T, gpred,
-                     out = solver._glocal[:K*dim].reshape(dim, K))
-        solver._glocal[K*dim:] = gpred.sum(axis=0)
         # we should normalize them with the number of data
         flocal /= solver._num_data
-        solver._glocal /= solver._num_data
         # add regularization term, but keep in mind that we have multiple nodes
         # so we only carry it out on root to make sure we only added one 
         # regularization term
         if mpi.is_root():
             freg, greg = solver.reg(w, **solver._regargs)
             flocal += solver._gamma * freg
-            solver._glocal[:K*dim] += solver._gamma * greg.ravel()
-        # do mpi reduction
-        mpi.barrier()
-        f = mpi.COMM.allreduce(flocal)
-        mpi.COMM.Allreduce(solver._glocal, solver._g)
+            greg = greg.reshape(dim, K)
+        # compute the gradient of w in blocks of rows, and start reducing each
+        # block while the next one is computed.
+        glocal = solver._glocal[:K*dim].reshape(dim, K)
+        g = solver._g[:K*dim].reshape(dim, K)
+        block = solver._gradient_block
+        requests = []
+        for start in range(0, dim, block):
+            end = min(start + block, dim)
+            if solver._Xchunk is None:
+                mathutil.dot(solver._X.T, gpred, out = glocal[start:end])
+            else:
+                chunk = solver._Xchunk.shape[1]
+                for cstart in range(start, end, chunk):
+                    cend = min(cstart + chunk, end)
+                    X = solver._Xchunk[:, :cend - cstart]
+                    X[:] = solver._X[:, cstart:cend]
+                    mathutil.dot(X.T, gpred, out = glocal[cstart:cend])
+            glocal[start:end] /= solver._num_data
+            if mpi.is_root():
+                glocal[start:end] += solver._gamma * greg[start:end]
+            requests.append(mpi.iallreduce(glocal[start:end], g[start:end]))
+        solver._glocal[K*dim:] = gpred.sum(axis=0)
+        solver._glocal[K*dim:] /= solver._num_data
+        requests.append(mpi.iallreduce(solver._glocal[K*dim:],
+                                       solver._g[K*dim:]))
+        f = mpi.allreduce_scalar(flocal)
+        mpi.waitall(requests)
         return f, solver._g
 
 
@@ -283,6 +324,11 @@ class SolverStochastic(Solver):
             return whatever that can be converted to a string by str(). If 
             callback is a list, then every entry in the list is a callback 
             function, and they will be carried out sequentially.
+        'prefetch': if a number larger than 0, the corresponding number of
+            minibatches are sampled ahead of time on a background thread
+            with mathutil.PrefetchSampler, while the current minibatch is
+            being processed. The minibatch buffers are reused, except for
+            the entries that a PostProcessSampler creates with its funcs.
     """
     def solve(self, sampler, param_init = None):
         """The solve function.
@@ -300,50 +346,63 @@ class SolverStochastic(Solver):
                 self._fminargs)
         param = param_init
         timer = util.Timer()
-        for iter in range(self._args['num_iter']):
-            Xbatch, Ybatch, weightbatch = sampler.sample(self._args['minibatch'])
-            # carry out the computation
-            if mode == 'lbfgs':
-                param = solver_basic.solve(Xbatch, Ybatch, weightbatch, param)
-                logging.debug('iter %d time = %s' % \
-                        (iter, str(timer.total(False))))
-            else:
-                # adagrad: compute gradient and update
-                param_flat = solver_basic.presolve(\
-                        Xbatch, Ybatch, weightbatch, param)
-                if iter == 0:
-                    # we need to build the cache in solver_basic as well as
-                    # the accumulated gradients
-                    accum_grad = np.ones_like(param_flat) * \
-                            (self._args.get('eta', 0.) ** 2) + \
-                            np.finfo(np.float64).eps
-                    if self._args.get('base_lr', None) is None:
-                        # do a line search to get the value
-                        self._args['base_lr'] = \
-                                mathutil.wolfe_line_search_adagrad(param_flat,
-                                lambda x: SolverMC.obj(x, solver_basic),
-                                eta = self._args.get('eta', 0.))
-                        # reset the timer to exclude the base learning rate tuning
-                        # time
-                        timer.reset()
-                f0, g = SolverMC.obj(param_flat, solver_basic)
-                accum_grad += g * g
-                # we are MINIMIZING, so go against the gradient direction
-                param_flat -= g / np.sqrt(accum_grad) * self._args['base_lr']
-                f = SolverMC.obj(param_flat, solver_basic)[0] 
-                logging.debug('iter %d f0 = %f f = %f time = %s' % \
-                        (iter, f0, f,\
-                        str(timer.total(False))))
-                param = solver_basic.unflatten_params(param_flat)
-            callback = self._args.get('callback', None)
-            if callback is None:
-                continue
-            if type(callback) is not list:
-                cb_val = callback(param)
-                logging.debug('cb: ' + str(cb_val))
-            else:
-                cb_val = [cb_func(param) for cb_func in callback]
-                logging.debug('cb: ' + ' '.join([str(v) for v in cb_val]))
+        num_prefetch = self._args.get('prefetch', 0)
+        if num_prefetch > 0:
+            sampler = mathutil.PrefetchSampler(sampler,
+                    self._args['minibatch'], num_prefetch)
+        try:
+            for iter in range(self._args['num_iter']):
+                Xbatch, Ybatch, weightbatch = \
+                        sampler.sample(self._args['minibatch'])
+                # carry out the computation
+                if mode == 'lbfgs':
+                    param = solver_basic.solve(Xbatch, Ybatch, weightbatch,
+                                               param)
+                    logging.debug('iter %d time = %s' % \
+                            (iter, str(timer.total(False))))
+                else:
+                    # adagrad: compute gradient and update
+                    param_flat = solver_basic.presolve(\
+                            Xbatch, Ybatch, weightbatch, param)
+                    if iter == 0:
+                        # we need to build the cache in solver_basic as well as
+                        # the accumulated gradients
+                        accum_grad = np.ones_like(param_flat) * \
+                                (self._args.get('eta', 0.) ** 2) + \
+                                np.finfo(np.float64).eps
+                        if self._args.get('base_lr', None) is None:
+                            # do a line search to get the value
+                            self._args['base_lr'] = \
+                                    mathutil.wolfe_line_search_adagrad(
+                                    param_flat,
+                                    lambda x: SolverMC.obj(x, solver_basic),
+                                    eta = self._args.get('eta', 0.))
+                            # reset the timer to exclude the base learning
+                            # rate tuning time
+                            timer.reset()
+                    f0, g = SolverMC.obj(param_flat, solver_basic)
+                    accum_grad += g * g
+                    # we are MINIMIZING, so go against the gradient direction
+                    param_flat = param_flat - \
+                            g / np.sqrt(accum_grad) * self._args['base_lr']
+                    f = SolverMC.obj(param_flat, solver_basic)[0] 
+                    logging.debug('iter %d f0 = %f f = %f time = %s' % \
+                            (iter, f0, f,\
+                            str(timer.total(False))))
+                    param = solver_basic.unflatten_params(param_flat)
+                callback = self._args.get('callback', None)
+                if callback is None:
+                    continue
+                if type(callback) is not list:
+                    cb_val = callback(param)
+                    logging.debug('cb: ' + str(cb_val))
+                else:
+                    cb_val = [cb_func(param) for cb_func in callback]
+                    logging.debug('cb: ' + ' '.join([str(v) for v in cb_val]))
+        finally:
+            if num_prefetch > 0:
+                # stop the background thread even if the solve failed
+                sampler.close()
         # the stochastic part is done. See if we want to do fine-tuning.
         finetune = self._args.get('fine_tune', 0)
         if finetune > 0:
@@ -606,8 +665,8 @@ class Evaluator(object):
             pred = pred.argmax(axis=1)
         if Y.ndim == 2:
             Y = Y.argmax(axis=1)
-        correct = mpi.COMM.allreduce((Y==pred).sum())
-        num_data = mpi.COMM.allreduce(len(Y))
+        correct = mpi.allreduce_scalar((Y==pred).sum())
+        num_data = mpi.allreduce_scalar(len(Y))
         return float(correct) / num_data
     
     @staticmethod
@@ -663,8 +722,8 @@ class Evaluator(object):
                             "so the accuracy would always be one.")
         top_k_id = np.argsort(pred, axis=1)[:, -k:]
         match = (top_k_id == Y[:, np.newaxis])
-        correct = mpi.COMM.allreduce(match.sum())
-        num_data = mpi.COMM.allreduce(len(Y))
+        correct = mpi.allreduce_scalar(match.sum())
+        num_data = mpi.allreduce_scalar(len(Y))
         return float(correct) / num_data
     
     @staticmethod
@@ -682,9 +741,9 @@ class Evaluator(object):
                     Y == 1, pred)
             ap = metrics.auc(recall, precision)
         else:
-            ap = None
+            ap = 0.
         mpi.barrier()
-        return mpi.COMM.bcast(ap)
+        return mpi.bcast_scalar(ap)
     
     @staticmethod
     def average_precision_multiclass(Y, pred):
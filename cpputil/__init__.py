@@ -18,57 +18,81 @@ except Exception, e:
 # fast pooling
 ################################################################################
 _POOL_METHODS = {'max':0, 'ave': 1, 'rms': 2}
-_CPPUTIL.fastpooling.restype = ct.c_int
-_CPPUTIL.fastpooling.argtypes = [ct.POINTER(ct.c_double), # image
-                                      ct.c_int, # height
-                                      ct.c_int, # width
-                                      ct.c_int, # num_channels
-                                      ct.c_int, # grid[0]
-                                      ct.c_int, # grid[1]
-                                      ct.c_int, # method
-                                      ct.POINTER(ct.c_double) # output
-                                     ]
-_CPPUTIL.fast_oc_pooling.restype = ct.c_int
-_CPPUTIL.fast_oc_pooling.argtypes = [ct.POINTER(ct.c_double), # image
-                                      ct.c_int, # grid[0]
-                                      ct.c_int, # grid[1]
-                                      ct.c_int, # num_channels
-                                      ct.c_int, # method
-                                      ct.POINTER(ct.c_double) # output
-                                     ]
+# each function has a double and a float (with suffix _float) version
+for ctype, suffix in [(ct.c_double, ''), (ct.c_float, '_float')]:
+    func = getattr(_CPPUTIL, 'fastpooling' + suffix)
+    func.restype = ct.c_int
+    func.argtypes = [ct.POINTER(ctype), # image
+                     ct.c_int, # height
+                     ct.c_int, # width
+                     ct.c_int, # num_channels
+                     ct.c_int, # grid[0]
+                     ct.c_int, # grid[1]
+                     ct.c_int, # method
+                     ct.POINTER(ctype) # output
+                    ]
+    func = getattr(_CPPUTIL, 'fast_oc_pooling' + suffix)
+    func.restype = ct.c_int
+    func.argtypes = [ct.POINTER(ctype), # image
+                     ct.c_int, # grid[0]
+                     ct.c_int, # grid[1]
+                     ct.c_int, # num_channels
+                     ct.c_int, # method
+                     ct.POINTER(ctype) # output
+                    ]
+
+def _check_dtype(image):
+    """Returns the ctype and the function name suffix for the image dtype.
+    """
+    if image.dtype == np.float64:
+        return ct.c_double, ''
+    elif image.dtype == np.float32:
+        return ct.c_float, '_float'
+    else:
+        raise TypeError, "Unsupported dtype: %s" % repr(image.dtype)
 
 def fastpooling(image, grid, method, out = None):
+    ctype, suffix = _check_dtype(image)
     if out is None:
-        out = np.empty((grid[0], grid[1], image.shape[-1]))
+        out = np.empty((grid[0], grid[1], image.shape[-1]),
+                       dtype = image.dtype)
     else:
+        if out.dtype != image.dtype:
+            raise TypeError, "The output should have dtype %s" % \
+                    repr(image.dtype)
         out.resize(grid[0], grid[1], image.shape[-1])
-    _CPPUTIL.fastpooling(
-            image.ctypes.data_as(ct.POINTER(ct.c_double)),
+    getattr(_CPPUTIL, 'fastpooling' + suffix)(
+            image.ctypes.data_as(ct.POINTER(ctype)),
             ct.c_int(image.shape[0]),
             ct.c_int(image.shape[1]),
             ct.c_int(image.shape[2]),
             ct.c_int(grid[0]),
             ct.c_int(grid[1]),
             ct.c_int(_POOL_METHODS[method]),
-            out.ctypes.data_as(ct.POINTER(ct.c_double)))
+            out.ctypes.data_as(ct.POINTER(ctype)))
     return out
 
 def fast_oc_pooling(image, grid, method, out = None):
+    ctype, suffix = _check_dtype(image)
     num_output = grid[0] * (grid[0] + 1) * grid[1] * (grid[1] + 1) / 4
     if out is None:
-        output = np.empty((num_output, image.shape[-1]))
+        output = np.empty((num_output, image.shape[-1]), dtype = image.dtype)
     else:
+        if out.dtype != image.dtype:
+            raise TypeError, "The output should have dtype %s" % \
+                    repr(image.dtype)
+        output = out
         output.resize(num_output, image.shape[-1])
     if image.shape[0] != grid[0] or image.shape[1] != grid[1]:
         # do a first pass fast pooling
         image = fastpooling(image, grid, method)
-    _CPPUTIL.fast_oc_pooling(
-            image.ctypes.data_as(ct.POINTER(ct.c_double)),
+    getattr(_CPPUTIL, 'fast_oc_pooling' + suffix)(
+            image.ctypes.data_as(ct.POINTER(ctype)),
             ct.c_int(grid[0]),
             ct.c_int(grid[1]),
             ct.c_int(image.shape[2]),
             ct.c_int(_POOL_METHODS[method]),
-            output.ctypes.data_as(ct.POINTER(ct.c_double)))
+            output.ctypes.data_as(ct.POINTER(ctype)))
     return output
 
 
@@ -76,15 +100,25 @@ def fast_oc_pooling(image, grid, method, out = None):
 ################################################################################
 # im2col operation
 ################################################################################
-_CPPUTIL.im2col.restype = None
-_CPPUTIL.im2col.argtype = [ct.POINTER(ct.c_double),
-                           ct.POINTER(ct.c_int),
-                           ct.POINTER(ct.c_int),
-                           ct.c_int,
-                           ct.POINTER(ct.c_double)]
+for ctype, suffix in [(ct.c_double, ''), (ct.c_float, '_float')]:
+    func = getattr(_CPPUTIL, 'im2col' + suffix)
+    func.restype = None
+    func.argtypes = [ct.POINTER(ctype),
+                     ct.POINTER(ct.c_int),
+                     ct.POINTER(ct.c_int),
+                     ct.c_int,
+                     ct.POINTER(ctype)]
 
 def im2col(image, psize, stride, out = None):
-    image = np.ascontiguousarray(np.atleast_3d(image), dtype=np.float64)
+    """Densely extracts the patches of the image. The output has the same
+    dtype as the image if it is np.float32, and np.float64 otherwise.
+    """
+    if image.dtype == np.float32:
+        dtype = np.float32
+    else:
+        dtype = np.float64
+    image = np.ascontiguousarray(np.atleast_3d(image), dtype=dtype)
+    ctype, suffix = _check_dtype(image)
     imsize = np.asarray(image.shape, dtype = ct.c_int)
     psize = np.asarray(psize).astype(ct.c_int)
     stride = int(stride)
@@ -93,15 +127,17 @@ def im2col(image, psize, stride, out = None):
     newsize = (imsize[:2] - psize) / stride + 1
     if out is None:
         out = np.empty((newsize[0], newsize[1], 
-                        psize[0] * psize[1] * imsize[2]))
+                        psize[0] * psize[1] * imsize[2]), dtype = dtype)
     else:
         CHECK_IMAGE(out)
         CHECK_SHAPE(out, (newsize[0], newsize[1], 
                           psize[0] * psize[1] * imsize[2]))
-    _CPPUTIL.im2col(image.ctypes.data_as(ct.POINTER(ct.c_double)),
-                    imsize.ctypes.data_as(ct.POINTER(ct.c_int)),
-                    psize.ctypes.data_as(ct.POINTER(ct.c_int)),
-                    ct.c_int(stride),
-                    out.ctypes.data_as(ct.POINTER(ct.c_double)))
+        if out.dtype != dtype:
+            raise TypeError, "The output should have dtype %s" % repr(dtype)
+    getattr(_CPPUTIL, 'im2col' + suffix)(
+            image.ctypes.data_as(ct.POINTER(ctype)),
+            imsize.ctypes.data_as(ct.POINTER(ct.c_int)),
+            psize.ctypes.data_as(ct.POINTER(ct.c_int)),
+            ct.c_int(stride),
+            out.ctypes.data_as(ct.POINTER(ctype)))
     return out
-
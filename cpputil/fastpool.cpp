@@ -11,23 +11,22 @@
 #define AVEPOOL 1
 #define RMSPOOL 2
 
-extern "C" {
-
-int fastpooling(
-        const double* const image, // Input image, [height*width*nchannels]
+template <typename Dtype>
+int fastpooling_impl(
+        const Dtype* const image, // Input image, [height*width*nchannels]
         const int height, 
         const int width,
         const int nchannels,
         const int gridh, // The grid size along the height
         const int gridw, // The grid size along the width
         const int method, // The pooling method
-        double* output // output pooled features, 
+        Dtype* output // output pooled features, 
                              // [gridh*gridw*nchannels]
         )
 {
     int* counts = new int[gridh * gridw];
     memset(counts, 0, sizeof(int) * gridh * gridw);
-    memset(output, 0, sizeof(double) * gridh * gridw * nchannels);
+    memset(output, 0, sizeof(Dtype) * gridh * gridw * nchannels);
     
     switch (method) {
     case MAXPOOL:
@@ -37,8 +36,8 @@ int fastpooling(
                 int h_id = i * gridh / height;
                 for (int j = 0; j < width; ++j) {
                     int w_id = j * gridw / width;
-                    const double* image_hw = image + (i * width + j) * nchannels;
-                    double* output_hw = output + (h_id * gridw + w_id) * nchannels;
+                    const Dtype* image_hw = image + (i * width + j) * nchannels;
+                    Dtype* output_hw = output + (h_id * gridw + w_id) * nchannels;
                         output_hw[k] = (output_hw[k] > image_hw[k]) ? 
                                         output_hw[k] : image_hw[k];
                 } // loop over width
@@ -51,8 +50,8 @@ int fastpooling(
             int h_id = i * gridh / height;
             for (int j = 0; j < width; ++j) {
                 int w_id = j * gridw / width;
-                const double* image_hw = image + (i * width + j) * nchannels;
-                double* output_hw = output + (h_id * gridw + w_id) * nchannels;
+                const Dtype* image_hw = image + (i * width + j) * nchannels;
+                Dtype* output_hw = output + (h_id * gridw + w_id) * nchannels;
                 #pragma omp atomic
                 ++counts[h_id * gridw + w_id];
                 for (int k = 0; k < nchannels; ++k) {
@@ -76,12 +75,12 @@ int fastpooling(
             int h_id = i * gridh / height;
             for (int j = 0; j < width; ++j) {
                 int w_id = j * gridw / width;
-                const double* image_hw = image + (i * width + j) * nchannels;
-                double* output_hw = output + (h_id * gridw + w_id) * nchannels;
+                const Dtype* image_hw = image + (i * width + j) * nchannels;
+                Dtype* output_hw = output + (h_id * gridw + w_id) * nchannels;
                 #pragma omp atomic
                 ++counts[h_id * gridw + w_id];
                 for (int k = 0; k < nchannels; ++k) {
-                    double sqvalue = image_hw[k] * image_hw[k];
+                    Dtype sqvalue = image_hw[k] * image_hw[k];
                     #pragma omp atomic
                     output_hw[k] += sqvalue;
                 } // loop over channels
@@ -106,20 +105,21 @@ int fastpooling(
 }
 
 
-int fast_oc_pooling(
-        const double* const image, // Input image, [gridh*gridw*nchannels]
+template <typename Dtype>
+int fast_oc_pooling_impl(
+        const Dtype* const image, // Input image, [gridh*gridw*nchannels]
         const int gridh, // The grid size along the height
         const int gridw, // The grid size along the width
         const int nchannels,
         const int method, // The pooling method
-        double* output // output pooled features, 
+        Dtype* output // output pooled features, 
                              // [gridh*gridw*nchannels]
         )
 {
     int num_rfs = gridh * (gridh + 1) * gridw * (gridw + 1) / 4;
-    memset(output, 0, sizeof(double) * num_rfs * nchannels);
-    const double* image_pq;
-    double* output_pq = output;
+    memset(output, 0, sizeof(Dtype) * num_rfs * nchannels);
+    const Dtype* image_pq;
+    Dtype* output_pq = output;
     switch (method) {
     case MAXPOOL:
         for (int i = 0; i < gridh; ++i) {
@@ -170,7 +170,7 @@ int fast_oc_pooling(
         break;
     case RMSPOOL: {
         int total_pixels = gridh * gridw * nchannels;
-        double* image2 = new double[total_pixels];
+        Dtype* image2 = new Dtype[total_pixels];
         for (int i = 0; i < total_pixels; ++i) {
             image2[i] = image[i] * image[i];
         }
@@ -205,6 +205,34 @@ int fast_oc_pooling(
     return 0;
 }
 
+extern "C" {
+
+int fastpooling(const double* const image, const int height, const int width,
+        const int nchannels, const int gridh, const int gridw,
+        const int method, double* output) {
+    return fastpooling_impl<double>(image, height, width, nchannels,
+                                    gridh, gridw, method, output);
+}
 
-} // extern "C"
+int fastpooling_float(const float* const image, const int height,
+        const int width, const int nchannels, const int gridh,
+        const int gridw, const int method, float* output) {
+    return fastpooling_impl<float>(image, height, width, nchannels,
+                                   gridh, gridw, method, output);
+}
+
+int fast_oc_pooling(const double* const image, const int gridh,
+        const int gridw, const int nchannels, const int method,
+        double* output) {
+    return fast_oc_pooling_impl<double>(image, gridh, gridw, nchannels,
+                                        method, output);
+}
 
+int fast_oc_pooling_float(const float* const image, const int gridh,
+        const int gridw, const int nchannels, const int method,
+        float* output) {
+    return fast_oc_pooling_impl<float>(image, gridh, gridw, nchannels,
+                                       method, output);
+}
+
+} // extern "C"
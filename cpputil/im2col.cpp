@@ -7,13 +7,12 @@
 
 #include <omp.h>
 
-extern "C" {
-
-void im2col(const double* imin,
-            const int* imsize,
-            const int* psize,
-            const int stride,
-            double* imout) {
+template <typename Dtype>
+void im2col_impl(const Dtype* imin,
+                 const int* imsize,
+                 const int* psize,
+                 const int stride,
+                 Dtype* imout) {
     // The naive im2col implementation
     int ph = psize[0], pw = psize[1];
     int height = imsize[0], width = imsize[1], nchannels = imsize[2];
@@ -23,11 +22,11 @@ void im2col(const double* imin,
     int width_out = (width - pw) / stride + 1;
 #pragma omp parallel for
     for (int idxh = 0; idxh < height_out; ++idxh) {
-        double* current = imout + idxh * width_out * ph * step_out;
+        Dtype* current = imout + idxh * width_out * ph * step_out;
         for (int idxw = 0; idxw < width_out; ++idxw) {
             // copy image[idxh:idxh+ph, idxw:idxw+pw, :]
             int hstart = idxh * stride;
-            const double* src = imin + (hstart * width + idxw * stride) * nchannels;
+            const Dtype* src = imin + (hstart * width + idxw * stride) * nchannels;
             for (int i = hstart; i < hstart + ph; ++i) {
                 // copy image[i, idxw:idxw+pw, :]
                 for (int j = 0; j < step_out; ++j) {
@@ -38,7 +37,19 @@ void im2col(const double* imin,
             }
         }
     }
-} // im2col
+} // im2col_impl
+
+extern "C" {
+
+void im2col(const double* imin, const int* imsize, const int* psize,
+            const int stride, double* imout) {
+    im2col_impl<double>(imin, imsize, psize, stride, imout);
+}
+
+void im2col_float(const float* imin, const int* imsize, const int* psize,
+                  const int stride, float* imout) {
+    im2col_impl<float>(imin, imsize, psize, stride, imout);
+}
 
 } // extern "C"
 
@@ -97,7 +97,7 @@ class ImageSet(object):
     def size_total(self):
         """Return the size of the dataset hosted on all nodes
         """
-        return mpi.COMM.allreduce(self.size())
+        return mpi.allreduce_scalar(self.size())
     
     def _read(self, idx):
         """reads a datum given by idx, if not prefetched.
@@ -115,6 +115,25 @@ class ImageSet(object):
         else:
             return self._read(idx)
     
+    def has_descriptors(self):
+        """Returns True if the dataset implements descriptor() and
+        image_from_descriptor(), which allows the images to be processed on
+        other nodes (see mpi.steal_map()).
+        """
+        return False
+    
+    def descriptor(self, idx):
+        """Returns a small picklable description of the datum given by idx,
+        from which image_from_descriptor() on any node returns the datum.
+        """
+        raise NotImplementedError
+    
+    def image_from_descriptor(self, descriptor):
+        """Returns the datum described by a descriptor returned by
+        descriptor(), possibly on another node.
+        """
+        raise NotImplementedError
+    
     def raw_data(self):
         """ Returns the raw data
         
@@ -196,6 +215,21 @@ class MirrorSet(ImageSet):
             im = self._original.image(idx - self._original.size())
             return np.ascontiguousarray(im[:, ::-1])
 
+    def has_descriptors(self):
+        return self._original.has_descriptors()
+
+    def descriptor(self, idx):
+        return (idx >= self._original.size(),
+                self._original.descriptor(idx % self._original.size()))
+
+    def image_from_descriptor(self, descriptor):
+        mirror, original_descriptor = descriptor
+        im = self._original.image_from_descriptor(original_descriptor)
+        if mirror:
+            return np.ascontiguousarray(im[:, ::-1])
+        else:
+            return im
+
     def label(self, idx):
         """ Returns the label for the corresponding datum
         """
@@ -253,6 +287,18 @@ class ResizeSet(ImageSet):
                                 self._target_size,
                                 mode='nearest')
 
+    def has_descriptors(self):
+        return self._original.has_descriptors()
+
+    def descriptor(self, idx):
+        return self._original.descriptor(idx)
+
+    def image_from_descriptor(self, descriptor):
+        return transform.resize(
+                self._original.image_from_descriptor(descriptor),
+                self._target_size,
+                mode='nearest')
+
     def label(self, idx):
         """ Returns the label for the corresponding datum
         """
@@ -338,9 +384,28 @@ class TwoLayerDataset(ImageSet):
         self._classnames = mpi.COMM.bcast(classnames)
     
     def _read(self, idx):
-        img = imread_rgb(self._rawdata[idx])
+        return self._read_file(self._rawdata[idx])
+    
+    def _read_file(self, filename):
+        img = imread_rgb(filename)
         return manipulate(img, self._target_size,
                 self._max_size, self._min_size, self._center_crop)
+    
+    def has_descriptors(self):
+        return True
+    
+    def descriptor(self, idx):
+        """The descriptor is (rank, idx, filename), so prefetched images are
+        not read again on the node that hosts them.
+        """
+        return (mpi.RANK, idx, self._rawdata[idx])
+    
+    def image_from_descriptor(self, descriptor):
+        rank, idx, filename = descriptor
+        if self._prefetch and rank == mpi.RANK:
+            return self._data[idx]
+        else:
+            return self._read_file(filename)
 
 
 class SubImageSet(ImageSet):
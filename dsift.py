@@ -69,7 +69,7 @@ class OrientedGradientExtractor(pipeline.Extractor):
             self._ANGLES = np.array(range(num_angles)) \
                     * np.pi / num_angles
 
-    def process(self, image):
+    def process(self, image, out = None):
         image = image.astype(np.double)
         if image.max() > 1:
             # The image is between 0 and 255 - we need to convert it to [0,1]
@@ -94,7 +94,14 @@ class OrientedGradientExtractor(pipeline.Extractor):
             for i in range(num_angles):
                 I_orient[:,:,i] = I_mag * np.abs(
                         np.cos(I_theta - self._ANGLES[i]) ** alpha)
+        if out is not None:
+            out[:] = I_orient
+            return out
         return I_orient
+
+    def output_shape(self, input_shape):
+        return (input_shape[0], input_shape[1],
+                self.specs.get('num_angles', _NUM_ANGLES))
     
     
 class DsiftExtractor(pipeline.Extractor):
@@ -143,13 +150,14 @@ class DsiftExtractor(pipeline.Extractor):
         # center
         self.weights = weights_h * weights_w
         
-    def process(self, image):
+    def process(self, image, out = None):
         '''
         processes a single image, return the locations
         and the values of detected SIFT features.
         image: a M*N image which is a numpy 2D array. If you 
             pass a color image, it will automatically be converted
             to a grayscale image.
+        out: (optional) the preallocated output buffer.
         
         Return values:
             feat
@@ -178,8 +186,22 @@ class DsiftExtractor(pipeline.Extractor):
         #              format(W,H,gS,pS,len(rangeH)*len(rangeW)))
         feat = self.calculate_sift_grid(image,rangeH,rangeW)
         feat = self.normalize_sift(feat)
+        if out is not None:
+            out[:] = feat
+            return out
         return feat
 
+    def output_shape(self, input_shape):
+        H, W = input_shape[:2]
+        pS = self.pS
+        gS = self.gS
+        if H < pS or W < pS:
+            return (0, 0, _NUM_SAMPLES*_NUM_ANGLES)
+        offsetH = ((H-pS) % gS)/2
+        offsetW = ((W-pS) % gS)/2
+        return ((H-pS-offsetH)/gS + 1, (W-pS-offsetW)/gS + 1,
+                _NUM_SAMPLES*_NUM_ANGLES)
+
     def calculate_sift_grid(self,image,rangeH,rangeW):
         '''This function calculates the unnormalized sift features
         It is called by process_image().
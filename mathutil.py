@@ -1,11 +1,16 @@
+import collections
 import glob
+import heapq
 import numpy as np
 from iceberk import mpi
 import logging
+import Queue
+import sys
+import threading
 
 def CHECK_IMAGE(img):
     if (type(img) is np.ndarray) and (img.ndim == 3) \
-            and (img.dtype == np.float64):
+            and (img.dtype == np.float64 or img.dtype == np.float32):
         pass
     else:
         raise RuntimeError, "The image format is incorrect."
@@ -16,11 +21,12 @@ def CHECK_SHAPE(img, shape):
     if img.shape != shape:
         raise RuntimeError, "The shapes do not equal."
 
-def gemm(alpha, A, B, dtype=None, out=None):
+def gemm(alpha, A, B, dtype=None, out=None, beta=0.0):
     '''A gemm function that uses scipy fblas functions, avoiding matrix copy
     when the input is transposed.
     
-    The returned matrix is designed to be C_CONTIGUOUS.
+    The returned matrix is designed to be C_CONTIGUOUS. If out is given, the
+    result is alpha * A * B + beta * out, so beta = 1 accumulates into out.
     '''
     from scipy.linalg.fblas import dgemm, sgemm
     if A.ndim != 2 or B.ndim != 2:
@@ -56,6 +62,8 @@ def gemm(alpha, A, B, dtype=None, out=None):
     else:
         fblas_gemm = dgemm
     if out is None:
+        if beta != 0.0:
+            raise ValueError, 'beta should be 0 when out is not given.'
         return fblas_gemm(alpha,B,A,trans_a=trans_b,trans_b=trans_a).T
     else:
         if out.dtype != dtype:
@@ -63,7 +71,7 @@ def gemm(alpha, A, B, dtype=None, out=None):
                     % repr(dtype)
         if not out.flags['C_CONTIGUOUS']:
             raise TypeError, "The output matrix should be C contiguous."
-        fblas_gemm(alpha, B, A, 0.0, out.T, trans_b, trans_a, True)
+        fblas_gemm(alpha, B, A, beta, out.T, trans_b, trans_a, True)
         return out
 
 
@@ -84,14 +92,15 @@ def dot(A, B, out=None):
 
 def dot_image(image, B, out=None):
     """ A wrapper that does dot for a multidimensional image that is often used
-    in the pipeline. The input image should be C-contiguous.
+    in the pipeline. The input image should be C-contiguous. The computation
+    is carried out with the dtype of the image.
     """
     
     imshape = image.shape
     if not image.flags['C_CONTIGUOUS']:
         raise TypeError, 'Error: cannot deal with non-C-contiguous image'
     if out is None:
-        out = np.empty((np.prod(imshape[:-1]), B.shape[1]))
+        out = np.empty((np.prod(imshape[:-1]), B.shape[1]), dtype=image.dtype)
     else:
         out.resize((np.prod(imshape[:-1]), B.shape[1]))
     out = gemm(1.0, image.reshape((np.prod(imshape[:-1]), imshape[-1])), B,
@@ -165,9 +174,81 @@ def wolfe_line_search_adagrad(x, func, alpha = 1., eta = 0., c1 = 0.01, c2 = 0.9
     logging.debug('wolfe ls: a = %f, f = %f, finished.' % (alpha, f))
     return alpha
 
+class BufferArena(object):
+    """BufferArena keeps a set of grow-only buffers, one per key, so that
+    arrays of varying shapes (e.g. the intermediate outputs of images with
+    different sizes) could be carved out of the same memory without
+    allocating for every call. A buffer is only reallocated when a larger
+    array is requested, and is never shrunk. It is not thread-safe: each
+    thread should keep its own arena.
+    """
+    def __init__(self):
+        self._buffers = {}
+        self._shapes = {}
+    
+    def get(self, key, shape, dtype = np.float64):
+        """Returns a C-contiguous array of the given shape and dtype that uses
+        the buffer of key. The content of the array is undefined, and it is
+        only valid until the next get() or adopt() with the same key.
+        """
+        dtype = np.dtype(dtype)
+        shape = tuple(int(s) for s in shape)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        buf = self._buffers.get(key)
+        if buf is None or buf.nbytes < nbytes:
+            if buf is not None:
+                # grow geometrically so slowly increasing sizes do not cause
+                # a reallocation every time
+                nbytes = max(nbytes, buf.nbytes + buf.nbytes / 2)
+            buf = np.empty(nbytes, dtype = np.uint8)
+            self._buffers[key] = buf
+        self._shapes[key] = (shape, dtype)
+        return buf[:int(np.prod(shape)) * dtype.itemsize].view(dtype).\
+                reshape(shape)
+    
+    def adopt(self, key, array):
+        """Uses the memory of array as the buffer of key if it is larger than
+        the current one. This avoids allocating a buffer when an array of the
+        right shape has just been created anyway.
+        """
+        if not array.flags['C_CONTIGUOUS']:
+            return
+        buf = self._buffers.get(key)
+        if buf is None or buf.nbytes < array.nbytes:
+            self._buffers[key] = array.reshape(array.size).view(np.uint8)
+        self._shapes[key] = (array.shape, array.dtype)
+    
+    def last(self, key):
+        """Returns the (shape, dtype) of the array last obtained with key, or
+        None if there is none.
+        """
+        return self._shapes.get(key)
+    
+    def nbytes(self):
+        """Returns the total size of the buffers in bytes.
+        """
+        return sum(buf.nbytes for buf in self._buffers.values())
+    
+    def clear(self):
+        """Releases all the buffers.
+        """
+        self._buffers = {}
+        self._shapes = {}
+
+
 class ReservoirSampler(object):
     """reservoir_sampler implements the reservoir sampling method based on numpy
-    matrices. It does NOT use mpi - each mpi node does sampling on its own.
+    matrices. It does NOT use mpi - each mpi node does sampling on its own,
+    except for get_global() which merges the samples of all nodes.
+    
+    Conceptually, every considered feature gets a uniform random key, and the
+    reservoir keeps the features with the N smallest keys. Once the reservoir
+    is full, we use the skip-count method (as in Algorithm L by Li): the
+    number of features until the next one whose key is below the largest
+    kept key W is drawn directly, and its key is drawn uniformly below W. So
+    the number of random numbers we draw is proportional to the number of
+    replacements rather than to the number of features considered. The keys
+    allow get_global() to merge the reservoirs of the nodes.
     """
     def __init__(self, num_samples):
         """Initializes the sampler by giving the number of data points N
@@ -175,40 +256,83 @@ class ReservoirSampler(object):
         self._num_samples = num_samples
         self._current = 0
         self._data = None
-        
+        self._keys = np.empty(num_samples)
+        # once the reservoir is full: the index of the next feature to keep,
+        # and a heap of (-key, entry) whose top is the largest kept key.
+        self._next = None
+        self._heap = None
+    
+    def _skip(self):
+        """Draws the index of the next feature to keep.
+        """
+        weight = -self._heap[0][0]
+        # 1 - rand() is in (0, 1], so the log is finite.
+        self._next += int(np.floor(np.log(1. - np.random.rand()) /
+                                   np.log1p(-weight))) + 1
+
     def consider(self, feature):
-        """Consider a feature batch. feature.shape[1:] should be the same for
-        any batch.
+        """Consider a feature batch, or a list of feature batches (such as the
+        features of several images) at once. feature.shape[1:] should be the
+        same for any batch.
         """
-        if self._data is None:
-            self._data = np.empty((self._num_samples,) + feature.shape[1:],
-                                  dtype=feature.dtype)
-        elif self._data.shape[1:] != feature.shape[1:]:
-            raise ValueError, \
-                    "Input data has the wrong size, should be %s " \
-                    % str(feature.shape[1:])
-        batch_size = feature.shape[0]
-        if self._current >= self._num_samples:
-            # to make sure we have unbiased sampling, we do 2 steps: first
-            # decide whether to use one sample or not, then decide which one it
-            # should replace
-            # we need to decide if we want to keep the feature
-            selected = np.random.rand(batch_size) < \
-                    (float(self._num_samples) / np.arange(self._current + 1,
-                            self._current + batch_size + 1))
-            count = selected.sum()
-            self._data[np.random.randint(self._num_samples, size = count)] = \
-                    feature[selected]
-            self._current += batch_size
+        if type(feature) is list or type(feature) is tuple:
+            batches = feature
         else:
-            # we need to fill the data first, and then deal with remaining
-            # features
-            count = min(self._num_samples - self._current, batch_size)
-            self._data[self._current:self._current+count] = feature[:count]
-            self._current += count
-            if count < batch_size:
-                # we have remaining features to consider
-                self.consider(feature[count:])
+            batches = [feature]
+        for batch in batches:
+            if self._data is None:
+                self._data = np.empty((self._num_samples,) + batch.shape[1:],
+                                      dtype=batch.dtype)
+            elif self._data.shape[1:] != batch.shape[1:]:
+                raise ValueError, \
+                        "Input data has the wrong size, should be %s " \
+                        % str(self._data.shape[1:])
+        offsets = np.cumsum([0] + [batch.shape[0] for batch in batches])
+        start = self._current
+        # we need to fill the data first, and then deal with remaining
+        # features
+        count = max(min(self._num_samples - start, offsets[-1]), 0)
+        for i, batch in enumerate(batches):
+            lo, hi = offsets[i], min(offsets[i+1], count)
+            if hi > lo:
+                self._data[start+lo:start+hi] = batch[:hi-lo]
+        self._keys[start:start+count] = np.random.rand(count)
+        if count > 0 and start + count == self._num_samples:
+            # the reservoir just got full
+            self._heap = [(-key, i) for i, key in enumerate(self._keys)]
+            heapq.heapify(self._heap)
+            self._next = self._num_samples - 1
+            self._skip()
+        self._current = start + offsets[-1]
+        if self._next is None:
+            return
+        # find the features to keep in this stack, and the entries with the
+        # largest keys that they replace.
+        rows = []
+        slots = []
+        while self._next < self._current:
+            key = -self._heap[0][0] * (1. - np.random.rand())
+            slot = heapq.heapreplace(self._heap, (-key, self._heap[0][1]))[1]
+            self._keys[slot] = key
+            rows.append(self._next - start)
+            slots.append(slot)
+            self._skip()
+        if len(rows) == 0:
+            return
+        rows = np.array(rows)
+        slots = np.array(slots)
+        # a later feature overrides an earlier one in the same entry, so we
+        # only keep the last one for each entry before the scatter.
+        slots, last = np.unique(slots[::-1], return_index = True)
+        rows = rows[::-1][last]
+        # rows are sorted, so the ones of batch i are bounds[i]:bounds[i+1].
+        order = np.argsort(rows)
+        rows, slots = rows[order], slots[order]
+        bounds = np.searchsorted(rows, offsets)
+        for i, batch in enumerate(batches):
+            lo, hi = bounds[i], bounds[i+1]
+            if hi > lo:
+                self._data[slots[lo:hi]] = batch[rows[lo:hi] - offsets[i]]
     
     def num_considered(self):
         """Return the number of considered samples
@@ -225,13 +349,62 @@ class ReservoirSampler(object):
         else:
             return self._data
 
+    def get_global(self, num_samples = None):
+        """Like get(), but returns the local part of a sample that is uniform
+        over the features considered on all the nodes, even if the nodes
+        considered different numbers of features. This should be called on
+        all nodes. The sample holds the features with the num_samples
+        smallest keys over all nodes, where num_samples defaults to the sum
+        of the reservoir sizes of all nodes, so the number of samples
+        returned on each node varies.
+        
+        This is exact as long as no node holds more of these features than
+        its reservoir. Otherwise, the sample is limited to the keys that all
+        full reservoirs are guaranteed to hold, and a warning is logged as
+        the sample is smaller than num_samples.
+        """
+        if self._data is None:
+            keys = np.zeros(0)
+        else:
+            keys = self._keys[:min(self._current, self._num_samples)]
+        if self._current > self._num_samples:
+            # we have not kept the features with keys above our largest key
+            limit = keys.max() if len(keys) > 0 else -np.inf
+        else:
+            limit = np.inf
+        gathered = mpi.COMM.allgather((np.sort(keys), limit,
+                                       self._num_samples))
+        if num_samples is None:
+            num_samples = sum(g[2] for g in gathered)
+        all_keys = np.sort(np.hstack([g[0] for g in gathered]))
+        if num_samples <= 0:
+            threshold = -np.inf
+        elif num_samples <= len(all_keys):
+            threshold = all_keys[num_samples - 1]
+        else:
+            threshold = np.inf
+        limit = min(g[1] for g in gathered)
+        if limit < threshold:
+            threshold = limit
+            if mpi.is_root():
+                logging.warning("ReservoirSampler.get_global: only %d of the "
+                                "%d requested samples could be drawn "
+                                "uniformly. Use larger reservoirs." % \
+                                ((all_keys <= threshold).sum(), num_samples))
+        if self._data is None:
+            return None
+        return self.get()[keys <= threshold]
+
 
 class MinibatchSampler(object):
     """MinibatchSampler is the general class that performs minibatch sampling
     from data
     """
-    def sample(self, batch_size):
+    def sample(self, batch_size, out = None):
         """return a minibatch sample. Your sampler should implement this.
+        If out is given, it is a minibatch previously returned by the same
+        sampler that is no longer used, and the sampler may write the new
+        minibatch into its arrays instead of allocating new ones.
         """
         raise NotImplementedError
 
@@ -250,8 +423,14 @@ class PostProcessSampler(MinibatchSampler):
         self._basic = basic_sampler
         self._funcs = funcs
 
-    def sample(self, batch_size):
-        batch = self._basic.sample(batch_size)
+    def sample(self, batch_size, out = None):
+        # the entries without a func are reused by the basic sampler. The
+        # other entries are created by the funcs, which may change their
+        # shape and dtype, so they are allocated anew.
+        if out is not None:
+            out = [buf if func is None else None
+                   for buf, func in zip(out, self._funcs)]
+        batch = self._basic.sample(batch_size, out = out)
         output = []
         for mat, func in zip(batch, self._funcs):
             if func is None:
@@ -281,13 +460,13 @@ class NdarraySampler(MinibatchSampler):
             raise ValueError, \
                     "The input ndarrays should have the same shape[0]."
         self._num_data_local = lengths[0]
-        self._num_data = mpi.COMM.allreduce(self._num_data_local)
+        self._num_data = mpi.allreduce_scalar(self._num_data_local)
         # initialize some bookkeeping values for the sampler
         self._indices = np.arange(self._num_data_local, dtype = np.int)
         np.random.shuffle(self._indices)
         self._pointer = 0
     
-    def sample(self, batch_size):
+    def sample(self, batch_size, out = None):
         # compute the local batch size, and make sure the sampling is done
         # proportional to the number of data points that is hosted locally.
         batch_size = int(batch_size * self._num_data_local / \
@@ -302,13 +481,17 @@ class NdarraySampler(MinibatchSampler):
         else:
             old_pointer = self._pointer
             self._pointer += batch_size
+        if out is None:
+            out = [None] * len(self._arrays)
         output = []
-        for array in self._arrays:
+        batch_idx = self._indices[old_pointer:self._pointer]
+        for array, buf in zip(self._arrays, out):
             if array is None:
                 output.append(None)
+            elif buf is None:
+                output.append(array[batch_idx])
             else:
-                batch_idx = self._indices[old_pointer:self._pointer]
-                output.append(array[batch_idx].copy())
+                output.append(np.take(array, batch_idx, axis = 0, out = buf))
         return output
         
 
@@ -317,8 +500,12 @@ class FileSampler(MinibatchSampler):
     use memory maps to access the files and do sampling, in order to save 
     memory. Currently, you will need to make sure all file parts for an array
     is loadable from the running machine.
+    
+    The memory maps of the most recently used parts are kept open, up to
+    max_open_files of them, so that we do not reopen the files for every
+    minibatch while staying below the limit on open file descriptors.
     """
-    def __init__(self, filenames):
+    def __init__(self, filenames, max_open_files = 64):
         """Initialize the sampler.
         Input:
             filenames: a list of filenames containing the data. Each filename
@@ -328,8 +515,16 @@ class FileSampler(MinibatchSampler):
                 will read the files one by one using their string order. The
                 list could contain None, in which case we will simply return
                 None for the corresponding sample.
+            max_open_files: the maximum number of memory maps kept open.
+                Default 64.
         """
+        # for each filename, we keep the names of its parts, the offsets of
+        # the parts in the whole array with offsets[-1] being the number of
+        # data, and the shape and dtype of a single data point.
         self._datamaps = []
+        # the open memory maps, from the least to the most recently used
+        self._open_maps = collections.OrderedDict()
+        self._max_open_files = max(int(max_open_files), 1)
         # precheck the files to understand the storage structure
         for fname in filenames:
             if fname is None:
@@ -339,17 +534,22 @@ class FileSampler(MinibatchSampler):
                 files.sort()
                 if len(files) == 0:
                     raise ValueError, "Cannot find file: %s" % fname
-                segments = []
-                start_id = 0
+                shapes = []
                 for f in files:
+                    # we only need the header, so the map is closed right away
                     mat = np.load(f, mmap_mode='r')
-                    end_id = mat.shape[0] + start_id
-                    segments.append((f, start_id, end_id, mat.shape[1:], mat.dtype))
-                    start_id = end_id
-
-                self._datamaps.append(segments)
+                    shapes.append((mat.shape, mat.dtype))
+                    del mat
+                if any(shape[1:] != shapes[0][0][1:] or dtype != shapes[0][1]
+                       for shape, dtype in shapes):
+                    raise ValueError, \
+                            "Files %s do not have the same shape and dtype." \
+                            % fname
+                offsets = np.cumsum([0] + [shape[0] for shape, _ in shapes])
+                self._datamaps.append((files, offsets, shapes[0][0][1:],
+                                       shapes[0][1]))
         # find the number of data
-        num_data = [m[-1][2] for m in self._datamaps]
+        num_data = [m[1][-1] for m in self._datamaps if m is not None]
         if not all(n == num_data[0] for n in num_data):
             raise ValueError, \
                     "Files %s do not have the same number of data."
@@ -359,7 +559,7 @@ class FileSampler(MinibatchSampler):
         self._pointer = 0
         return
 
-    def sample(self, batch_size):
+    def sample(self, batch_size, out = None):
         if (batch_size > self._num_data):
             raise ValueError, "I can't do such a big batch size!"
         batch_size = batch_size / mpi.SIZE
@@ -373,29 +573,121 @@ class FileSampler(MinibatchSampler):
             self._pointer += batch_size
         batch_idx = self._indices[old_pointer:self._pointer]
         batch_idx.sort()
-        return [self._sample_single(m, batch_idx) for m in self._datamaps]
+        if out is None:
+            out = [None] * len(self._datamaps)
+        return [self._sample_single(m, batch_idx, buf)
+                for m, buf in zip(self._datamaps, out)]
 
-    def _sample_single(self, datamap, indices):
-        """Sample the numpy array based on the current filename
+    def _sample_single(self, datamap, indices, output = None):
+        """Sample the numpy array based on the current filename. The indices
+        should be sorted. If output is given, the sample is written into it.
         """
         if datamap is None:
             return None
         else:
-            batchsize = len(indices)
-            output = np.empty((batchsize,) + datamap[0][-2],
-                              dtype = datamap[0][-1])
-            startid = 0
-            for m in datamap:
-                # determine my end location
-                endid = startid
-                while endid < batchsize and indices[endid] < m[2]:
-                    endid += 1
-                if endid > startid:
-                    mat = np.load(m[0], mmap_mode='r')
-                    output[startid:endid] = mat[indices[startid:endid] - m[1]]
-                startid = endid
+            files, offsets, shape, dtype = datamap
+            if output is None:
+                output = np.empty((len(indices),) + shape, dtype = dtype)
+            # since the indices are sorted, the indices in part i are
+            # indices[bounds[i]:bounds[i+1]]
+            bounds = np.searchsorted(indices, offsets)
+            for i, f in enumerate(files):
+                start, end = bounds[i], bounds[i+1]
+                if end > start:
+                    mat = self._memmap(f)
+                    # the indices are valid, so we use mode='clip' to avoid
+                    # the buffering numpy does for mode='raise'
+                    np.take(mat, indices[start:end] - offsets[i], axis = 0,
+                            out = output[start:end], mode = 'clip')
             return output
-                 
+
+    def _memmap(self, filename):
+        """Returns the memory map of filename, opening it if needed and
+        closing the least recently used one if too many are open.
+        """
+        mat = self._open_maps.pop(filename, None)
+        if mat is None:
+            mat = np.load(filename, mmap_mode='r')
+            if len(self._open_maps) >= self._max_open_files:
+                self._open_maps.popitem(last = False)
+        self._open_maps[filename] = mat
+        return mat
+
+
+class PrefetchSampler(MinibatchSampler):
+    """PrefetchSampler wraps a basic sampler, and samples the upcoming
+    minibatches on a background thread, so that the reading and
+    postprocessing of the next minibatch overlaps with the computation on the
+    current one. The minibatches are kept in a ring of num_prefetch + 1
+    buffers that the basic sampler is asked to reuse (see
+    MinibatchSampler.sample()), so the returned minibatch is only valid until
+    the next call to sample(). Copy it if you need to keep it.
+
+    Since the basic sampler is called from the background thread, its
+    sample() should not carry out any mpi communication. The samplers in this
+    module satisfy this, but a PostProcessSampler whose funcs communicate
+    does not.
+    """
+    def __init__(self, basic_sampler, batch_size, num_prefetch = 2):
+        """Initialize the prefetching sampler
+        Input:
+            basic_sampler: the basic sampler that generates the minibatch.
+            batch_size: the batch size. As the minibatches are sampled ahead
+                of time, sample() should always be called with this size.
+            num_prefetch: the number of minibatches to sample ahead of time.
+        """
+        self._basic = basic_sampler
+        self._batch_size = batch_size
+        # the buffers that could be reused, and the minibatches ready to be
+        # returned, as (success, batch or exc_info).
+        self._free = Queue.Queue()
+        self._ready = Queue.Queue()
+        for i in range(num_prefetch + 1):
+            # the buffers are allocated by the basic sampler the first time
+            self._free.put(None)
+        self._current = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target = self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                buf = self._free.get(timeout = 0.1)
+            except Queue.Empty:
+                continue
+            try:
+                batch = self._basic.sample(self._batch_size, out = buf)
+            except Exception:
+                self._ready.put((False, sys.exc_info()))
+                return
+            self._ready.put((True, batch))
+
+    def sample(self, batch_size, out = None):
+        if batch_size != self._batch_size:
+            raise ValueError, \
+                    "PrefetchSampler is initialized with batch size %d." \
+                    % self._batch_size
+        if self._current is not None:
+            # the previous minibatch is no longer used.
+            self._free.put(self._current)
+            self._current = None
+        success, batch = self._ready.get()
+        if not success:
+            # re-raise the exception of the background thread, and keep it
+            # for the later calls as the thread has stopped.
+            self._ready.put((success, batch))
+            raise batch[0], batch[1], batch[2]
+        self._current = batch
+        return list(batch)
+
+    def close(self):
+        """Stops the background thread.
+        """
+        self._stop.set()
+        self._thread.join()
+
 ###############################################################################
 # MPI-related utils are implemented here.
 ###############################################################################
@@ -406,7 +698,7 @@ def mpi_mean(data):
     s_local = data.sum(0)
     m = np.empty_like(s_local)
     mpi.COMM.Allreduce(s_local, m)
-    num_data = mpi.COMM.allreduce(data.shape[0])
+    num_data = mpi.allreduce_scalar(data.shape[0])
     m /= float(num_data)
     return m
 
@@ -424,7 +716,7 @@ def mpi_meanstd(data):
     except MemoryError:
         std_local_computed = 0
     # let's check if some nodes did not have enough memory
-    if mpi.COMM.allreduce(std_local_computed) < mpi.SIZE:
+    if mpi.allreduce_scalar(std_local_computed) < mpi.SIZE:
         # we need to compute the std_local in a batch-based way
         std_local = np.zeros_like(data[0])
         # we try to get a reasonable minibatch size
@@ -437,7 +729,7 @@ def mpi_meanstd(data):
             std_local += data_batch.sum(axis=0)
     std = np.empty_like(std_local)
     mpi.COMM.Allreduce(std_local, std)
-    num_data = mpi.COMM.allreduce(data.shape[0])
+    num_data = mpi.allreduce_scalar(data.shape[0])
     std /= float(num_data)
     np.sqrt(std, out=std)
     return m, std
@@ -445,23 +737,206 @@ def mpi_meanstd(data):
 def mpi_std(data):
     return mpi_meanstd(data)[1]
 
+# the size of the row blocks that mpi_meancov centers at a time
+_MEANCOV_BLOCK_BYTES = 1 << 22
+
+class MeanCovAccumulator(object):
+    """MeanCovAccumulator computes the mean and the covariance matrix of data
+    that are given in row blocks, so the data never need to be held in memory
+    or centered all at once. Each node accumulates the sum and the scatter
+    matrix of its data after subtracting a fixed shift (the mean of the first
+    block it considers), which keeps the sums small and thus avoids the loss
+    of precision of accumulating the raw sums. The scatter matrix is updated
+    in place with one gemm per block. The correction for the shift and the
+    merge of the nodes (as in Chan et al.) are carried out once in get(),
+    which should be called on all nodes.
+    """
+    def __init__(self):
+        self._count = 0
+        self._shift = None
+        self._sum = None
+        self._scatter = None
+        self._dtype = None
+
+    def consider(self, block):
+        """Consider a block of data, each row being a data point. The blocks
+        should all have the same number of columns. Each block costs a
+        (dim, dim) gemm, so blocks should preferably have at least dim rows.
+        """
+        block = np.asarray(block)
+        if block.ndim != 2:
+            raise ValueError, "The data block should be a 2-d matrix."
+        if self._shift is None:
+            if block.shape[0] == 0:
+                return
+            self._shift = block.mean(0, dtype = np.float64)
+            self._sum = np.zeros(block.shape[1])
+            self._scatter = np.zeros((block.shape[1], block.shape[1]))
+            self._dtype = block.dtype
+        elif block.shape[1] != self._shift.shape[0]:
+            raise ValueError, \
+                    "Input data has the wrong size, should be %d " \
+                    % self._shift.shape[0]
+        if block.shape[0] == 0:
+            return
+        centered = block - self._shift
+        self._sum += centered.sum(0)
+        gemm(1.0, centered.T, centered, out = self._scatter, beta = 1.0)
+        self._count += block.shape[0]
+
+    def num_considered(self):
+        """Return the number of data considered on the local node
+        """
+        return self._count
+
+    def get(self):
+        """Returns the mean and the covariance matrix over all nodes. This
+        should be called on all nodes, and at least one node should have
+        considered some data.
+        """
+        dim = mpi.allreduce_scalar(
+                -1 if self._shift is None else self._shift.shape[0], max)
+        if dim < 0:
+            raise ValueError, "No data has been considered."
+        if self._shift is None:
+            self._shift = np.zeros(dim)
+            self._sum = np.zeros(dim)
+            self._scatter = np.zeros((dim, dim))
+        num_data = mpi.allreduce_scalar(self._count)
+        # the local mean is shift + delta
+        delta = self._sum / max(self._count, 1)
+        # the mean needs a small reduction first, so that the scatter
+        # matrices could be merged around it with a single Allreduce.
+        sum_local = (self._shift + delta) * self._count
+        m = np.empty_like(sum_local)
+        mpi.COMM.Allreduce(sum_local, m)
+        m /= float(num_data)
+        # the scatter matrix around m is the one around the shift, minus
+        # count * delta * delta^T, plus count * diff * diff^T. We apply the
+        # correction in place, and revert it after the reduction.
+        diff = self._shift + delta - m
+        _add_outer(self._scatter, diff, delta, self._count)
+        covmat = np.empty_like(self._scatter)
+        mpi.COMM.Allreduce(self._scatter, covmat)
+        _add_outer(self._scatter, diff, delta, -self._count)
+        covmat /= float(num_data)
+        return m, covmat
+
+
+def _add_outer(mat, u, v, scale):
+    """Adds scale * (u * u^T - v * v^T) to mat in place, in row blocks so that
+    no (dim, dim) temporary is created.
+    """
+    if scale == 0:
+        return
+    block = max(_MEANCOV_BLOCK_BYTES / max(mat[:1].nbytes, 1), 1)
+    for start in range(0, mat.shape[0], block):
+        end = min(start + block, mat.shape[0])
+        mat[start:end] += scale * (np.outer(u[start:end], u) -
+                                   np.outer(v[start:end], v))
+
+
 def mpi_meancov(data, copydata = False):
-    """An mpi implementation of the covariance matrix over different nodes
+    """An mpi implementation of the mean and the covariance matrix over
+    different nodes. data could either be a 2-d matrix, which is processed in
+    row blocks and never modified, or an iterable of 2-d row blocks (such as
+    a generator), in which case the data do not need to be all in memory.
+    copydata is kept for backward compatibility and has no effect.
     """
-    m = mpi_mean(data)
-    if copydata:
-        # copy the data and avoid numerical instability
-        data = data - m
+    accumulator = MeanCovAccumulator()
+    if isinstance(data, np.ndarray):
+        dtype = data.dtype
+        # each block costs a (dim, dim) gemm, so we use at least dim rows
+        minibatch = max(_MEANCOV_BLOCK_BYTES / max(data[:1].nbytes, 1),
+                        data.shape[1], 1)
+        for start in range(0, data.shape[0], minibatch):
+            accumulator.consider(data[start:start+minibatch])
     else:
-        data -= m
-    cov_local = dot(data.T, data)
-    covmat = np.empty_like(cov_local)
-    mpi.COMM.Allreduce(cov_local, covmat)
-    num_data = mpi.COMM.allreduce(data.shape[0])
-    covmat /= float(num_data)
-    if not copydata:
-        data += m
+        for block in data:
+            accumulator.consider(block)
+        dtype = accumulator._dtype
+    m, covmat = accumulator.get()
+    if dtype is not None and dtype.kind == 'f' and dtype != covmat.dtype:
+        # return the same dtype as the input, as before
+        m = m.astype(dtype)
+        covmat = covmat.astype(dtype)
     return m, covmat
 
+def _mpi_cov_dot(data, m, Q, num_data):
+    """Returns cov(data) * Q over all nodes, where m is the mean of the data,
+    without forming the covariance matrix or centering the data.
+    """
+    minibatch = max(_MEANCOV_BLOCK_BYTES / max(data[:1].nbytes, 1), 1)
+    mQ = np.dot(m, Q)
+    product_local = np.zeros(Q.shape)
+    for start in range(0, data.shape[0], minibatch):
+        block = np.asarray(data[start:start+minibatch], dtype = np.float64)
+        # (X - m) * Q, and then (X - m)^T * that
+        Z = dot(block, Q)
+        Z -= mQ
+        product_local += dot(block.T, Z)
+        product_local -= np.outer(m, Z.sum(0))
+    product = np.empty_like(product_local)
+    mpi.COMM.Allreduce(product_local, product)
+    product /= float(num_data)
+    return product
+
+def _mpi_orthonormalize(Y):
+    """Orthonormalizes the columns of Y on root, and broadcasts the result so
+    that all nodes use exactly the same basis.
+    """
+    if mpi.is_root():
+        Q = np.ascontiguousarray(np.linalg.qr(Y)[0])
+    else:
+        Q = np.empty(Y.shape)
+    mpi.COMM.Bcast(Q)
+    return Q
+
+def mpi_randomized_pca(data, num_components, oversample = 10, num_iter = 2):
+    """An mpi implementation of randomized subspace iteration (Halko et al.)
+    that finds the top eigenvectors of the covariance matrix of the data,
+    without forming the covariance matrix. Each iteration costs two passes
+    over the local data and one Allreduce of a (dim, num_components +
+    oversample) matrix.
+    Input:
+        data: the local data, a 2-d matrix with each row being a data point.
+            Unlike mpi_meancov, an iterable of row blocks is not supported,
+            since the data is passed over several times.
+        num_components: the number of components to keep.
+        oversample: the number of extra random vectors used in the iteration.
+        num_iter: the number of power iterations.
+    Output:
+        m: the mean of the data.
+        eigval: the top eigenvalues, in descending order.
+        eigvec: the corresponding eigenvectors as columns.
+    Raises:
+        TypeError, if data is not a 2-d matrix.
+    """
+    if not isinstance(data, np.ndarray) or data.ndim != 2:
+        raise TypeError, \
+                "mpi_randomized_pca needs the local data as a 2-d matrix, " \
+                "got %s." % repr(type(data))
+    m = np.asarray(mpi_mean(data), dtype = np.float64)
+    num_data = mpi.allreduce_scalar(data.shape[0])
+    dim = data.shape[1]
+    if num_components > dim:
+        raise ValueError, \
+                "Cannot keep %d components of %d-dimensional data." \
+                % (num_components, dim)
+    k = min(num_components + oversample, dim)
+    Q = _mpi_orthonormalize(np.random.randn(dim, k))
+    for i in range(num_iter):
+        Q = _mpi_orthonormalize(_mpi_cov_dot(data, m, Q, num_data))
+    # the Rayleigh-Ritz step: the eigendecomposition of the covariance
+    # restricted to the subspace
+    small = np.dot(Q.T, _mpi_cov_dot(data, m, Q, num_data))
+    small += small.T
+    small /= 2.
+    eigval, eigvec = np.linalg.eigh(small)
+    order = np.argsort(eigval)[::-1][:num_components]
+    eigval = eigval[order]
+    eigvec = np.dot(Q, eigvec[:, order])
+    return m, eigval, eigvec
+
 def mpi_cov(data, copydata = False):
     return mpi_meancov(data, copydata)[1]
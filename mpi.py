@@ -1,30 +1,44 @@
 ''' mpi implements common util functions based on mpi4py.
 '''
 
+import atexit
 import cPickle as pickle
 import glob
+import json
 import logging
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import os
 import random
 import socket
 import sys
+import thread
+import threading
 import time
+import util
 
 # MPI
-try:
-    from mpi4py import MPI
-    COMM = MPI.COMM_WORLD
-except Exception, e:
-    sys.stderr.write(\
-            "Warning: I cannot import mpi4py. Using a dummpy single noded "\
-            "implementation instead. The program will run in single node mode "\
-            "even if you executed me with mpirun or mpiexec.\n")
-    sys.stderr.write("We STRONGLY recommend you to try to install mpi and "\
-                     "mpi4py.\n")
-    sys.stderr.write("mpi4py exception message is:")
-    sys.stderr.write(repr(Exception) + repr(e))
-    from _mpi_dummy import COMM
+import _mpi_multiprocess
+if _mpi_multiprocess.is_worker():
+    # we are started by mprun.py, and use local processes instead of mpi
+    COMM = _mpi_multiprocess.COMM()
+    MPI = _mpi_multiprocess.MPI
+else:
+    try:
+        from mpi4py import MPI
+        COMM = MPI.COMM_WORLD
+    except Exception, e:
+        sys.stderr.write(\
+                "Warning: I cannot import mpi4py. Using a dummpy single noded "\
+                "implementation instead. The program will run in single node "\
+                "mode even if you executed me with mpirun or mpiexec. Use "\
+                "mprun.py to run on the local cores without mpi.\n")
+        sys.stderr.write("We STRONGLY recommend you to try to install mpi and "\
+                         "mpi4py.\n")
+        sys.stderr.write("mpi4py exception message is:")
+        sys.stderr.write(repr(Exception) + repr(e))
+        from _mpi_dummy import COMM
+        MPI = None
 
 RANK = COMM.Get_rank()
 SIZE = COMM.Get_size()
@@ -35,7 +49,19 @@ if _HOST_RAW.find('.') == -1:
 else:
     HOST = _HOST_RAW[:_HOST_RAW.find('.')]
 _MPI_PRINT_MESSAGE_TAG = 560710
+_STEAL_REQUEST_TAG = 560711
+_STEAL_REPLY_TAG = 560712
 _MPI_BUFFER_LIMIT = 1073741824
+# barrier() spins for this many seconds before it starts to sleep, with the
+# sleep time starting from _BARRIER_FIRST_SLEEP and doubling each time.
+_BARRIER_SPIN = 0.0005
+_BARRIER_FIRST_SLEEP = 0.00001
+# the communicators used by shared_bcast, computed on first use
+_NODE_COMMS = False
+# the shared memory windows allocated by shared_bcast
+_SHARED_WINDOWS = {}
+# the communication tracer, see enable_tracing()
+_TRACER = None
 
 # we need to set the random seed different for each mpi instance
 random.seed(time.time() * RANK)
@@ -53,9 +79,9 @@ def mkdir(dirname):
 
 def agree(decision):
     """agree() makes the decision consistent by propagating the decision of the
-    root to everyone
+    root to everyone. The decision is treated as a boolean.
     """
-    return COMM.bcast(decision)
+    return bcast_scalar(bool(decision))
 
 
 def elect():
@@ -65,7 +91,7 @@ def elect():
     Output:
         the rank of the president
     '''
-    president = COMM.bcast(np.random.randint(SIZE))
+    president = bcast_scalar(np.random.randint(SIZE))
     return president
 
 
@@ -81,21 +107,201 @@ def is_root():
     return RANK == 0
 
 
+def _scalar_buffer(value, dtype = None):
+    """Returns a one-element array of the given dtype (default float64)
+    holding value, or None if value is not a number that MPI can handle as a
+    typed buffer. The dtype does not depend on the local type of value, so
+    the nodes always agree on the MPI datatype even if some of them pass an
+    int and others a float.
+    """
+    if not isinstance(value, (bool, int, long, float, np.bool_, np.integer,
+                              np.floating)):
+        return None
+    if dtype is None:
+        dtype = np.float64
+    return np.array([value], dtype = dtype)
+
+
+def _scalar_result(buf, value):
+    """Converts the received one-element buffer back to a python number of
+    the same kind as the local value.
+    """
+    result = buf[0].item()
+    if isinstance(value, (bool, np.bool_)):
+        return bool(result)
+    elif isinstance(value, (int, long, np.integer)):
+        return int(round(result))
+    return result
+
+
+def allreduce_scalar(value, op = None, dtype = None):
+    """Reduces a number over all nodes with a typed buffer, avoiding the
+    pickling done by COMM.allreduce. Booleans are summed as ints.
+    
+    Input:
+        value: the local number.
+        op: (optional) the MPI op, or the builtin max, min or sum. Default
+            sum.
+        dtype: (optional) the dtype used in the reduction, which should be
+            the same on all nodes. Default float64, which is exact for
+            integers smaller than 2**53; pass np.int64 for larger ones.
+    Output:
+        the reduced number, as a python number of the same kind (bool, int
+        or float) as the local value.
+    """
+    if SIZE == 1:
+        return value
+    if op is None or op is sum:
+        op = MPI.SUM
+    elif op is max:
+        op = MPI.MAX
+    elif op is min:
+        op = MPI.MIN
+    if dtype is None and (op == MPI.LAND or op == MPI.LOR):
+        # MPI only defines the logical ops on integers
+        dtype = np.int64
+    sendbuf = _scalar_buffer(value, dtype)
+    if sendbuf is None:
+        return COMM.allreduce(value, op = op)
+    recvbuf = np.empty_like(sendbuf)
+    COMM.Allreduce(sendbuf, recvbuf, op = op)
+    if isinstance(value, (bool, np.bool_)) and op == MPI.SUM:
+        return int(round(recvbuf[0].item()))
+    return _scalar_result(recvbuf, value)
+
+
+def bcast_scalar(value, root = 0, dtype = None):
+    """Broadcasts a number from root with a typed buffer, avoiding the
+    pickling done by COMM.bcast. The non-root nodes should pass a number,
+    whose value is ignored. dtype is as in allreduce_scalar().
+    
+    Output:
+        the number on root, as a python number of the same kind as the local
+        value.
+    """
+    if SIZE == 1:
+        return value
+    buf = _scalar_buffer(value, dtype)
+    if buf is None:
+        return COMM.bcast(value, root = root)
+    COMM.Bcast(buf, root = root)
+    return _scalar_result(buf, value)
+
+
+def bcast_array(array, root = 0):
+    """Broadcasts a small numeric array from root with typed buffers: a fixed
+    size header carrying the dtype and the shape, followed by the data. The
+    array is ignored on the non-root nodes. Arrays that MPI cannot send as a
+    typed buffer are pickled.
+    
+    Output:
+        the array on root. On root, the input array itself is returned.
+    """
+    if SIZE == 1:
+        return array
+    # header: the dtype char (0 if we need to pickle), ndim and shape
+    header = np.zeros(2 + 32, dtype = np.int64)
+    if RANK == root:
+        array = np.asarray(array)
+        if array.dtype.kind in 'biufc' and array.dtype.isnative:
+            header[0] = ord(array.dtype.char)
+            header[1] = array.ndim
+            header[2:2 + array.ndim] = array.shape
+    COMM.Bcast(header, root = root)
+    if header[0] == 0:
+        return COMM.bcast(array, root = root)
+    if RANK == root:
+        COMM.Bcast(np.ascontiguousarray(array), root = root)
+        return array
+    data = np.empty(tuple(header[2:2 + header[1]]),
+                    dtype = np.dtype(chr(header[0])))
+    COMM.Bcast(data, root = root)
+    return data
+
+
+def iallreduce(sendbuf, recvbuf, op = None):
+    """Starts a non-blocking Allreduce from sendbuf to recvbuf and returns the
+    request, which should be completed with waitall(). The buffers should not
+    be touched before that. If non-blocking collectives are not available, a
+    blocking Allreduce is carried out and None is returned.
+    
+    Input:
+        op: (optional) the MPI op. Default sum.
+    """
+    if SIZE == 1:
+        recvbuf[:] = sendbuf
+        return None
+    if op is None:
+        op = MPI.SUM
+    if hasattr(COMM, 'Iallreduce'):
+        try:
+            return COMM.Iallreduce(sendbuf, recvbuf, op = op)
+        except NotImplementedError:
+            # mpi4py defines Iallreduce even if the MPI library is MPI-2
+            pass
+    COMM.Allreduce(sendbuf, recvbuf, op = op)
+    return None
+
+
+def waitall(requests):
+    """Waits for the requests returned by the non-blocking helpers. None
+    entries are ignored.
+    """
+    requests = [r for r in requests if r is not None]
+    if len(requests) > 0:
+        start = time.time()
+        MPI.Request.Waitall(requests)
+        if _TRACER is not None and isinstance(COMM, _TracingComm):
+            _TRACER.record('Waitall', _call_site(), start,
+                           time.time() - start, 0)
+
+
+def _wait(test, max_sleep, spin = None):
+    """Waits until test() returns True. We first spin for spin seconds (default
+    _BARRIER_SPIN), and then sleep with exponentially growing intervals of at
+    most max_sleep seconds, so short waits return quickly and long waits do
+    not occupy the CPU.
+    """
+    if spin is None:
+        spin = _BARRIER_SPIN
+    deadline = time.time() + spin
+    while not test():
+        if time.time() > deadline:
+            break
+    else:
+        return
+    delay = _BARRIER_FIRST_SLEEP
+    while not test():
+        time.sleep(delay)
+        delay = min(delay * 2, max_sleep)
+
+
 def barrier(tag=0, sleep=0.01):
     ''' A better mpi barrier
     
     The original MPI.comm.barrier() may cause idle processes to still occupy
-    the CPU, while this barrier waits.
+    the CPU, while this barrier waits: it spins briefly and then sleeps with
+    exponentially growing intervals of at most sleep seconds (see _wait()).
+    The native non-blocking Ibarrier is used if available, otherwise a
+    dissemination barrier with messages of the given tag.
     '''
     if SIZE == 1: 
         return 
+    if hasattr(COMM, 'Ibarrier'):
+        try:
+            req = COMM.Ibarrier()
+        except NotImplementedError:
+            # mpi4py defines Ibarrier even if the MPI library is MPI-2
+            req = None
+        if req is not None:
+            _wait(req.Test, sleep)
+            return
     mask = 1 
     while mask < SIZE: 
         dst = (RANK + mask) % SIZE 
         src = (RANK - mask + SIZE) % SIZE 
         req = COMM.isend(None, dst, tag) 
-        while not COMM.Iprobe(src, tag): 
-            time.sleep(sleep) 
+        _wait(lambda: COMM.Iprobe(src, tag), sleep)
         COMM.recv(None, src, tag) 
         req.Wait() 
         mask <<= 1
@@ -184,36 +390,223 @@ def distribute(mat):
     """Distributes the mat from root to individual nodes
     
     The data will be distributed along the first axis, as even as possible.
-    You should make sure that the matrix is in C-contiguous format.
+    The rows are sent with a collective scatter (see _scatter_rows), so mat
+    does not need to be C-contiguous.
     """
     # quick check
     if SIZE == 1:
         return mat
     if is_root():
+        num_rows = mat.shape[0]
         shape = mat.shape[1:]
-        segments = get_segments(mat.shape[0])
         dtype = mat.dtype
     else:
+        num_rows = 0
         shape = None
-        segments = None
         dtype = None
-    shape = COMM.bcast(shape)
-    dtype = COMM.bcast(dtype)
-    segments = COMM.bcast(segments)
+    segments = get_segments(bcast_scalar(num_rows))
+    shape, dtype = COMM.bcast((shape, dtype))
+    data = np.empty((segments[RANK+1] - segments[RANK],) + shape,
+                    dtype = dtype)
+    if _scatter_rows(mat, data, segments):
+        return data
+    # fall back to point-to-point sends from root
     if is_root():
         if mat.flags['C_CONTIGUOUS'] != True:
             logging.warning('Warning: mat is not contiguous.')
             mat = np.ascontiguousarray(mat)
         for i in range(1,SIZE):
             safe_send_matrix(mat[segments[i]:segments[i+1]], dest=i)
-        data = mat[:segments[1]].copy()
+        data[:] = mat[:segments[1]]
     else:
-        data = np.empty((segments[RANK+1] - segments[RANK],) + shape,
-                        dtype = dtype)
         safe_recv_matrix(data)
     return data
 
 
+def _scatter_rows(mat, data, segments):
+    """Scatters the rows segments[i]:segments[i+1] of mat on root into data
+    on node i, using Scatterv with a datatype of one row so that the counts
+    do not overflow. To deal with the mpi4py 2GB limit, the rows are sent in
+    rounds of at most _MPI_BUFFER_LIMIT bytes in total. If mat is not
+    C-contiguous, root copies only the rows of the current round into a
+    staging buffer.
+    
+    Returns False on all nodes, without communicating, if MPI datatypes are
+    not available.
+    """
+    rowbytes = data.dtype.itemsize * int(np.prod(data.shape[1:]))
+    if MPI is None or rowbytes == 0 or not hasattr(COMM, 'Scatterv'):
+        return False
+    counts = [segments[i+1] - segments[i] for i in range(SIZE)]
+    rows_per_round = max(_MPI_BUFFER_LIMIT / (rowbytes * SIZE), 1)
+    num_rounds = (max(counts) + rows_per_round - 1) / rows_per_round
+    rowtype = MPI.BYTE.Create_contiguous(rowbytes)
+    rowtype.Commit()
+    try:
+        for r in range(num_rounds):
+            start = r * rows_per_round
+            round_counts = [max(min(count - start, rows_per_round), 0)
+                            for count in counts]
+            if is_root():
+                if mat.flags['C_CONTIGUOUS']:
+                    sendbuf = mat
+                    displs = [segments[i] + start for i in range(SIZE)]
+                else:
+                    sendbuf = np.empty((sum(round_counts),) + data.shape[1:],
+                                       dtype = data.dtype)
+                    displs = [sum(round_counts[:i]) for i in range(SIZE)]
+                    for i in range(SIZE):
+                        sendbuf[displs[i]:displs[i] + round_counts[i]] = \
+                                mat[segments[i] + start:
+                                    segments[i] + start + round_counts[i]]
+                sendspec = [sendbuf, round_counts, displs, rowtype]
+            else:
+                sendspec = None
+            recv = data[start:start + round_counts[RANK]]
+            COMM.Scatterv(sendspec, [recv, round_counts[RANK], rowtype],
+                          root = 0)
+    finally:
+        rowtype.Free()
+    return True
+
+
+class _StealScheduler(object):
+    """Hands out chunks of the items of all nodes for steal_map(). A node gets
+    chunks from the front of its own items first, and then steals chunks from
+    the back of the node with the most remaining items.
+    """
+    def __init__(self, descriptors, chunk_size):
+        self._descriptors = descriptors
+        self._chunk_size = chunk_size
+        self._start = [0] * len(descriptors)
+        self._end = [len(d) for d in descriptors]
+        self.num_stolen = 0
+
+    def next(self, rank):
+        """Returns the next chunk (owner, start, descriptors) for rank, or
+        None if all items have been handed out.
+        """
+        if self._end[rank] > self._start[rank]:
+            owner = rank
+            start = self._start[rank]
+            end = min(start + self._chunk_size, self._end[rank])
+            self._start[rank] = end
+        else:
+            remaining = [e - s for s, e in zip(self._start, self._end)]
+            owner = int(np.argmax(remaining))
+            if remaining[owner] == 0:
+                return None
+            end = self._end[owner]
+            start = max(end - self._chunk_size, self._start[owner])
+            self._end[owner] = start
+            self.num_stolen += end - start
+        return owner, start, self._descriptors[owner][start:end]
+
+
+def _serve_steal_requests(scheduler, active, block, sleep):
+    """Answers the chunk requests of the other nodes on root, and returns the
+    number of nodes that are still working. If block is True, waits until at
+    least one request is answered.
+    """
+    status = MPI.Status()
+    while True:
+        served = False
+        while active > 0 and COMM.Iprobe(source = MPI.ANY_SOURCE,
+                                         tag = _STEAL_REQUEST_TAG,
+                                         status = status):
+            source = status.Get_source()
+            COMM.recv(None, source, _STEAL_REQUEST_TAG)
+            chunk = scheduler.next(source)
+            COMM.send(chunk, source, _STEAL_REPLY_TAG)
+            if chunk is None:
+                active -= 1
+            served = True
+        if served or not block or active == 0:
+            return active
+        time.sleep(sleep)
+
+
+def steal_map(func, descriptors, chunk_size = 8, gather = True,
+              sleep = 0.001):
+    """Applies func to the local list of descriptors, balancing the work over
+    all nodes: root hands out chunks of items on demand, and a node that has
+    finished its own items processes the remaining items of the others. This
+    helps when the cost of the items varies a lot (e.g. images of different
+    sizes), which would make some nodes wait for the others.
+    
+    Since an item could be processed on any node, func should only depend on
+    the descriptor (e.g. an image filename), and the descriptors should be
+    picklable. Root answers the requests between its own chunks, so chunks
+    should be reasonably small.
+    
+    Input:
+        func: the function applied to each descriptor.
+        descriptors: the list of local descriptors.
+        chunk_size: (optional) the number of items handed out at a time.
+            Default 8.
+        gather: (optional) if True, the results are sent back to the nodes
+            that own the descriptors. Otherwise, func is only called for its
+            side effects on the node that runs it, and None is returned.
+            Default True.
+        sleep: (optional) the time root sleeps between polls when it has no
+            work left. Default 0.001.
+    Output:
+        results: the list of func(descriptor) in the order of the local
+            descriptors if gather is True, otherwise None.
+    """
+    if SIZE == 1:
+        results = [func(d) for d in descriptors]
+        if gather:
+            return results
+        else:
+            return None
+    descriptors = list(descriptors)
+    all_descriptors = COMM.gather(descriptors)
+    results = []
+    if is_root():
+        scheduler = _StealScheduler(all_descriptors, chunk_size)
+        active = SIZE - 1
+        while True:
+            active = _serve_steal_requests(scheduler, active, False, sleep)
+            chunk = scheduler.next(RANK)
+            if chunk is None:
+                break
+            owner, start, chunk_descriptors = chunk
+            results.append((owner, start,
+                            [func(d) for d in chunk_descriptors]))
+        while active > 0:
+            active = _serve_steal_requests(scheduler, active, True, sleep)
+        logging.debug("steal_map: %d items stolen." % scheduler.num_stolen)
+    else:
+        COMM.send(None, 0, _STEAL_REQUEST_TAG)
+        chunk = COMM.recv(None, 0, _STEAL_REPLY_TAG)
+        while chunk is not None:
+            # ask for the next chunk before working on this one
+            COMM.send(None, 0, _STEAL_REQUEST_TAG)
+            owner, start, chunk_descriptors = chunk
+            results.append((owner, start,
+                            [func(d) for d in chunk_descriptors]))
+            chunk = COMM.recv(None, 0, _STEAL_REPLY_TAG)
+    if not gather:
+        return None
+    # send the results back to their owners
+    output = None
+    for owner in range(SIZE):
+        # the comprehension variables would leak and rebind the loop
+        # variables above in python 2, so they get their own names.
+        collected = COMM.gather([(chunk_start, chunk_results)
+                                 for chunk_owner, chunk_start, chunk_results
+                                 in results if chunk_owner == owner],
+                                root = owner)
+        if RANK == owner:
+            output = [None] * len(descriptors)
+            for node_results in collected:
+                for chunk_start, chunk_results in node_results:
+                    output[chunk_start:chunk_start + len(chunk_results)] = \
+                            chunk_results
+    return output
+
+
 def distribute_list(source):
     """Distributes the list from root to individual nodes
     """
@@ -241,44 +634,185 @@ def distribute_list(source):
     return data
 
 
+def _node_comms():
+    """Returns (node_comm, leader_comm, leader), where node_comm contains the
+    nodes that share memory with the current node, leader_comm contains the
+    first node of each node_comm (it is MPI.COMM_NULL on the other nodes), and
+    leader is the rank in leader_comm of the current node's leader. Returns
+    None if MPI-3 shared memory is not available. The result is cached.
+    """
+    global _NODE_COMMS
+    if _NODE_COMMS is False:
+        if MPI is None or not hasattr(MPI, 'COMM_TYPE_SHARED') or \
+                not hasattr(MPI.Win, 'Allocate_shared'):
+            _NODE_COMMS = None
+        else:
+            node_comm = COMM.Split_type(MPI.COMM_TYPE_SHARED, key = RANK)
+            if node_comm.Get_rank() == 0:
+                leader_comm = COMM.Split(0, RANK)
+                leader = leader_comm.Get_rank()
+            else:
+                leader_comm = COMM.Split(MPI.UNDEFINED, RANK)
+                leader = None
+            leader = node_comm.bcast(leader)
+            _NODE_COMMS = (node_comm, leader_comm, leader)
+    return _NODE_COMMS
+
+
+def shared_bcast(array, root = 0, key = None):
+    """Broadcasts the array from root to all nodes, keeping only one copy on
+    each machine in MPI-3 shared memory. This is meant for large read-only
+    arrays such as dictionaries and classifier weights, which would otherwise
+    be copied once per node. The returned array is read-only.
+    
+    If MPI-3 shared memory is not available, the array is broadcasted with a
+    plain Bcast into a private copy. With a single node no communication or
+    copy is needed, and a read-only view of the array is returned.
+    
+    Input:
+        array: the array on root. It is ignored on the other nodes.
+        root: (optional) the root node. Default 0.
+        key: (optional) if given, the shared memory allocated by a previous
+            call with the same key is reused when it is large enough, and the
+            arrays returned by that call should no longer be used. Otherwise,
+            the shared memory is kept until the program exits.
+    """
+    if SIZE == 1:
+        view = np.asarray(array).view()
+        view.flags.writeable = False
+        return view
+    comms = _node_comms()
+    if RANK == root:
+        array = np.ascontiguousarray(array)
+        if comms is None:
+            meta = (array.shape, array.dtype, None)
+        else:
+            meta = (array.shape, array.dtype, comms[2])
+    else:
+        meta = None
+    shape, dtype, root_leader = COMM.bcast(meta, root = root)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    if comms is None or nbytes == 0:
+        if RANK == root:
+            data = array.copy()
+        else:
+            data = np.empty(shape, dtype = dtype)
+        if nbytes > 0:
+            _bcast_bytes(data.view(np.uint8).reshape(nbytes), root, COMM)
+        data.flags.writeable = False
+        return data
+    node_comm, leader_comm, _ = comms
+    if key is not None and key in _SHARED_WINDOWS and \
+            _SHARED_WINDOWS[key][1] >= nbytes:
+        win, size = _SHARED_WINDOWS[key]
+    else:
+        if key is not None and key in _SHARED_WINDOWS:
+            _SHARED_WINDOWS.pop(key)[0].Free()
+        if node_comm.Get_rank() == 0:
+            size = nbytes
+        else:
+            size = 0
+        win = MPI.Win.Allocate_shared(size, 1, comm = node_comm)
+        size = nbytes
+        if key is None:
+            key = ('_shared_bcast', len(_SHARED_WINDOWS))
+        _SHARED_WINDOWS[key] = (win, size)
+    buf, _ = win.Shared_query(0)
+    raw = np.ndarray(buffer = buf, dtype = np.uint8, shape = (nbytes,))
+    win.Fence()
+    if RANK == root:
+        raw[:] = array.view(np.uint8).reshape(nbytes)
+    win.Fence()
+    if leader_comm != MPI.COMM_NULL and leader_comm.Get_size() > 1:
+        _bcast_bytes(raw, root_leader, leader_comm)
+    win.Fence()
+    data = raw.view(dtype).reshape(shape)
+    data.flags.writeable = False
+    return data
+
+
+def _bcast_bytes(raw, root, comm):
+    """Broadcasts a 1-dimensional uint8 buffer in chunks of at most
+    _MPI_BUFFER_LIMIT bytes to deal with the mpi4py 2GB limit.
+    """
+    for start in range(0, raw.size, _MPI_BUFFER_LIMIT):
+        comm.Bcast(raw[start:start + _MPI_BUFFER_LIMIT], root = root)
+
+
 def dump_matrix(mat, filename):
     """Dumps the matrix distributed over machines to one single file.
     
-    We do NOT recommend using this - it causes a lot of communications since
-    all data need to be transferred to root before writing to disk. Instead,
-    use dump_matrix_multi which stores the matrix to multiple chunks.
+    Root only writes the npy header with the total shape, and then every node
+    writes its own rows at their offset in the file in parallel, so the time
+    is proportional to the largest local matrix. The rows are written with
+    MPI-IO if available, and with plain file writes otherwise, in which case
+    the file system should be shared by all the nodes. If you do not need a
+    single file, dump_matrix_multi is still simpler.
     """
     if SIZE == 1:
         with open(filename,'w') as fid:
             np.save(fid, mat)
+        return
+    mat_sizes = COMM.allgather(mat.shape[0])
+    if is_root():
+        shape = mat.shape[1:]
+        dtype = mat.dtype
+        header = np.lib.format.open_memmap(
+                filename, mode = 'w+', dtype = dtype,
+                shape = (sum(mat_sizes),) + shape)
+        offset = header.offset
+        del header
     else:
-        mat_sizes = COMM.gather(mat.shape[0])
+        shape, dtype, offset = None, None, None
+    shape, dtype, offset = COMM.bcast((shape, dtype, offset))
+    # all nodes should fail together before the collective MPI.File.Open, or
+    # the others would wait there forever.
+    mismatch = mat.shape[1:] != shape or mat.dtype != dtype
+    if allreduce_scalar(mismatch) > 0:
         if is_root():
-            total_size = sum(mat_sizes)
-            mat_reduced = np.empty((total_size,) + mat.shape[1:],
-                                   dtype = mat.dtype)
-            start = mat_sizes[0]
-            mat_reduced[:start] = mat
-            for i in range(1,SIZE):
-                safe_recv_matrix(mat_reduced[start:start+mat_sizes[i]],
-                                 source = i)
-                start += mat_sizes[i]
-            with open(filename,'w') as fid:
-                np.save(fid, mat_reduced)
-        else:
-            safe_send_matrix(mat, dest = 0)
-        barrier()
+            os.remove(filename)
+        raise ValueError, "The local matrices do not have the same shape " \
+                "and dtype: %s %s vs %s %s on root." % \
+                (str(mat.shape[1:]), str(mat.dtype), str(shape), str(dtype))
+    rowbytes = dtype.itemsize * int(np.prod(shape))
+    my_offset = offset + sum(mat_sizes[:RANK]) * rowbytes
+    # write in chunks of at most _MPI_BUFFER_LIMIT bytes
+    rows_per_chunk = max(_MPI_BUFFER_LIMIT / max(rowbytes, 1), 1)
+    chunks = range(0, mat.shape[0], rows_per_chunk)
+    if MPI is not None and hasattr(MPI, 'File'):
+        fh = MPI.File.Open(_raw_comm(), filename, MPI.MODE_WRONLY)
+        try:
+            for start in chunks:
+                chunk = np.ascontiguousarray(mat[start:start+rows_per_chunk])
+                fh.Write_at(my_offset + start * rowbytes, [chunk, MPI.BYTE])
+        finally:
+            fh.Close()
+    else:
+        with open(filename, 'r+b') as fid:
+            for start in chunks:
+                fid.seek(my_offset + start * rowbytes)
+                mat[start:start+rows_per_chunk].tofile(fid)
+    barrier()
 
 
-def load_matrix(filename):
+def load_matrix(filename, mmap = False):
     """Load a matrix from a single matrix, and distribute it to each node
-    numpy supports memmap so each node will simply load its own part
+    numpy supports memmap so each node will simply load its own part. The
+    dtype of the stored matrix is kept.
+    
+    Input:
+        mmap: (optional) if True, return a read-only memory map of the local
+            part instead of reading it into memory. Default False.
     """
+    if mmap:
+        mmap_mode = 'r'
+    else:
+        mmap_mode = None
     if SIZE == 1:
         try:
-            data = np.load(filename)
+            data = np.load(filename, mmap_mode = mmap_mode)
         except IOError:
-            data = np.load(filename + '.npy')
+            data = np.load(filename + '.npy', mmap_mode = mmap_mode)
         return data
     try:
         raw_data = np.load(filename, mmap_mode = 'r')
@@ -288,8 +822,12 @@ def load_matrix(filename):
         raw_data = np.load(filename + '.npy', mmap_mode = 'r')
     total_size = raw_data.shape[0]
     segments = get_segments(total_size)
-    data = np.empty((segments[RANK+1] - segments[RANK],) + raw_data.shape[1:])
-    data[:] = raw_data[segments[RANK]:segments[RANK+1]]
+    if mmap:
+        data = raw_data[segments[RANK]:segments[RANK+1]]
+    else:
+        data = np.empty((segments[RANK+1] - segments[RANK],) + \
+                        raw_data.shape[1:], dtype = raw_data.dtype)
+        data[:] = raw_data[segments[RANK]:segments[RANK+1]]
     barrier()
     return data
 
@@ -307,38 +845,49 @@ def dump_matrix_multi(mat, filename):
     np.save(my_filename, mat)
 
 
-def load_matrix_multi(filename, N = None):
+def load_matrix_multi(filename, N = None, mmap = False, num_threads = 4):
     """Loads the matrix previously dumped by dump_matrix_multi. The MPI size 
     might be different. The stored files are in the format
-    filename-xxxxx-of-xxxxx, which we obtain using glob.
+    filename-xxxxx-of-xxxxx, which we obtain using glob. The dtype of the
+    stored matrix is kept.
     
     Input:
         N: (optional) if given, specify the number of parts the matrix is
             separated too. Otherwise, the number is automatically inferred by
             listing all the files using regexp matching.
+        mmap: (optional) if True and the local part lies inside one file,
+            return a read-only memory map of it instead of reading it into
+            memory. Default False.
+        num_threads: (optional) the number of files that are read in
+            parallel when the local part spans several files. Default 4.
     """
-    files= glob.glob('%s-?????-of-?????.npy' % (filename))
-    N = len(files)
+    if N is None:
+        files = glob.glob('%s-?????-of-?????.npy' % (filename))
+        counts = set(int(f[-9:-4]) for f in files)
+        if len(counts) == 0:
+            raise IOError, "Cannot find files %s-xxxxx-of-xxxxx.npy" % \
+                    filename
+        elif len(counts) > 1:
+            raise ValueError, "Found files with different numbers of parts "\
+                    "%s for %s. Please specify N." % (sorted(counts), filename)
+        N = counts.pop()
+    files = ['%s-%05d-of-%05d.npy' % (filename, i, N) for i in range(N)]
     logging.debug("Loading the matrix from %d parts" % N)
     # we will load the length of the data, and then try to distribute them
     # as even as possible.
     if RANK == 0:
         # the root will first taste each file
-        sizes = np.array([np.load('%s-%05d-of-%05d.npy' % (filename, i, N),
-                                  mmap_mode='r').shape[0]
-                          for i in range(N)])
-        temp = np.load('%s-%05d-of-%05d.npy' % (filename, 0, N),
-                                  mmap_mode='r')
-        shape = temp.shape[1:]
-        dtype = temp.dtype
+        temps = [np.load(f, mmap_mode='r') for f in files]
+        sizes = np.array([temp.shape[0] for temp in temps])
+        shape = temps[0].shape[1:]
+        dtype = temps[0].dtype
+        del temps
     else:
         sizes = None
         shape = None
         dtype = None
-    barrier()
-    sizes = COMM.bcast(sizes)
-    shape = COMM.bcast(shape)
-    dtype = COMM.bcast(dtype)
+    sizes = bcast_array(sizes)
+    shape, dtype = COMM.bcast((shape, dtype))
     total = sizes.sum()
     segments = get_segments(total)
     # now, each node opens the file that overlaps with its data, and reads
@@ -346,23 +895,245 @@ def load_matrix_multi(filename, N = None):
     my_start = segments[RANK]
     my_end = segments[RANK+1]
     my_size = my_end - my_start
-    mat = np.empty((my_size,) + shape, dtype = dtype)
-    mat = np.empty((my_size,) + shape)
+    # find the overlapping files as (file id, start in mat, end in mat, start
+    # in file, end in file)
+    parts = []
     f_start = 0
-    f_end = 0
     for i, size in enumerate(sizes):
-        f_end += size
+        f_end = f_start + size
         if f_start < my_end and f_end > my_start:
-            file_mat = np.load('%s-%05d-of-%05d.npy' % (filename, i, N),
-                                mmap_mode='r')
-            mat[max(f_start - my_start, 0):\
-                min(f_end - my_start, my_size)] = \
-                    file_mat[max(my_start - f_start,0):\
-                             min(my_end - f_start, size)]
-        f_start += size
+            parts.append((i, max(f_start - my_start, 0),
+                          min(f_end - my_start, my_size),
+                          max(my_start - f_start, 0),
+                          min(my_end - f_start, size)))
+        f_start = f_end
+    if mmap and len(parts) == 1:
+        i, _, _, start, end = parts[0]
+        return np.load(files[i], mmap_mode='r')[start:end]
+    mat = np.empty((my_size,) + shape, dtype = dtype)
+    def _read(part):
+        i, mat_start, mat_end, start, end = part
+        file_mat = np.load(files[i], mmap_mode='r')
+        mat[mat_start:mat_end] = file_mat[start:end]
+    if num_threads > 1 and len(parts) > 1:
+        pool = ThreadPool(min(num_threads, len(parts)))
+        try:
+            pool.map(_read, parts)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for part in parts:
+            _read(part)
     return mat
 
 
+class _Tracer(object):
+    """Collects the communication calls recorded by _TracingComm: the per
+    operation and call site statistics in a util.Profiler, where the bytes
+    are recorded in place of the allocated bytes, and a timeline of at most
+    max_events calls. The calls whose bytes are not known (nbytes is None)
+    are marked with '?' in the summary.
+    """
+    def __init__(self, max_events):
+        self.profiler = util.Profiler()
+        self.events = []
+        self.max_events = max_events
+        self._unknown = set()
+        self._lock = threading.Lock()
+
+    def record(self, op, tag, start, elapsed, nbytes, timeline = True):
+        name = '%s@%s' % (op, tag)
+        self.profiler.record(name, elapsed, allocated = nbytes or 0)
+        with self._lock:
+            if nbytes is None:
+                self._unknown.add(name)
+            if not timeline:
+                return
+            if len(self.events) < self.max_events:
+                self.events.append((op, tag, start, elapsed, nbytes,
+                                    thread.get_ident()))
+
+    def summary(self, reduce = False):
+        """Returns a human-readable table of the recorded calls.
+        """
+        stats = self.profiler.stats(reduce)
+        with self._lock:
+            unknown = list(self._unknown)
+        if reduce:
+            unknown = sum(COMM.allgather(unknown), [])
+        unknown = set(unknown)
+        lines = ['%-56s %8s %10s %10s %10s %12s' % \
+                 ('op@call site', 'calls', 'total(s)', 'p50(ms)', 'p99(ms)',
+                  'bytes(MB)')]
+        for name, stat in sorted(stats, key = lambda x: -x[1]['total']):
+            nbytes = '%.3f' % (stat['bytes'] / 1048576.)
+            if name in unknown:
+                # some of the calls pickled python objects
+                nbytes = '?' if stat['bytes'] == 0 else nbytes + '+?'
+            lines.append('%-56s %8d %10.3f %10.3f %10.3f %12s' % \
+                    (name, stat['calls'], stat['total'], stat['p50'] * 1000.,
+                     stat['p99'] * 1000., nbytes))
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        """Returns the timeline in the Chrome trace event format, which can be
+        loaded in chrome://tracing. Each node is a process.
+        """
+        with self._lock:
+            events = list(self.events)
+        return {'traceEvents':
+                [{'name': op, 'cat': tag, 'ph': 'X', 'pid': RANK, 'tid': tid,
+                  'ts': start * 1e6, 'dur': elapsed * 1e6,
+                  'args': {'bytes': nbytes, 'site': tag}}
+                 for op, tag, start, elapsed, nbytes, tid in events]}
+
+    def dump(self, prefix):
+        """Writes prefix-xxxxx.txt with the summary and prefix-xxxxx.json with
+        the timeline of the current node.
+        """
+        with open('%s-%05d.txt' % (prefix, RANK), 'w') as fid:
+            fid.write(self.summary() + '\n')
+        with open('%s-%05d.json' % (prefix, RANK), 'w') as fid:
+            json.dump(self.chrome_trace(), fid)
+
+
+def _payload_bytes(obj):
+    """Returns the number of bytes that obj takes in a message if obj is an
+    ndarray (or a buffer specification like [ndarray, datatype]), and None
+    otherwise: pickling python objects again only to count the bytes would
+    double the cost of the call.
+    """
+    if (type(obj) is list or type(obj) is tuple) and len(obj) > 0 and \
+            isinstance(obj[0], np.ndarray):
+        obj = obj[0]
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    return None
+
+
+def _call_site():
+    """Returns the call site of a communication call, as module.function of the
+    first caller outside this module, followed by the function in this module
+    that it called (if any), like 'iceberk.kmeans_mpi.kmeans/allreduce_scalar'.
+    """
+    frame = sys._getframe(2)
+    inner = None
+    while frame is not None and frame.f_globals.get('__name__') == __name__:
+        inner = frame.f_code.co_name
+        frame = frame.f_back
+    if frame is None:
+        site = '?'
+    else:
+        site = '%s.%s' % (frame.f_globals.get('__name__', '?'),
+                          frame.f_code.co_name)
+    if inner is not None:
+        site += '/' + inner
+    return site
+
+
+class _TracingComm(object):
+    """Wraps a COMM so that each call is timed and recorded by a _Tracer.
+    Everything else is forwarded to the wrapped COMM.
+    """
+    # for these calls the result is what is communicated
+    _RECEIVING = set(['recv', 'bcast', 'gather', 'allgather', 'allreduce',
+                      'scatter'])
+    # these calls are polled in busy loops (e.g. by barrier() and
+    # steal_map()), so they are only counted in the summary and are kept out
+    # of the timeline.
+    _POLLING = set(['Iprobe', 'iprobe', 'Test', 'Testall', 'Testany'])
+    # these calls pickle python objects, of which the bytes are unknown
+    _PICKLING = set(['send', 'isend', 'recv', 'irecv', 'sendrecv', 'bcast',
+                     'gather', 'allgather', 'scatter', 'reduce', 'allreduce',
+                     'alltoall'])
+
+    def __init__(self, comm, tracer):
+        self._comm = comm
+        self._tracer = tracer
+
+    def __getattr__(self, name):
+        attr = getattr(self._comm, name)
+        if not callable(attr) or name.startswith('Get_'):
+            return attr
+        tracer = self._tracer
+        receiving = name in self._RECEIVING
+        timeline = name not in self._POLLING
+        pickling = name in self._PICKLING
+        def traced(*args, **kwargs):
+            site = _call_site()
+            start = time.time()
+            result = attr(*args, **kwargs)
+            elapsed = time.time() - start
+            if receiving:
+                nbytes = _payload_bytes(result)
+            elif len(args) > 0:
+                nbytes = _payload_bytes(args[0])
+            else:
+                nbytes = 0
+            if nbytes is None and not pickling:
+                # e.g. the requests passed to Test
+                nbytes = 0
+            tracer.record(name, site, start, elapsed, nbytes, timeline)
+            return result
+        return traced
+
+
+def _raw_comm():
+    """Returns the COMM without the tracing wrapper, for the mpi4py functions
+    that need a real communicator.
+    """
+    if isinstance(COMM, _TracingComm):
+        return COMM._comm
+    else:
+        return COMM
+
+
+def enable_tracing(prefix = None, max_events = 1000000):
+    """Starts tracing the communication: every call on COMM, either in this
+    module or in others that use mpi.COMM, is recorded with its operation,
+    bytes, wall time and call site. Non-blocking calls are timed until they
+    return, and mpi.waitall() is recorded separately. Only buffers are
+    counted in the bytes: the calls that pickle python objects are marked
+    with '?' in the summary and have null bytes in the timeline. Polling
+    calls like Iprobe are counted in the summary but not in the timeline.
+    
+    Input:
+        prefix: (optional) if given, each node writes the summary to
+            prefix-xxxxx.txt and the timeline in the Chrome trace format to
+            prefix-xxxxx.json when the program exits.
+        max_events: (optional) the maximum number of calls kept in the
+            timeline. The summary covers all calls. Default 1000000.
+    """
+    global COMM, _TRACER
+    if isinstance(COMM, _TracingComm):
+        return
+    _TRACER = _Tracer(max_events)
+    COMM = _TracingComm(COMM, _TRACER)
+    if prefix is not None:
+        tracer = _TRACER
+        atexit.register(lambda: tracer.dump(prefix))
+
+
+def disable_tracing():
+    """Stops tracing the communication. The recorded calls are kept until
+    tracing is enabled again.
+    """
+    global COMM
+    if isinstance(COMM, _TracingComm):
+        COMM = COMM._comm
+
+
+def trace_summary(reduce = False):
+    """Returns a human-readable table of the traced calls, sorted by the wall
+    time. If reduce is True, the calls of all nodes are summed up, which is a
+    collective operation. Returns None if tracing was never enabled.
+    """
+    if _TRACER is None:
+        return None
+    return _TRACER.summary(reduce)
+
+
 def root_pickle(obj, filename):
     if is_root():
         pickle.dump(obj, open(filename, 'w'))
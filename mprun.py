@@ -0,0 +1,71 @@
+"""mprun runs a python script in several local processes that communicate with
+_mpi_multiprocess instead of mpi, so the mpi algorithms in iceberk can use all
+the cores of a machine without an mpi installation. Usage:
+
+    python mprun.py -n 4 script.py [args...]
+
+which is the counterpart of
+
+    mpirun -n 4 python script.py [args...]
+
+If any of the processes fails, the others are terminated.
+"""
+
+import _mpi_multiprocess
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def run(num_processes, args):
+    """Runs the command args (starting with the python script) in
+    num_processes processes, and returns the first non-zero exit code, or 0.
+    """
+    dirname = tempfile.mkdtemp(prefix = 'iceberk-mprun-')
+    processes = []
+    try:
+        for rank in range(num_processes):
+            env = dict(os.environ)
+            env[_mpi_multiprocess._ENV_RANK] = str(rank)
+            env[_mpi_multiprocess._ENV_SIZE] = str(num_processes)
+            env[_mpi_multiprocess._ENV_DIR] = dirname
+            processes.append(subprocess.Popen([sys.executable] + args,
+                                              env = env))
+        returncode = 0
+        running = list(processes)
+        while len(running) > 0:
+            for p in list(running):
+                if p.poll() is not None:
+                    running.remove(p)
+                    if p.returncode != 0 and returncode == 0:
+                        returncode = p.returncode
+                        # the others would wait for the failed process
+                        for q in running:
+                            q.terminate()
+            time.sleep(0.1)
+        return returncode
+    finally:
+        for p in processes:
+            if p.poll() is None:
+                p.kill()
+        shutil.rmtree(dirname, ignore_errors = True)
+
+
+def main():
+    parser = optparse.OptionParser(
+            usage = "%prog [-n NUM_PROCESSES] script.py [args...]")
+    parser.disable_interspersed_args()
+    parser.add_option('-n', '--np', dest = 'num_processes', type = 'int',
+                      default = 1, help = "the number of processes")
+    options, args = parser.parse_args()
+    if len(args) == 0:
+        parser.error("Please specify the script to run.")
+    return run(options.num_processes, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
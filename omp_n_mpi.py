@@ -98,8 +98,8 @@ def omp_n(X, k, num_active, max_iter=100, tol=1e-4):
     # vdata is used for testing convergence
     Nlocal = X.shape[0]
     vdatalocal = np.sum(np.var(X, 0))
-    N = mpi.COMM.allreduce(Nlocal)
-    vdata = mpi.COMM.allreduce(vdatalocal)
+    N = mpi.allreduce_scalar(Nlocal)
+    vdata = mpi.allreduce_scalar(vdatalocal)
     vdata /= N
     # random initialization
     centroids = np.random.randn(k, X.shape[1])
@@ -123,8 +123,8 @@ def omp_n(X, k, num_active, max_iter=100, tol=1e-4):
         if mpi.is_root():
             converged = np.sum((centroids_old - centroids) ** 2) < tol * vdata
         else:
-            converged = None
-        converged = mpi.COMM.bcast(converged)
+            converged = False
+        converged = mpi.bcast_scalar(converged)
         if converged:
             logging.debug("OMP has converged.")
             break
@@ -3,16 +3,26 @@
 In this program we will represent any general "image" with a width * height * 
 nchannels numpy matrix of np.float64, , which is always preserved as a
 contiguous array in C-order so we can more efficiently solve most of the
-problems.
+problems. Alternatively, a ConvLayer could be set to run in np.float32 (see
+ConvLayer.set_dtype()), in which case the images are np.float32 matrices.
 """
 from iceberk import cpputil, mathutil, mpi, util
 from iceberk import kmeans_mpi, omp_mpi, omp_n_mpi
 from iceberk import datasets
+import glob
+import hashlib
+import itertools
 import logging
 from mathutil import CHECK_IMAGE, CHECK_SHAPE
+from multiprocessing.pool import ThreadPool
 import numpy as np
+import os
 from PIL import Image
 from sklearn import metrics
+import shutil
+import tempfile
+import threading
+import time
 
 # we try to import bottleneck: this helps computing the nearest neighbors in 
 # LLC faster. Otherwise, we will simply use np.argsort.
@@ -22,6 +32,60 @@ except ImportError:
     logging.warning('Cannot find bottleneck, using numpy as backup.')
     bn = None
 
+# the size of a block of patches in the fused patch extraction, in bytes. It
+# should be small enough for a block and its encoding to stay in cache.
+_FUSION_BLOCK_BYTES = 1 << 18
+
+
+def _float_dtype(image):
+    """Returns the dtype to carry out the computation for the image: float32
+    images are kept in float32, and everything else is computed in float64.
+    """
+    if image.dtype == np.float32:
+        return np.float32
+    else:
+        return np.float64
+
+
+def _astype(obj, dtype):
+    """Casts the floating point ndarrays in obj (an ndarray, or a tuple or list
+    of them) to the given dtype. Other objects are returned untouched.
+    """
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.kind == 'f' and obj.dtype != dtype:
+            return obj.astype(dtype)
+        return obj
+    elif type(obj) is tuple or type(obj) is list:
+        return type(obj)(_astype(o, dtype) for o in obj)
+    else:
+        return obj
+
+
+def _hash_params(md5, obj):
+    """Updates md5 with the parameters in obj: ndarrays, python values and
+    the public attributes of objects such as components and trainers.
+    """
+    if isinstance(obj, np.ndarray):
+        md5.update('%s %s' % (obj.dtype.str, str(obj.shape)))
+        md5.update(np.ascontiguousarray(obj).data)
+    elif type(obj) is tuple or type(obj) is list:
+        md5.update('%s %d' % (type(obj).__name__, len(obj)))
+        for o in obj:
+            _hash_params(md5, o)
+    elif type(obj) is dict:
+        md5.update('dict %d' % len(obj))
+        for key in sorted(obj):
+            md5.update(repr(key))
+            _hash_params(md5, obj[key])
+    elif hasattr(obj, '__dict__') and not isinstance(obj, type):
+        md5.update(obj.__class__.__name__)
+        _hash_params(md5, dict((key, value) for key, value
+                               in obj.__dict__.iteritems()
+                               if not key.startswith('_')))
+    else:
+        md5.update(repr(obj))
+
+
 class Component(object):
     """ The common interface to process an input image
     
@@ -49,6 +113,19 @@ class Component(object):
         """
         raise NotImplementedError
 
+    def output_shape(self, input_shape):
+        """ The interface that infers the shape of the output of process()
+        from the shape of its input, without processing anything.
+        
+        Input:
+            input_shape: the shape of the input as a tuple.
+        Output:
+            output_shape: the shape of the output as a tuple.
+        Raises:
+            ValueError, if the input shape is not valid for the component.
+        """
+        raise NotImplementedError
+
     def train(self, patches):
         """ The interface that trains the component.
         
@@ -59,31 +136,78 @@ class Component(object):
         """
         raise NotImplementedError
 
+    def set_dtype(self, dtype):
+        """ Casts the trained parameters of the component (if any) to dtype, so
+        that they do not need to be converted at every process() call.
+        """
+        pass
+
 class ConvLayer(list):
     """ ConvLayer is one big layer in the convolutional pipeline.
     
     It starts with a patch extractor, followed by several feature processing
     components, and ends with a spatial pooler.
     """
+    # the default dtype, also used by layers pickled before dtype existed.
+    _dtype = np.float64
+    # the util.Profiler that times the components, if profiling is enabled.
+    _profiler = None
+    # whether the patch extractor is fused with the components after it.
+    _fuse = True
+    
     def __init__(self, *args, **kwargs):
         """Initialize a convolutional layer.
         Optional keyword parameters:
             prev: the previous convolutional layer. Default None.
             fixed_size: if set True, we assume that all input images have
                 fixed shape - in this case we will have efficient buffer.
+            dtype: np.float64 or np.float32, the dtype the layer computes in.
+                Default np.float64. See set_dtype() for details.
+            fuse: if True, a PatchExtractor followed by normalizers and
+                encoders is run block by block (see _process_fused()), so
+                the full patch matrix is never materialized. Default True.
         """
         self._previous_layer = kwargs.pop('prev', None)
         self._fixed_size = kwargs.pop('fixed_size', False)
+        self._fuse = kwargs.pop('fuse', True)
+        dtype = kwargs.pop('dtype', np.float64)
         super(ConvLayer, self).__init__(*args, **kwargs)
+        self.set_dtype(dtype, recursive = False)
+    
+    def set_dtype(self, dtype, recursive = True):
+        """Sets the dtype of the layer. With np.float32, the images, the
+        intermediate outputs, the C pooling and im2col kernels and the output of
+        process_dataset() are all single precision, which halves the memory
+        and the gemm time. Training is still carried out in double precision:
+        the trained parameters are cast once after training, or when
+        set_dtype() is called (e.g. after loading a pickled layer).
+        
+        Input:
+            dtype: np.float64 or np.float32.
+            recursive: if True, also set the dtype of the previous layers.
+                Default True.
+        """
+        dtype = np.dtype(dtype)
+        if dtype != np.float64 and dtype != np.float32:
+            raise ValueError, "Unsupported dtype: %s" % repr(dtype)
+        self._dtype = dtype.type
+        for component in self:
+            component.set_dtype(self._dtype)
+        if recursive and self._previous_layer is not None:
+            self._previous_layer.set_dtype(dtype)
         
     def train(self, dataset, num_patches,
-              exhaustive = False, ratio_per_image = 0.1):
+              exhaustive = False, ratio_per_image = 0.1, cache = None):
         """ train the convolutional layer
         
         Note that we do not train the first element (patch extractor),
         and stop when we see the spatial pooler. There might be some post
         processing components after the pooler, but they should not require
         any training (if they do, you may want to move them to the next layer
+        
+        If a LayerOutputCache is given, the outputs of the previous layers are
+        taken from (and stored in) the cache, and the cached outputs of this
+        layer and the layers on top of it are invalidated after training.
         """
         if len(self) == 0:
             return
@@ -92,7 +216,9 @@ class ConvLayer(list):
             raise ValueError, \
                   "The first component should be a patch extractor!"
         patches = self[0].sample(dataset, num_patches, self._previous_layer,
-                                 exhaustive, ratio_per_image)
+                                 exhaustive, ratio_per_image, cache = cache)
+        if cache is not None:
+            cache.invalidate(self)
         if len(self) == 1 or isinstance(self[1], Pooler):
             logging.debug('Nothing to be trained in this layer.')
             return
@@ -108,28 +234,413 @@ class ConvLayer(list):
             else:
                 # prepare the next component's input
                 patches = component.process(patches)
+        # cast the trained parameters to the dtype we compute in
+        for component in self:
+            component.set_dtype(self._dtype)
         logging.debug("Training convolutional layer done.")
         
-    def process(self, image, as_vector = False, convbuffer = None):
-        output = image
+    def enable_profiling(self, profiler = None):
+        """Starts to time the components of this layer and its previous layers
+        in every call to process() or process_batch(). Profiling is off by
+        default and costs nothing then.
+        
+        Input:
+            profiler: (optional) the util.Profiler to record to. If None, a
+                new one is created.
+        Output:
+            profiler: the profiler. Use profiler.report() to get a summary
+                reduced over all the MPI nodes.
+        """
+        if profiler is None:
+            profiler = util.Profiler()
+        self._profiler = profiler
+        if self._previous_layer is not None:
+            self._previous_layer.enable_profiling(profiler)
+        return profiler
+    
+    def disable_profiling(self):
+        """Stops profiling this layer and its previous layers.
+        """
+        self._profiler = None
+        if self._previous_layer is not None:
+            self._previous_layer.disable_profiling()
+    
+    def _process_element(self, index, image, out = None):
+        """Runs self[index] on image, recording its statistics if profiling is
+        enabled.
+        """
+        element = self[index]
+        if self._profiler is None:
+            if out is None:
+                return element.process(image)
+            return element.process(image, out = out)
+        start = time.time()
+        if out is None:
+            output = element.process(image)
+        else:
+            output = element.process(image, out = out)
+        elapsed = time.time() - start
+        depth = 0
+        layer = self._previous_layer
+        while layer is not None:
+            depth += 1
+            layer = layer._previous_layer
+        if output is out or output is image:
+            allocated = 0
+        else:
+            allocated = output.nbytes
+        self._profiler.record('layer%d/%d:%s' % \
+                                  (depth, index, element.__class__.__name__),
+                              elapsed, image, output, allocated)
+        return output
+    
+    def _arena_out(self, arena, index, image):
+        """Returns an output buffer for self[index] from the arena, or None if
+        the output shape cannot be inferred. Extractors and the components
+        that only work along the last axis (normalizers and encoders) get
+        buffers; poolers allocate their (small) outputs themselves.
+        """
+        element = self[index]
+        key = (id(self), index)
+        if isinstance(element, PatchExtractor):
+            if image.ndim == 2:
+                num_channels = 1
+            else:
+                num_channels = image.shape[2]
+            shape = ((image.shape[0] - element.psize[0]) / element.stride + 1,
+                     (image.shape[1] - element.psize[1]) / element.stride + 1,
+                     element.psize[0] * element.psize[1] * num_channels)
+            if shape[0] <= 0 or shape[1] <= 0:
+                # let the extractor raise the error
+                return None
+            return arena.get(key, shape, _float_dtype(image))
+        elif isinstance(element, (Normalizer, FeatureEncoder)):
+            # the output dimension is learned from the previous image
+            last = arena.last(key)
+            if last is None:
+                return None
+            return arena.get(key, image.shape[:-1] + last[0][-1:], last[1])
+        else:
+            return None
+    
+    def process(self, image, as_vector = False, convbuffer = None,
+                arena = None):
+        """Processes an image.
+        
+        Input:
+            image: the input image.
+            as_vector: if True, flatten the output to a vector.
+            convbuffer: a list of len(self) + 1 buffers that are reused over
+                images of the same shape (see fixed_size in __init__).
+            arena: a mathutil.BufferArena that provides the intermediate
+                outputs, which could be reused over images of different
+                shapes. Ignored if convbuffer is given.
+        """
         if self._previous_layer is not None:
-            output = self._previous_layer.process(image)
-        if convbuffer is not None:
+            image = self._previous_layer.process(image, arena = arena)
+        return self._process_local(image, as_vector, convbuffer, arena)
+    
+    def output(self, dataset, idx, cache = None):
+        """Returns the output of the layer on the image idx of the dataset.
+        
+        If a LayerOutputCache is given, the output is taken from the cache if
+        possible, and is stored in it otherwise. The same holds for the
+        outputs of the previous layers, so each image goes through each layer
+        at most once. Cached outputs are read-only.
+        """
+        if cache is not None:
+            output = cache.get(self, dataset, idx)
+            if output is not None:
+                return output
+        output = self._process_local(self._input(dataset, idx, cache))
+        if cache is not None:
+            output = cache.put(self, dataset, idx, output)
+        return output
+    
+    def _input(self, dataset, idx, cache = None, arena = None):
+        """Returns the input of this layer for the image idx of the dataset,
+        i.e. the output of the previous layer (possibly from the cache).
+        """
+        if self._previous_layer is None:
+            return dataset.image(idx)
+        elif cache is None:
+            return self._previous_layer.process(dataset.image(idx),
+                                                arena = arena)
+        else:
+            return self._previous_layer.output(dataset, idx, cache)
+    
+    def _process_local(self, image, as_vector = False, convbuffer = None,
+                       arena = None, out = None):
+        """Processes the output of the previous layer with the components of
+        this layer only. See process() for the arguments. If out is given, the
+        output is written into it (with the shape of out) and out is returned;
+        with a planned convbuffer (see plan()) the last component then writes
+        into out directly.
+        """
+        output = np.asarray(image, dtype = self._dtype)
+        fused = self._fused_length()
+        if convbuffer is None and arena is not None:
+            if fused > 0:
+                output = self._process_fused(output, fused, arena)
+            for i in range(fused, len(self)):
+                buf = self._arena_out(arena, i, output)
+                result = self._process_element(i, output, out = buf)
+                if buf is None and not isinstance(self[i], Pooler) and \
+                        not np.may_share_memory(result, output):
+                    arena.adopt((id(self), i), result)
+                output = result
+            if len(self) > 0 and not isinstance(self[-1], Pooler) and \
+                    out is None:
+                # the output lives in the arena, so we return a copy
+                output = output.copy()
+        elif convbuffer is not None:
             convbuffer[0] = output
-            for i, element in enumerate(self):
-                # provide buffer
-                convbuffer[i+1] = element.process(convbuffer[i],
-                                                    out = convbuffer[i+1])
-            # in the end we produce a copy of the output
-            output = convbuffer[-1].copy()
-        else:
-            for element in self:
-                output = element.process(output)
+            last = convbuffer[-1]
+            direct = out is not None and last is not None and \
+                    len(self) > 0 and out.size == last.size and \
+                    out.dtype == last.dtype
+            if direct:
+                convbuffer[-1] = out.reshape(last.shape)
+            try:
+                if fused > 0:
+                    convbuffer[fused] = self._process_fused(
+                            output, fused, arena, out = convbuffer[fused])
+                for i in range(fused, len(self)):
+                    # provide buffer
+                    convbuffer[i+1] = self._process_element(
+                            i, convbuffer[i], out = convbuffer[i+1])
+                output = convbuffer[-1]
+            finally:
+                if direct:
+                    convbuffer[-1] = last
+            if direct and np.may_share_memory(output, out):
+                return out
+            elif out is None:
+                # in the end we produce a copy of the output
+                output = output.copy()
+        else:
+            if fused > 0:
+                output = self._process_fused(output, fused)
+            for i in range(fused, len(self)):
+                output = self._process_element(i, output)
+        if out is not None:
+            out[...] = output.reshape(out.shape)
+            return out
         if as_vector:
             output.resize(np.prod(output.shape))
         return output
     
-    def process_dataset(self, dataset, as_list = False, as_2d = False):
+    def output_shape(self, input_shape):
+        """Returns the shape of the output of process() for an image of shape
+        input_shape, without processing anything.
+        
+        Raises:
+            ValueError, if the components are not compatible with the input.
+            NotImplementedError, if a component cannot infer its output shape.
+        """
+        if self._previous_layer is not None:
+            input_shape = self._previous_layer.output_shape(input_shape)
+        return self._shapes(input_shape)[-1]
+    
+    def _shapes(self, input_shape):
+        """Returns the shapes of the input and the outputs of the components of
+        this layer, given the shape of the output of the previous layer.
+        """
+        shapes = [tuple(int(s) for s in input_shape)]
+        for element in self:
+            shapes.append(tuple(int(s)
+                                for s in element.output_shape(shapes[-1])))
+        return shapes
+    
+    def plan(self, input_shape):
+        """Plans the processing of images of shape input_shape: validates the
+        chain of components, precomputes the shape of every intermediate
+        output, and allocates one workspace for all of them. The workspace has
+        two slabs, and each component reads from one slab and writes into the
+        other, so processing an image does not allocate anything.
+        
+        Input:
+            input_shape: the shape of the images passed to process().
+        Output:
+            convbuffer: the buffers to pass to process() as convbuffer. They
+                are not thread-safe: each thread should have its own plan.
+        Raises:
+            see output_shape().
+        """
+        if self._previous_layer is not None:
+            input_shape = self._previous_layer.output_shape(input_shape)
+        return self._plan(self._shapes(input_shape))
+    
+    def _plan(self, shapes):
+        """Allocates the workspace for the shapes returned by _shapes().
+        """
+        sizes = [int(np.prod(shape)) for shape in shapes[1:]]
+        slabs = [np.empty(max(sizes[0::2] + [0]), dtype = self._dtype),
+                 np.empty(max(sizes[1::2] + [0]), dtype = self._dtype)]
+        convbuffer = [None]
+        for i, shape in enumerate(shapes[1:]):
+            convbuffer.append(slabs[i % 2][:sizes[i]].reshape(shape))
+        return convbuffer
+    
+    def _dataset_shapes(self, dataset):
+        """Returns the _shapes() of the images of the dataset if they all have
+        the same shape (see dataset.dim()) and the shapes could be inferred,
+        and None otherwise.
+        """
+        dim = dataset.dim()
+        if dim is None or dim is False:
+            return None
+        input_shape = tuple(int(d) for d in dim)
+        if len(input_shape) == 2 and dataset.num_channels() > 1:
+            input_shape += (dataset.num_channels(),)
+        try:
+            if self._previous_layer is not None:
+                input_shape = self._previous_layer.output_shape(input_shape)
+            return self._shapes(input_shape)
+        except NotImplementedError:
+            return None
+    
+    def _fused_length(self):
+        """Returns the number of leading components that are run fused by
+        _process_fused(): a PatchExtractor followed by the normalizers and
+        encoders after it, which all work on each patch independently. Returns
+        0 if fusion does not apply. Fusion is disabled while profiling, since
+        the components are then timed one by one.
+        """
+        if not self._fuse or self._profiler is not None or len(self) < 2 \
+                or not isinstance(self[0], PatchExtractor):
+            return 0
+        end = 1
+        while end < len(self) and \
+                isinstance(self[end], (Normalizer, FeatureEncoder)):
+            end += 1
+        if end == 1:
+            return 0
+        return end
+    
+    def _process_fused(self, image, end, arena = None, out = None):
+        """Runs self[:end] (see _fused_length()) on blocks of patch rows, so
+        that the full output of the patch extractor and of the intermediate
+        components is never materialized: each block of patches is extracted,
+        normalized and encoded while it is still in cache, and the last
+        component writes its output for the block directly into out.
+        
+        Input:
+            image: the input image.
+            end: the number of fused components.
+            arena: (optional) a mathutil.BufferArena for the block buffers and
+                the output. If None, a temporary one is used.
+            out: (optional) the buffer for the output of self[end-1].
+        """
+        extractor = self[0]
+        psize = extractor.psize
+        stride = extractor.stride
+        if image.shape[0] < psize[0] or image.shape[1] < psize[1]:
+            raise ValueError, "No patch can be extracted."
+        num_rows = (image.shape[0] - psize[0]) / stride + 1
+        num_cols = (image.shape[1] - psize[1]) / stride + 1
+        if image.ndim == 2:
+            num_channels = 1
+        else:
+            num_channels = image.shape[2]
+        row_bytes = num_cols * psize[0] * psize[1] * num_channels * \
+                image.dtype.itemsize
+        block = max(_FUSION_BLOCK_BYTES / row_bytes, 1)
+        if arena is None:
+            out_arena = None
+            arena = mathutil.BufferArena()
+        else:
+            out_arena = arena
+        for start in range(0, num_rows, block):
+            stop = min(start + block, num_rows)
+            output = image[start * stride:(stop - 1) * stride + psize[0]]
+            for i in range(end):
+                if i == end - 1 and out is not None:
+                    buf = out[start:stop]
+                else:
+                    buf = self._arena_out(arena, i, output)
+                result = self._process_element(i, output, out = buf)
+                if i == end - 1 and out is not None and result is not buf:
+                    # the component did not honor out, e.g. a user subclass
+                    # whose process() returns a new array.
+                    buf[...] = result
+                    result = buf
+                elif buf is None and not np.may_share_memory(result, output):
+                    arena.adopt((id(self), i), result)
+                output = result
+            if out is None:
+                # now that we know the output dimension, allocate the output
+                shape = (num_rows,) + output.shape[1:]
+                if out_arena is None:
+                    out = np.empty(shape, dtype = output.dtype)
+                else:
+                    out = out_arena.get((id(self), 'fused'), shape,
+                                        output.dtype)
+                out[start:stop] = output
+        return out
+    
+    def process_batch(self, images, as_vector = False):
+        """Processes a batch of images that have the same shape.
+        
+        The extracted patches of all the images are stacked into one array, so
+        that every component between the extractor and the first pooler runs
+        only once for the whole batch (e.g. one large gemm instead of one
+        small gemm per image). The pooler and the components after it are then
+        carried out image by image.
+        
+        Input:
+            images: a list of images, all of which should have the same shape.
+            as_vector: if True, the output of each image is flattened to a
+                vector. Default False.
+        Output:
+            output: an ndarray whose first axis corresponds to the images.
+        """
+        if len(images) == 0:
+            raise ValueError, "The batch should contain at least one image."
+        if self._previous_layer is not None:
+            images = [self._previous_layer.process(image) for image in images]
+        return self._process_batch_local(images, as_vector)
+    
+    def _process_batch_local(self, images, as_vector = False):
+        """Processes a batch of outputs of the previous layer with the
+        components of this layer only. See process_batch() for the arguments.
+        """
+        images = [np.asarray(image, dtype = self._dtype) for image in images]
+        if len(self) == 0 or not isinstance(self[0], Extractor):
+            # nothing could be stacked, so we simply process them one by one
+            return np.array([self._process_local(image, as_vector = as_vector)
+                             for image in images])
+        # find the components that only work along the last axis
+        end = 1
+        while end < len(self) and not isinstance(self[end], Pooler):
+            end += 1
+        first = self._process_element(0, images[0])
+        batch = np.empty((len(images),) + first.shape, dtype = first.dtype)
+        batch[0] = first
+        for i in range(1, len(images)):
+            if images[i].shape != images[0].shape:
+                raise ValueError, \
+                        "All images in a batch should have the same shape."
+            self._process_element(0, images[i], out = batch[i])
+        for j in range(1, end):
+            batch = self._process_element(j, batch)
+        output = None
+        for i in range(len(images)):
+            feat = batch[i]
+            for j in range(end, len(self)):
+                feat = self._process_element(j, feat)
+            if as_vector:
+                feat = feat.ravel()
+            if output is None:
+                output = np.empty((len(images),) + feat.shape,
+                                  dtype = feat.dtype)
+            output[i] = feat
+        return output
+    
+    def process_dataset(self, dataset, as_list = False, as_2d = False,
+                        batch_size = None, num_workers = 1, cache = None,
+                        checkpoint = None, checkpoint_every = 1024,
+                        steal = False):
         """Processes a whole dataset and returns an numpy ndarray
         
         Input:
@@ -138,46 +649,538 @@ class ConvLayer(list):
                 different sizes for each image. Default False.
             as_2d: if True, return a matrix where each image corresponds to a
                 row in the matrix. Default False.
+            batch_size: if given, images are processed batch_size at a time
+                using process_batch(). All the images should then have the
+                same shape. The features agree with the ones of processing
+                one image at a time up to floating point rounding, as the
+                larger gemm may sum in a different order. Default None (one
+                image at a time).
+            num_workers: the number of threads that process the local images.
+                Each thread keeps its own buffers and writes its results
+                directly into the output, so dataset.image() should be safe to
+                call from multiple threads. Default 1.
+            cache: if given, a LayerOutputCache that provides the outputs of
+                the previous layers. Default None.
+            checkpoint: if given, a directory where the outputs are saved
+                every checkpoint_every images. If the directory contains the
+                outputs of a previous (e.g. failed) run, they are restored and
+                only the missing images are processed. The outputs are saved
+                by global image index, so the previous run could have used a
+                different number of MPI nodes. Not supported with as_list.
+                Default None.
+            checkpoint_every: the number of images between two checkpoints.
+                Default 1024.
+            steal: if True, the images are shared over the nodes with
+                mpi.steal_map(), so nodes that finish their own images early
+                process the remaining images of the others. This helps when
+                the images have very different sizes. The dataset should
+                support descriptors (see ImageSet.has_descriptors()). Not
+                supported with batch_size, num_workers, cache or checkpoint.
+                Default False.
         """
-        # check if we want to use buffer
-        if self._fixed_size:
-            convbuffer = [None] * (len(self) + 1)
-        else:
-            convbuffer = None
+        if as_list and checkpoint is not None:
+            raise ValueError, "Checkpointing does not support as_list."
+        if steal and (batch_size is not None or num_workers > 1 or
+                      cache is not None or checkpoint is not None):
+            raise ValueError, "Work stealing does not support batch_size, "\
+                    "num_workers, cache or checkpoint."
         total = dataset.size_total()
         logging.debug("Processing a total of %s images" % (total,))
         timer = util.Timer()
+        if steal:
+            data = self._process_stealing(dataset, as_list, as_2d)
+            logging.debug("Feature extration took %s" % timer.total())
+            return data
+        size = dataset.size()
+        shapes = None
         if as_list:
-            data = [self.process(dataset.image(i), convbuffer = convbuffer) \
-                    for i in range(dataset.size())]
+            data = [None] * size
+            start = 0
         else:
+            shapes = self._dataset_shapes(dataset)
+        if shapes is not None:
+            # the images have a fixed shape, so we know the output shape
+            # without processing any image
+            data = np.empty((size,) + self._planned_shape(shapes, as_2d),
+                            dtype = self._dtype)
+            logging.debug("Output feature shape: %s" % (str(data.shape[1:])))
+            start = 0
+        elif not as_list:
             # we assume that each image leads to the same feature size
-            temp = self.process(dataset.image(0), as_vector = as_2d)
+            temp = self._process_local(self._input(dataset, 0, cache),
+                                       as_vector = as_2d)
             logging.debug("Output feature shape: %s" % (str(temp.shape)))
-            data = np.empty((dataset.size(),) + temp.shape)
+            data = np.empty((size,) + temp.shape, dtype = temp.dtype)
             data[0] = temp
-            size = dataset.size()
-            timer = util.Timer()
-            for i in range(1,size):
-                data[i] = self.process(dataset.image(i), as_vector = as_2d,
-                                       convbuffer = convbuffer)
-                # report local progress
-                if (i * 10 / size) != ((i-1) * 10 / size):
-                    logging.debug("rank %d: %d percent. elapsed %s" % \
-                            (mpi.RANK, i*100 / size, timer.total()))
+            start = 1
+        if batch_size is not None:
+            batch_size = max(int(batch_size), 1)
+        if checkpoint is None:
+            self._process_range(dataset, data, start, size, as_list, as_2d,
+                                batch_size, num_workers, timer, cache, shapes)
+        else:
+            self._process_checkpointed(dataset, data, start, as_2d,
+                                       batch_size, num_workers, cache, shapes,
+                                       checkpoint, checkpoint_every, timer)
         mpi.barrier()
         logging.debug("Feature extration took %s" % timer.total())
         return data
     
+    def _process_stealing(self, dataset, as_list, as_2d):
+        """Processes the dataset with mpi.steal_map(). See process_dataset().
+        """
+        if not dataset.has_descriptors():
+            raise ValueError, "Work stealing needs a dataset that supports "\
+                    "descriptors."
+        descriptors = [dataset.descriptor(i) for i in range(dataset.size())]
+        results = mpi.steal_map(
+                lambda d: self.process(dataset.image_from_descriptor(d),
+                                       as_vector = as_2d),
+                descriptors)
+        if as_list:
+            return results
+        shapes = self._dataset_shapes(dataset)
+        if shapes is not None:
+            shape = self._planned_shape(shapes, as_2d)
+            dtype = self._dtype
+        else:
+            shape = results[0].shape
+            dtype = results[0].dtype
+        data = np.empty((len(results),) + shape, dtype = dtype)
+        for i, result in enumerate(results):
+            data[i] = result
+        return data
+    
+    def process_dataset_to_file(self, dataset, filename, as_2d = False,
+                                chunk_size = 1024, batch_size = None,
+                                num_workers = 1, cache = None):
+        """Processes a whole dataset and writes the features to disk, without
+        holding all of them in memory. Each node writes its local features to
+        the memory-mapped file filename-xxxxx-of-xxxxx.npy, the same format
+        as mpi.dump_matrix_multi(), so the result could be loaded with
+        mpi.load_matrix_multi() or read with mathutil.FileSampler.
+        
+        Any shards filename-xxxxx-of-xxxxx.npy written before with a different
+        number of nodes are removed, and the ones with the same number are
+        overwritten.
+        
+        Input:
+            dataset: the input dataset.
+            filename: the prefix of the output files.
+            as_2d: if True, store a matrix where each image corresponds to a
+                row in the matrix. Default False.
+            chunk_size: the number of images processed before the features are
+                flushed to disk, which bounds the memory used by the features.
+                Default 1024.
+            batch_size, num_workers, cache: see process_dataset().
+        Output:
+            shape: the shape of the local feature matrix.
+        """
+        if mpi.SIZE > 99999:
+            raise ValueError, 'I cannot deal with too many MPI instances.'
+        total = dataset.size_total()
+        logging.debug("Processing a total of %s images to %s" % \
+                (total, filename))
+        timer = util.Timer()
+        size = dataset.size()
+        shapes = self._dataset_shapes(dataset)
+        if shapes is not None:
+            temp = None
+            shape = self._planned_shape(shapes, as_2d)
+            dtype = self._dtype
+            first = 0
+        else:
+            # we assume that each image leads to the same feature size
+            temp = self._process_local(self._input(dataset, 0, cache),
+                                       as_vector = as_2d)
+            shape = temp.shape
+            dtype = temp.dtype
+            first = 1
+        logging.debug("Output feature shape: %s" % (str(shape)))
+        mpi.mkdir(os.path.dirname(filename))
+        if mpi.is_root():
+            # remove the shards left by a run with a different number of
+            # nodes, which would make mpi.load_matrix_multi() ambiguous.
+            for f in glob.glob('%s-?????-of-?????.npy' % filename):
+                if int(f[-9:-4]) != mpi.SIZE:
+                    os.remove(f)
+        mpi.barrier()
+        my_filename = '%s-%05d-of-%05d.npy' % (filename, mpi.RANK, mpi.SIZE)
+        data = np.lib.format.open_memmap(my_filename, mode = 'w+',
+                                         dtype = dtype,
+                                         shape = (size,) + shape)
+        if temp is not None:
+            data[0] = temp
+        if batch_size is not None:
+            batch_size = max(int(batch_size), 1)
+        chunk_size = max(int(chunk_size), 1)
+        for start in range(first, size, chunk_size):
+            end = min(start + chunk_size, size)
+            self._process_range(dataset, data, start, end, False, as_2d,
+                                batch_size, num_workers, cache = cache,
+                                shapes = shapes)
+            data.flush()
+            logging.debug("rank %d: %d of %d images written. elapsed %s" % \
+                    (mpi.RANK, end, size, timer.total()))
+        data.flush()
+        shape = data.shape
+        del data
+        mpi.barrier()
+        logging.debug("Feature extration took %s" % timer.total())
+        return shape
+    
+    def _process_checkpointed(self, dataset, data, first, as_2d, batch_size,
+                              num_workers, cache, shapes, checkpoint,
+                              checkpoint_every, timer):
+        """Processes the local images like _process_range(), but restores the
+        outputs saved in the checkpoint directory by a previous run, and saves
+        the new outputs every checkpoint_every images. first is the first
+        local image that has not been processed yet (1 after a warm-up).
+        
+        Each saved chunk is a file chunk-<start>-<end>.npy that holds the
+        outputs of the images start to end-1 in global order. It is written
+        to a temporary name and then renamed, so a failure never leaves a
+        partial chunk behind.
+        
+        The checkpoint directory also holds a fingerprint of the run (see
+        _checkpoint_fingerprint()), written when the directory is first used.
+        We refuse to resume from a directory whose fingerprint differs, as its
+        chunks were computed by a different layer or on a different dataset.
+        """
+        size = data.shape[0]
+        # the local images are a contiguous segment of the whole dataset
+        offset = sum(mpi.COMM.allgather(size)[:mpi.RANK])
+        mpi.mkdir(checkpoint)
+        # size_total() is a collective, so all nodes call it here and only
+        # root uses it.
+        total = dataset.size_total()
+        if mpi.is_root():
+            fingerprint = self._checkpoint_fingerprint(dataset, data, total)
+            error = None
+            fname = os.path.join(checkpoint, 'fingerprint.txt')
+            if os.path.exists(fname):
+                with open(fname) as fid:
+                    if fid.read() != fingerprint:
+                        error = "The checkpoint %s was written by a " \
+                                "different layer or for a different " \
+                                "dataset." % checkpoint
+            else:
+                with open(fname, 'w') as fid:
+                    fid.write(fingerprint)
+        else:
+            error = None
+        error = mpi.COMM.bcast(error)
+        if error is not None:
+            raise ValueError, error
+        saved = np.zeros(size, dtype = bool)
+        for fname in glob.glob(os.path.join(checkpoint,
+                                            'chunk-*-*.npy')):
+            try:
+                chunk_start, chunk_end = \
+                        [int(s) for s in os.path.basename(fname)[6:-4].\
+                                split('-')]
+            except ValueError:
+                continue
+            start = max(chunk_start, offset)
+            end = min(chunk_end, offset + size)
+            if start >= end:
+                continue
+            chunk = np.load(fname, mmap_mode='r')
+            if chunk.shape != (chunk_end - chunk_start,) + data.shape[1:]:
+                logging.warning("Ignoring checkpoint %s of shape %s." % \
+                                (fname, str(chunk.shape)))
+                continue
+            data[start - offset:end - offset] = \
+                    chunk[start - chunk_start:end - chunk_start]
+            saved[start - offset:end - offset] = True
+            del chunk
+        logging.debug("rank %d: %d of %d images restored from %s" % \
+                      (mpi.RANK, saved.sum(), size, checkpoint))
+        checkpoint_every = max(int(checkpoint_every), 1)
+        i = 0
+        while i < size:
+            if saved[i]:
+                i += 1
+                continue
+            # find the next run of missing images, up to checkpoint_every
+            j = i + 1
+            while j < size and j - i < checkpoint_every and not saved[j]:
+                j += 1
+            self._process_range(dataset, data, max(i, first), j, False, as_2d,
+                                batch_size, num_workers, cache = cache,
+                                shapes = shapes)
+            name = 'chunk-%010d-%010d.npy' % (offset + i, offset + j)
+            temp = os.path.join(checkpoint, '.%s-%05d.tmp.npy' % \
+                                (name[:-4], mpi.RANK))
+            np.save(temp, data[i:j])
+            os.rename(temp, os.path.join(checkpoint, name))
+            logging.debug("rank %d: %d of %d images saved to %s. "
+                          "elapsed %s" % (mpi.RANK, j, size, checkpoint,
+                                          timer.total()))
+            i = j
+    
+    def _checkpoint_fingerprint(self, dataset, data, total):
+        """Returns a string that identifies the outputs of a checkpointed run:
+        the total number of images, the output shape and dtype, a hash of the
+        parameters of the components of this layer and the previous ones, and
+        a hash of the first local image. Only root's fingerprint is used, so
+        this should not carry out any collective operation.
+        """
+        md5 = hashlib.md5()
+        layer = self
+        while layer is not None:
+            for component in layer:
+                _hash_params(md5, component)
+            layer = layer._previous_layer
+        image_md5 = hashlib.md5(dataset.__class__.__name__)
+        if dataset.size() > 0:
+            _hash_params(image_md5, np.asarray(dataset.image(0)))
+        return 'size %d\nshape %s\ndtype %s\nparams %s\nimage %s\n' % \
+                (total, str(data.shape[1:]), data.dtype.str,
+                 md5.hexdigest(), image_md5.hexdigest())
+    
+    def _planned_shape(self, shapes, as_2d):
+        """Returns the shape of the output of an image, given its _shapes().
+        """
+        if as_2d:
+            return (int(np.prod(shapes[-1])),)
+        return shapes[-1]
+    
+    def _process_range(self, dataset, data, start, end, as_list, as_2d,
+                       batch_size, num_workers, timer = None, cache = None,
+                       shapes = None):
+        """Processes the images with index start to end-1 with num_workers
+        threads and writes the output into data. If a timer is given, the
+        progress is logged. If the _shapes() of the images are given, each
+        thread processes the images with a plan (see plan()).
+        """
+        size = end - start
+        if size <= 0:
+            return
+        if batch_size is not None:
+            chunk_size = batch_size
+        else:
+            chunk_size = max(int(size / (num_workers * 8)), 1)
+        chunks = [(i, min(i + chunk_size, end))
+                  for i in range(start, end, chunk_size)]
+        # buffers are kept per thread, since they are not thread-safe
+        buffers = threading.local()
+        lock = threading.Lock()
+        progress = [start]
+        def _run(chunk):
+            self._process_chunk(dataset, data, chunk[0], chunk[1], as_list,
+                                as_2d, batch_size, buffers, cache, shapes)
+            if timer is None:
+                return
+            # report local progress
+            with lock:
+                done = progress[0]
+                progress[0] += chunk[1] - chunk[0]
+                if (done * 10 / end) != (progress[0] * 10 / end):
+                    logging.debug("rank %d: %d percent. elapsed %s" % \
+                            (mpi.RANK, progress[0]*100 / end, timer.total()))
+        if num_workers > 1 and len(chunks) > 1:
+            pool = ThreadPool(num_workers)
+            try:
+                pool.map(_run, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for chunk in chunks:
+                _run(chunk)
+    
+    def _process_chunk(self, dataset, data, start, end, as_list, as_2d,
+                       batch_size, buffers, cache = None, shapes = None):
+        """Processes the images with index start to end-1 and writes the
+        output into data. buffers is the (thread-local) object that keeps the
+        convolution buffers of the caller.
+        """
+        if batch_size is not None and not as_list:
+            for i in range(start, end, batch_size):
+                data[i:min(i + batch_size, end)] = self._process_batch_local(
+                        [self._input(dataset, j, cache)
+                         for j in range(i, min(i + batch_size, end))],
+                        as_vector = as_2d)
+            return
+        # check if we want to use buffer: with a plan, or if the images have
+        # a fixed size, we reuse the whole convbuffer. Otherwise the
+        # intermediate outputs come from a grow-only arena.
+        if getattr(buffers, 'arena', None) is None:
+            buffers.arena = mathutil.BufferArena()
+        arena = buffers.arena
+        if shapes is not None:
+            if getattr(buffers, 'plan', None) is None:
+                buffers.plan = self._plan(shapes)
+            convbuffer = buffers.plan
+        elif self._fixed_size:
+            if getattr(buffers, 'convbuffer', None) is None:
+                buffers.convbuffer = [None] * (len(self) + 1)
+            convbuffer = buffers.convbuffer
+        else:
+            convbuffer = None
+        for i in range(start, end):
+            image = self._input(dataset, i, cache, arena)
+            if shapes is None:
+                data[i] = self._process_local(
+                        image, as_vector = (as_2d and not as_list),
+                        convbuffer = convbuffer, arena = arena)
+            elif np.shape(image) == shapes[0]:
+                # the output is written directly into data
+                self._process_local(image, as_vector = as_2d,
+                                    convbuffer = convbuffer, arena = arena,
+                                    out = data[i])
+            else:
+                logging.warning("Image %d does not have the planned shape." \
+                                % i)
+                data[i] = self._process_local(image, as_vector = as_2d,
+                                              arena = arena)
+    
     def sample(self, dataset, num_patches,
-               exhaustive = False, ratio_per_image = 0.1):
+               exhaustive = False, ratio_per_image = 0.1, cache = None,
+               steal = False):
         """Sample pooled features from the dataset. For example, if after
         pooling, the output feature is 4*4*1000, then the sampled output is
-        num_patches * 1000.
+        num_patches * 1000. If a LayerOutputCache is given, the outputs of
+        this layer and its previous layers are taken from (and stored in) the
+        cache. See Extractor.sample() for steal.
         """
         extractor = IdenticalExtractor()
         return extractor.sample(dataset, num_patches, self, 
-                                exhaustive, ratio_per_image)
+                                exhaustive, ratio_per_image, cache = cache,
+                                steal = steal)
+
+
+class LayerOutputCache(object):
+    """LayerOutputCache keeps the outputs of ConvLayers on the images of a
+    dataset (see ConvLayer.output()), so that training and processing a stack
+    of layers computes each layer on each image at most once. The outputs
+    are kept in memory up to a budget, and the rest are spilled to .npy files
+    that are memory-mapped when read. All the cached outputs are read-only.
+    """
+    def __init__(self, budget = 1 << 30, spill_dir = None):
+        """Initializes the cache.
+        
+        Input:
+            budget: the number of bytes kept in memory. Default 1GB.
+            spill_dir: the directory to spill the outputs to. If None, a
+                temporary directory is created and removed by close().
+        """
+        self._budget = budget
+        self._spill_dir = spill_dir
+        self._own_dir = False
+        self._lock = threading.Lock()
+        # entries map (id(layer), id(dataset), idx) to (array, filename).
+        self._entries = {}
+        # we hold the layers and datasets so their ids are not reused
+        self._layers = {}
+        self._datasets = {}
+        self._nbytes = 0
+        self._num_files = 0
+    
+    def get(self, layer, dataset, idx):
+        """Returns the cached output, or None if it is not in the cache.
+        """
+        with self._lock:
+            entry = self._entries.get((id(layer), id(dataset), idx))
+        if entry is None:
+            return None
+        elif entry[0] is not None:
+            return entry[0]
+        else:
+            return np.load(entry[1], mmap_mode='r')
+    
+    def put(self, layer, dataset, idx, output):
+        """Stores the output and returns its read-only cached version.
+        """
+        key = (id(layer), id(dataset), idx)
+        with self._lock:
+            if key in self._entries:
+                entry = self._entries[key]
+                filename = None
+            else:
+                self._layers[id(layer)] = layer
+                self._datasets[id(dataset)] = dataset
+                if self._nbytes + output.nbytes <= self._budget:
+                    output.flags.writeable = False
+                    entry = (output, None)
+                    self._nbytes += output.nbytes
+                    filename = None
+                else:
+                    filename = self._new_filename()
+                    entry = (None, filename)
+                self._entries[key] = entry
+        if filename is not None:
+            # write outside the lock. Another thread could only see the entry
+            # before the file is complete if it asked for the same image.
+            np.save(filename, output)
+        if entry[0] is not None:
+            return entry[0]
+        else:
+            return np.load(entry[1], mmap_mode='r')
+    
+    def _new_filename(self):
+        """Returns a new file name in the spill directory. Should be called
+        with the lock held.
+        """
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix = 'iceberk-cache-')
+            self._own_dir = True
+        else:
+            mpi.mkdir(self._spill_dir)
+        self._num_files += 1
+        return os.path.join(self._spill_dir, 'output-%d-%d.npy' % \
+                            (mpi.RANK, self._num_files))
+    
+    def invalidate(self, layer):
+        """Removes the cached outputs of the layer and of all the layers that
+        use it as a previous layer (their outputs depend on it).
+        """
+        with self._lock:
+            stale = set()
+            for layer_id, cached_layer in self._layers.items():
+                current = cached_layer
+                while current is not None:
+                    if current is layer:
+                        stale.add(layer_id)
+                        break
+                    current = current._previous_layer
+            for key in self._entries.keys():
+                if key[0] in stale:
+                    self._remove(key)
+            for layer_id in stale:
+                del self._layers[layer_id]
+    
+    def _remove(self, key):
+        """Removes an entry. Should be called with the lock held.
+        """
+        array, filename = self._entries.pop(key)
+        if array is not None:
+            self._nbytes -= array.nbytes
+        else:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+    
+    def nbytes(self):
+        """Returns the number of bytes held in memory.
+        """
+        return self._nbytes
+    
+    def close(self):
+        """Removes all the cached outputs, and the spill directory if it was
+        created by the cache.
+        """
+        with self._lock:
+            for key in self._entries.keys():
+                self._remove(key)
+            self._layers = {}
+            self._datasets = {}
+            if self._own_dir:
+                shutil.rmtree(self._spill_dir, ignore_errors = True)
+                self._spill_dir = None
+                self._own_dir = False
 
 
 class Extractor(Component):
@@ -188,10 +1191,11 @@ class Extractor(Component):
             "You should not call the train() function of a extractor."
     
     def sample(self, dataset, num_patches, previous_layer = None,
-               exhaustive = False, ratio_per_image = 0.1):
+               exhaustive = False, ratio_per_image = 0.1, cache = None,
+               steal = False):
         """ randomly sample num_patches from the dataset. Pass previous_layer
         if sampling should be performed on the output of a previously computed
-        layer.
+        layer, and optionally a LayerOutputCache to reuse its outputs.
         
         The returned patches would be a 2-dimensional ndarray of size
             [num_patches, psize[0] * psize[1] * num_channels]
@@ -202,18 +1206,28 @@ class Extractor(Component):
         in a lazy way - for each image we keep a subset of its features given
         by ratio_per_image, and as soon as we hit the number of required patches
         we stop sampling.
+        
+        If steal is True, the images are shared over the nodes with
+        mpi.steal_map() and each node samples from the images it processed.
+        All the images are then processed, and the dataset should support
+        descriptors (see ImageSet.has_descriptors()). Not supported with
+        cache. As the nodes process different numbers of images, the patches
+        are then sampled uniformly over all nodes (see
+        ReservoirSampler.get_global()), and the number of patches on each
+        node varies. To keep the sample exact, each node then keeps a
+        reservoir of num_patches patches instead of num_patches / mpi.SIZE.
         """
         logging.debug("Extracting %d patches..." % num_patches)
+        total_patches = num_patches
         num_patches = np.maximum(int(num_patches / float(mpi.SIZE) + 0.5), 1)
-        sampler = mathutil.ReservoirSampler(num_patches)
+        if steal:
+            sampler = mathutil.ReservoirSampler(total_patches)
+        else:
+            sampler = mathutil.ReservoirSampler(num_patches)
         order = np.arange(dataset.size())
         if not exhaustive:
             order = np.random.permutation(order)
-        for i in range(dataset.size()):
-            if previous_layer is not None:
-                feat = previous_layer.process(dataset.image(i))
-            else:
-                feat = dataset.image(i)
+        def consider(feat):
             feat = self.process(feat)
             feat.resize((np.prod(feat.shape[:2]),) + feat.shape[2:])
             if exhaustive:
@@ -223,12 +1237,35 @@ class Extractor(Component):
                 idx = np.random.permutation(np.arange(feat.shape[0]))
                 num_selected = max(int(feat.shape[0] * ratio_per_image), 1)
                 sampler.consider(feat[idx[:num_selected]])
+        if steal:
+            if cache is not None:
+                raise ValueError, "Work stealing does not support cache."
+            if not dataset.has_descriptors():
+                raise ValueError, "Work stealing needs a dataset that "\
+                        "supports descriptors."
+            def consider_descriptor(descriptor):
+                feat = dataset.image_from_descriptor(descriptor)
+                if previous_layer is not None:
+                    feat = previous_layer.process(feat)
+                consider(feat)
+            mpi.steal_map(consider_descriptor,
+                          [dataset.descriptor(i) for i in order],
+                          gather = False)
+        else:
+            for i in order:
+                if previous_layer is not None:
+                    feat = previous_layer.output(dataset, i, cache)
+                else:
+                    feat = dataset.image(i)
+                consider(feat)
                 # as soon as we hit the number of patches needed, quit
-                if sampler.num_considered() > num_patches:
+                if not exhaustive and sampler.num_considered() > num_patches:
                     break
         if sampler.num_considered() < num_patches:
             logging.warning("Warning: the number of provided patches is " \
                             "smaller than the number of samples needed.")
+        if steal:
+            return sampler.get_global(total_patches)
         return sampler.get()
     
     def process(self, image, out = None):
@@ -245,8 +1282,14 @@ class IdenticalExtractor(Extractor):
     def process(self, image, out = None):
         if out is not None:
             out[:] = np.atleast_3d(image)
+            return out
         else:
             return np.atleast_3d(image.copy())
+    
+    def output_shape(self, input_shape):
+        if len(input_shape) == 2:
+            return tuple(input_shape) + (1,)
+        return tuple(input_shape)
 
 class PatchExtractor(Extractor):
     """The patch extractor. It densely extracts overlapping patches, and 
@@ -268,7 +1311,8 @@ class PatchExtractor(Extractor):
         self.stride = stride
     
     def sample(self, dataset, num_patches, previous_layer = None,
-               exhaustive = False, ratio_per_image = 0.1, withlabel = False):
+               exhaustive = False, ratio_per_image = 0.1, withlabel = False,
+               cache = None, steal = False):
         """ randomly sample num_patches from the dataset.
         
         The returned patches would be a 2-dimensional ndarray of size
@@ -277,10 +1321,13 @@ class PatchExtractor(Extractor):
         Optionally, you can set withlabel = True, in which case the function
         also returns the label of the image. Note that this would make the
         output format compatible with the general pipeline.
+        
+        steal is only used with a previous layer (see Extractor.sample()).
         """
         if previous_layer is not None:
             return Extractor.sample(self, dataset, num_patches,
-                                    previous_layer, exhaustive, ratio_per_image)
+                                    previous_layer, exhaustive, ratio_per_image,
+                                    cache = cache, steal = steal)
         # if there is no previous layer, we have a more efficient method to
         # perform sampling.
         num_patches = np.maximum(int(num_patches / float(mpi.SIZE) + 0.5), 1)
@@ -330,6 +1377,19 @@ class PatchExtractor(Extractor):
             [new_height, new_width, psize[0] * psize[1] * num_channels]
         '''
         return cpputil.im2col(image, self.psize, self.stride, out)
+    
+    def output_shape(self, input_shape):
+        if input_shape[0] < self.psize[0] or input_shape[1] < self.psize[1]:
+            raise ValueError, "Image shape %s and patch shape %s are not "\
+                              "compatible" % (repr(input_shape),
+                                              repr(self.psize))
+        if len(input_shape) == 2:
+            num_channels = 1
+        else:
+            num_channels = input_shape[2]
+        return ((input_shape[0] - self.psize[0]) / self.stride + 1,
+                (input_shape[1] - self.psize[1]) / self.stride + 1,
+                self.psize[0] * self.psize[1] * num_channels)
 
 
 class Normalizer(Component):
@@ -339,6 +1399,11 @@ class Normalizer(Component):
     def process(self, image, out = None):
         raise NotImplementedError
 
+    def output_shape(self, input_shape):
+        """ Normalizers do not change the shape.
+        """
+        return tuple(input_shape)
+
     def train(self, patches):
         """ For normalizers, usually no training should be needed.
         """
@@ -351,12 +1416,13 @@ class MeanNormalizer(Normalizer):
     def process(self, image, out = None):
         """ normalizes the patches.
         """
-        image = image.astype(np.float64)
+        if image.dtype != _float_dtype(image):
+            image = image.astype(_float_dtype(image))
         m = image.mean(axis=-1).reshape(image.shape[:-1] + (1,))
         if out is None:
             out = image - m
         else:
-            out[:] = image - m
+            np.subtract(image, m, out=out)
         return out
 
 
@@ -369,22 +1435,21 @@ class MeanvarNormalizer(Normalizer):
     def process(self, image, out = None):
         """ normalizes the patches.
         """
-        image = image.astype(np.float64)
+        if image.dtype != _float_dtype(image):
+            image = image.astype(_float_dtype(image))
         shape_old = image.shape
         shape_temp = (np.prod(shape_old[:-1]), shape_old[-1])
-        image.resize(shape_temp)
-        m = image.mean(axis=1)
-        std = image.std(axis=1)
+        # work on 2-d views, so neither the input nor the output is copied
+        image_2d = image.reshape(shape_temp)
+        m = image_2d.mean(axis=1)
+        std = image_2d.std(axis=1)
         std += self.specs.get('reg', np.finfo(np.float64).eps)
         if out is None:
-            out = image - m[:, np.newaxis]
-        else:
-            out.resize(shape_temp)
-            out[:] = image - m[:, np.newaxis]
-        out /= std[:, np.newaxis]
-        image.resize(shape_old)
-        out.resize(shape_old)
-        return out
+            out = np.empty(shape_old, dtype = image.dtype)
+        out_2d = out.reshape(shape_temp)
+        np.subtract(image_2d, m[:, np.newaxis], out=out_2d)
+        out_2d /= std[:, np.newaxis]
+        return out.reshape(shape_old)
 
 class SpatialMeanNormalizer(Normalizer):
     """Normalizes the patches by subtracting the per-channel mean.
@@ -395,22 +1460,19 @@ class SpatialMeanNormalizer(Normalizer):
     def process(self, image, out = None):
         """ normalizes the patches.
         """
-        image = image.astype(np.float64)
+        if image.dtype != _float_dtype(image):
+            image = image.astype(_float_dtype(image))
         channels = self.specs['channels']
         shape_old = image.shape
         # first, subtract the mean
         shape_temp = (np.prod(shape_old[:-1]), 
                       shape_old[-1] / channels, channels)
-        image.resize(shape_temp)
-        m = image.mean(axis=1)
+        image_3d = image.reshape(shape_temp)
+        m = image_3d.mean(axis=1)
         if out is None:
-            out = image - m[:,np.newaxis, :]
-        else:
-            out.resize(shape_temp)
-            out[:] = image - m[:, np.newaxis, :]
-        image.resize(shape_old)
-        out.resize(shape_old)
-        return out
+            out = np.empty(shape_old, dtype = image.dtype)
+        np.subtract(image_3d, m[:, np.newaxis, :], out=out.reshape(shape_temp))
+        return out.reshape(shape_old)
 
 
 
@@ -421,18 +1483,20 @@ class L2Normalizer(Normalizer):
     Specs:
         'reg': the regularization term added to the norm.
     """
-    def process(self, image):
+    def process(self, image, out = None):
         """ normalizes the patches
         """
         shape_old = image.shape
         shape_temp = (np.prod(shape_old[:-1]), shape_old[-1])
-        image.resize(shape_temp)
-        length = np.sqrt((image**2).sum(axis=1))
+        image_2d = image.reshape(shape_temp)
+        length = np.sqrt((image_2d**2).sum(axis=1))
         length += self.specs.get('reg', np.finfo(np.float64).eps)
-        image_out = image / length[:, np.newaxis]
-        image.resize(shape_old)
-        image_out.resize(shape_old)
-        return image_out
+        if out is None:
+            image_out = image_2d / length[:, np.newaxis]
+        else:
+            image_out = out.reshape(shape_temp)
+            np.divide(image_2d, length[:, np.newaxis], out=image_out)
+        return image_out.reshape(shape_old)
 
 
 class L1Normalizer(Normalizer):
@@ -455,6 +1519,9 @@ class L1Normalizer(Normalizer):
         return out
 
 
+# gives each dictionary trainer its own keys for mpi.shared_bcast
+_TRAINER_IDS = itertools.count()
+
 class DictionaryTrainer(object):
     """The dictionary trainer
     """
@@ -465,6 +1532,15 @@ class DictionaryTrainer(object):
             specs: a dictionary containing param keywords and values
         """
         self.specs = specs
+        self._trainer_id = next(_TRAINER_IDS)
+    
+    def _shared_bcast(self, array, name):
+        """Broadcasts array with mpi.shared_bcast. Training the same trainer
+        again reuses the shared memory, so the dictionary returned by the
+        previous train() call should no longer be used.
+        """
+        return mpi.shared_bcast(array, key = ('DictionaryTrainer',
+                                              self._trainer_id, name))
         
     def train(self, incoming_patches):
         """ train a dictionary, and return the necessary dictionary parameters
@@ -479,29 +1555,61 @@ class DictionaryTrainer(object):
         raise NotImplementedError
     
 class PcaTrainer(DictionaryTrainer):
-    """Performs PCA training
+    """Performs PCA training. Besides a 2-d matrix, incoming_patches could
+    also be an iterable of 2-d row blocks, so that the patches need not be
+    held in memory all at once (see mathutil.mpi_meancov).
     """
     def train(self, incoming_patches):
         m, covmat = mathutil.mpi_meancov(incoming_patches)
         if mpi.is_root():
             # only root carries out the computation
             eigval, eigvec = np.linalg.eigh(covmat)
-            reg = self.specs.get('reg', np.finfo(np.float64).eps)
-            W = eigvec * 1.0 / (np.sqrt(np.maximum(eigval, 0.0)) + reg)
+            W = self._whiten(eigval, eigvec)
         else:
             eigval, eigvec, W = None, None, None
-        W = mpi.COMM.bcast(W)
-        eigval = mpi.COMM.bcast(eigval)
-        eigvec = mpi.COMM.bcast(eigvec)
+        # one read-only copy per machine
+        W = self._shared_bcast(W, 'W')
+        eigval = self._shared_bcast(eigval, 'eigval')
+        eigvec = self._shared_bcast(eigvec, 'eigvec')
         return (W, -m), (eigval, eigvec, covmat)
+    
+    def _whiten(self, eigval, eigvec):
+        """Computes the whitening matrix from the eigendecomposition of the
+        covariance matrix.
+        """
+        reg = self.specs.get('reg', np.finfo(np.float64).eps)
+        return eigvec * 1.0 / (np.sqrt(np.maximum(eigval, 0.0)) + reg)
 
 class ZcaTrainer(PcaTrainer):
     """Performs ZCA training
     """
+    def _whiten(self, eigval, eigvec):
+        return np.dot(PcaTrainer._whiten(self, eigval, eigvec), eigvec.T)
+
+
+class RandomizedPcaTrainer(PcaTrainer):
+    """Performs PCA training that only keeps the top components, found with
+    randomized subspace iteration over all nodes (see
+    mathutil.mpi_randomized_pca). The covariance matrix is never formed, and
+    W is a (dim, num_components) matrix, which makes both training and
+    encoding cheaper for high-dimensional patches. The components are in
+    descending order of their eigenvalues. Unlike PcaTrainer, incoming_patches
+    should be a 2-d matrix, since the iteration passes over the patches
+    several times; a TypeError is raised otherwise.
+    specs:
+        num_components: the number of components to keep
+        oversample: the number of extra random vectors (default 10)
+        num_iter: the number of power iterations (default 2)
+        reg: the regularization term added to the std (default eps)
+    """
     def train(self, incoming_patches):
-        (W, b), (eigval, eigvec, covmat) = PcaTrainer.train(self, incoming_patches)
-        W = np.dot(W, eigvec.T)
-        return (W, b), (eigval, eigvec, covmat)
+        m, eigval, eigvec = mathutil.mpi_randomized_pca(
+                incoming_patches,
+                self.specs['num_components'],
+                oversample = self.specs.get('oversample', 10),
+                num_iter = self.specs.get('num_iter', 2))
+        W = self._whiten(eigval, eigvec)
+        return (W, -m), (eigval, eigvec, None)
 
 
 class KmeansTrainer(DictionaryTrainer):
@@ -512,6 +1620,8 @@ class KmeansTrainer(DictionaryTrainer):
         max_iter: the maximum mumber of kmeans iterations (default 100)
         tol: the tolerance threshold before we stop iterating (default 1e-4)
     """
+    _normalize = False
+    
     def train(self, incoming_patches):
         centroids, label, inertia = \
             kmeans_mpi.kmeans(incoming_patches, 
@@ -519,6 +1629,10 @@ class KmeansTrainer(DictionaryTrainer):
                               n_init = self.specs.get('n_init', 1),
                               max_iter = self.specs.get('max_iter', 100),
                               tol = self.specs.get('tol', 0.0001))
+        if self._normalize:
+            centroids /= np.sqrt((centroids**2).sum(1))[:, np.newaxis]
+        # one read-only copy per machine
+        centroids = self._shared_bcast(centroids, 'centroids')
         return centroids, (label, inertia)
 
 class NormalizedKmeansTrainer(KmeansTrainer):
@@ -530,10 +1644,7 @@ class NormalizedKmeansTrainer(KmeansTrainer):
         max_iter: the maximum mumber of kmeans iterations (default 100)
         tol: the tolerance threshold before we stop iterating (default 1e-4)
     """
-    def train(self, incoming_patches):
-        centroids, misc = KmeansTrainer.train(self, incoming_patches)
-        centroids /= np.sqrt((centroids**2).sum(1))[:, np.newaxis]
-        return centroids, misc
+    _normalize = True
 
 class OMPTrainer(DictionaryTrainer):
     """Orthogonal Matching Pursuit
@@ -544,7 +1655,7 @@ class OMPTrainer(DictionaryTrainer):
                                 max_iter = self.specs.get('max_iter', 100),
                                 tol = self.specs.get('tol', 0.0001)
                                 )
-        return centroid, ()
+        return self._shared_bcast(centroid, 'centroids'), ()
 
 class OMPNTrainer(DictionaryTrainer):
     """Orthogonal Matching Pursuit with N activations instead of 
@@ -556,7 +1667,7 @@ class OMPNTrainer(DictionaryTrainer):
                                    max_iter = self.specs.get('max_iter', 100),
                                    tol = self.specs.get('tol', 0.0001)
                                   )
-        return centroid, ()
+        return self._shared_bcast(centroid, 'centroids'), ()
 
 class FeatureEncoder(Component):
     """The feature encoder.
@@ -575,6 +1686,35 @@ class FeatureEncoder(Component):
     def train(self, incoming_patches):
         if self.trainer is not None:
             self.dictionary = self.trainer.train(incoming_patches)[0]
+    
+    def set_dtype(self, dtype):
+        self.dictionary = _astype(self.dictionary, dtype)
+    
+    def output_shape(self, input_shape):
+        return tuple(input_shape[:-1]) + (self._output_dim(input_shape[-1]),)
+    
+    def _output_dim(self, input_dim):
+        """Returns the output dimension given the input dimension. The default
+        implementation assumes that the dictionary has one entry per row.
+        """
+        if self.dictionary is None:
+            raise ValueError, "The encoder has not been trained."
+        if self.dictionary.shape[1] != input_dim:
+            raise ValueError, "Input dimension %d does not match the "\
+                    "dictionary dimension %d." % \
+                    (input_dim, self.dictionary.shape[1])
+        return self.dictionary.shape[0]
+
+def _linear_output_dim(encoder, input_dim):
+    """The _output_dim() of the linear encoders, whose dictionary is (W, b).
+    """
+    if encoder.dictionary is None:
+        raise ValueError, "The encoder has not been trained."
+    W = encoder.dictionary[0]
+    if W.shape[0] != input_dim:
+        raise ValueError, "Input dimension %d does not match the "\
+                "dictionary dimension %d." % (input_dim, W.shape[0])
+    return W.shape[1]
 
 class LinearEncoderBW(FeatureEncoder):
     """A linear encoder that does output = (input + b) * W
@@ -587,6 +1727,8 @@ class LinearEncoderBW(FeatureEncoder):
         out = mathutil.dot_image(image, W, out=out)
         image -= b
         return out
+    
+    _output_dim = _linear_output_dim
 
 class LinearEncoderWB(FeatureEncoder):
     """A linear encoder that does output = input * W + b
@@ -596,6 +1738,8 @@ class LinearEncoderWB(FeatureEncoder):
         out = mathutil.dot_image(image, W, out=out)
         out += b
         return out
+    
+    _output_dim = _linear_output_dim
 
 """the default linear encoder is LinearEncoderBW
 """
@@ -618,10 +1762,10 @@ class VQEncoder(FeatureEncoder):
         if out is None:
             out = np.zeros_like(distance)
         else:
-            CHECK_SHAPE(out, distance.shape)
+            out.resize(distance.shape)
             out[:] = 0
         idx = distance.argmin(axis=1)
-        out[:,idx] = 1
+        out[np.arange(out.shape[0]), idx] = 1
         return out.reshape(shape + (out.shape[-1],))
 
 class ThresholdEncoder(FeatureEncoder):
@@ -633,19 +1777,29 @@ class ThresholdEncoder(FeatureEncoder):
         alpha = self.specs.get('alpha', 0.25)
         # check if we would like to do two-side thresholding. Default yes.
         if self.specs.get('twoside', True):
-            # concatenate, and make sure the output is C_CONTIGUOUS
-            # for the temporary product, we check if we can utilize the
-            # buffer to save allocation time
-            product = mathutil.dot_image(image, self.dictionary.T)
-            imshape = product.shape[:-1]
-            N = product.shape[-1]
-            product.resize((np.prod(imshape), N))
+            # concatenate, and make sure the output is C_CONTIGUOUS. To avoid
+            # a temporary product, we compute it into the first half of the
+            # output memory and then spread the rows in place.
+            imshape = image.shape[:-1]
+            M = int(np.prod(imshape))
+            N = self.dictionary.shape[0]
             if out is None:
-                out = np.empty((np.prod(imshape), N*2))
+                out = np.empty((M, N*2), dtype = image.dtype)
             else:
-                out.resize((np.prod(imshape), N*2))
-            out[:,:N] = product
-            out[:,N:] = -product
+                out.resize((M, N*2))
+            out_flat = out.reshape(M * N * 2)
+            mathutil.dot_image(image, self.dictionary.T,
+                               out=out_flat[:M*N].reshape((M, N)))
+            # row i moves from offset i*N to offset 2*i*N. Moving the second
+            # half of the remaining rows at a time never overwrites a row that
+            # has not been moved yet, and row 0 is already in place.
+            end = M
+            while end > 1:
+                start = (end + 1) / 2
+                out[start:end, :N] = \
+                        out_flat[start*N:end*N].reshape((end - start, N))
+                end = start
+            np.negative(out[:, :N], out[:, N:])
             out.resize(imshape + (N*2,))
         elif self.specs['twoside'] == 'abs':
             out = mathutil.dot_image(image, self.dictionary.T, out=out)
@@ -657,6 +1811,12 @@ class ThresholdEncoder(FeatureEncoder):
         np.clip(out, 0., np.inf, out=out)
         return out
     
+    def _output_dim(self, input_dim):
+        output_dim = FeatureEncoder._output_dim(self, input_dim)
+        if self.specs.get('twoside', True):
+            return output_dim * 2
+        return output_dim
+    
 
 class ReLUEncoder(ThresholdEncoder):
     """ ReLUEncoder is simply the threshold encoder with the alpha term set to
@@ -765,6 +1925,10 @@ class MetaPooler(Pooler):
         else:
             out[:] = np.hstack(output)
             return out
+    
+    def output_shape(self, input_shape):
+        return (sum(int(np.prod(basic_pooler.output_shape(input_shape)))
+                    for basic_pooler in self._basic_poolers),)
 
 class SpatialPooler(Pooler):
     """ The spatial Pooler that does spatial pooling on a regular grid.
@@ -780,9 +1944,10 @@ class SpatialPooler(Pooler):
         self.specs['grid'] = grid
     
     def process(self, image, out = None):
-        if not (image.flags['C_CONTIGUOUS'] and image.dtype == np.float64):
+        if not (image.flags['C_CONTIGUOUS'] and 
+                image.dtype == _float_dtype(image)):
             logging.warning("Warning: the image is not contiguous.")
-            image = np.ascontiguousarray(image, dtype=np.float64)
+            image = np.ascontiguousarray(image, dtype=_float_dtype(image))
         # do fast pooling
         grid = self.specs['grid']
         if type(grid) is int:
@@ -790,6 +1955,12 @@ class SpatialPooler(Pooler):
             self.specs['grid'] = grid
         out = cpputil.fastpooling(image, grid, self.specs['method'], out = out)
         return out
+    
+    def output_shape(self, input_shape):
+        grid = self.specs['grid']
+        if type(grid) is int:
+            grid = (grid, grid)
+        return (grid[0], grid[1], input_shape[-1])
 
 
 class OvercompletePooler(Pooler):
@@ -799,9 +1970,10 @@ class OvercompletePooler(Pooler):
         method: 'max', 'ave' or 'rms'.
     """
     def process(self, image, out = None):
-        if not (image.flags['C_CONTIGUOUS'] and image.dtype == np.float64):
+        if not (image.flags['C_CONTIGUOUS'] and 
+                image.dtype == _float_dtype(image)):
             logging.warning("Warning: the image is not contiguous.")
-            image = np.ascontiguousarray(image, dtype=np.float64)
+            image = np.ascontiguousarray(image, dtype=_float_dtype(image))
         grid = self.specs['grid']
         if type(grid) is int:
             grid = (grid, grid)
@@ -809,6 +1981,13 @@ class OvercompletePooler(Pooler):
         out = cpputil.fast_oc_pooling(image, grid, self.specs['method'], 
                                       out = out)
         return out
+    
+    def output_shape(self, input_shape):
+        grid = self.specs['grid']
+        if type(grid) is int:
+            grid = (grid, grid)
+        return (grid[0] * (grid[0] + 1) * grid[1] * (grid[1] + 1) / 4,
+                input_shape[-1])
 
 class PyramidPooler(MetaPooler):
     """PyramidPooler performs pyramid pooling.
@@ -866,9 +2045,13 @@ class FixedSizePooler(Pooler):
         # we use a spatial pooler to do the actual job
         image = np.ascontiguousarray(image[offset[0]:offset[0]+pool_size[0],
                                            offset[1]:offset[1]+pool_size[1]],
-                                     dtype = np.float64)
+                                     dtype = _float_dtype(image))
         self._spatialpooler.set_grid(grid)
         return self._spatialpooler.process(image, out=out)
+    
+    def output_shape(self, input_shape):
+        grid = (np.asarray(input_shape[:2]) / self.specs['size']).astype(int)
+        return (int(grid[0]), int(grid[1]), input_shape[-1])
 
 class KernelPooler(Pooler):
     """KernelPooler is similar to SpatialPooler but uses a kernel to weight
@@ -941,11 +2124,13 @@ class KernelPooler(Pooler):
         pool_size = grid * stride + kernel_size
         offset = ((image_size - pool_size) / 2).astype(int)
         if out is None:
-            out = np.zeros((grid[0], grid[1], output_dim))
+            out = np.zeros((grid[0], grid[1], output_dim),
+                           dtype = _float_dtype(image))
         else:
             CHECK_SHAPE(out, (grid[0], grid[1], output_dim))
             out[:] = 0
-        cache = np.zeros((kernel_size[0], kernel_size[1], output_dim))
+        cache = np.zeros((kernel_size[0], kernel_size[1], output_dim),
+                         dtype = out.dtype)
         cache_2d = cache.view()
         cache_2d.shape = (kernel_size[0] * kernel_size[1], output_dim)
         # for max, rms and average pooling, we have faster methods to do it
@@ -959,6 +2144,16 @@ class KernelPooler(Pooler):
                 pool(cache_2d, out[i,j])
         return out
     
+    def output_shape(self, input_shape):
+        method = self.specs['method']
+        output_dim = input_shape[-1]
+        if method not in ('max', 'ave', 'rms'):
+            output_dim = method.dim(output_dim)
+        kernel_size = np.asarray(self.specs['kernel'].shape, dtype=int)
+        grid = ((np.asarray(input_shape[:2]) - kernel_size) / 
+                self.specs['stride']).astype(int)
+        return (int(grid[0]), int(grid[1]), output_dim)
+    
     @staticmethod
     def kernel_gaussian(size, sigma):
         """ A Gaussian kernel of the given size and given sigma
@@ -7,6 +7,12 @@ do
     mpirun -n $i nosetests *.py
 done
 
+# local multiprocess call without mpi
+for i in {2..4}
+do
+    python ../mprun.py -n $i `which nosetests` *.py
+done
+
 # test no mpi case
 PYTHONPATH_SAV=$PYTHONPATH
 PYTHONPATH=$PWD/nompi:$PYTHONPATH
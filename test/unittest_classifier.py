@@ -74,3 +74,31 @@ class TestLoss2(unittest.TestCase):
         TestLoss2.basicTest(Y, pred * 10, weight,
                 classifier.Loss.loss_multiclass_logistic,
                 classifier.Loss2.loss_multiclass_logistic)
+
+
+class TestSolverMC(unittest.TestCase):
+    def testBlockedGradient(self):
+        X = np.random.rand(100, 200)
+        y = np.random.randint(5, size=100)
+        Y = classifier.to_one_of_k_coding(y, fill = 0, K = 5)
+        solver = classifier.SolverMC(0.01,
+                                     classifier.Loss.loss_multiclass_logistic,
+                                     classifier.Reg.reg_l2)
+        wb = solver.presolve(X, Y, None, None) + np.random.rand(5 * 201)
+        f, g = classifier.SolverMC.obj(wb, solver)
+        g = g.copy()
+        block_bytes = classifier._GRADIENT_BLOCK_BYTES
+        # 1: one row of the gradient per block, copied one column at a time.
+        # 1600: 40 rows per block, copied 2 columns at a time.
+        for num_bytes, chunk in [(1, 1), (1600, 2)]:
+            try:
+                classifier._GRADIENT_BLOCK_BYTES = num_bytes
+                solver.presolve(X, Y, None, None)
+                # X itself is not copied
+                self.assertTrue(np.may_share_memory(solver._X, X))
+                self.assertEqual(solver._Xchunk.shape, (100, chunk))
+                f_blocked, g_blocked = classifier.SolverMC.obj(wb, solver)
+            finally:
+                classifier._GRADIENT_BLOCK_BYTES = block_bytes
+            self.assertAlmostEqual(f, f_blocked)
+            np.testing.assert_array_almost_equal(g, g_blocked)
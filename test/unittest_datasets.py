@@ -113,6 +113,22 @@ class TestTwoLayerDataset(unittest.TestCase):
         for i in range(data.size()):
             self.assertEqual(data.image(i).shape, target_size + (3,))
         self.assertEqual(data.num_channels(), 3)
+    
+    def testDescriptor(self):
+        for prefetch in [False, True]:
+            data = datasets.TwoLayerDataset(self.path, ['png'],
+                                            prefetch = prefetch)
+            self.assertTrue(data.has_descriptors())
+            for i in range(data.size()):
+                np.testing.assert_array_equal(
+                        data.image(i),
+                        data.image_from_descriptor(data.descriptor(i)))
+        mirror = datasets.MirrorSet(data)
+        self.assertTrue(mirror.has_descriptors())
+        for i in range(mirror.size()):
+            np.testing.assert_array_equal(
+                    mirror.image(i),
+                    mirror.image_from_descriptor(mirror.descriptor(i)))
 
 if __name__ == '__main__':
     unittest.main()
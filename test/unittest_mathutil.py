@@ -1,7 +1,10 @@
-from iceberk import mathutil
+from iceberk import mathutil, mpi
 import numpy as np
 import unittest
 
+_MATHUTIL_FILE_SAMPLER_TEST_PREFIX = \
+        '/tmp/iceberk.test.unittest_mathutil.filesampler'
+
 class TestMathutil(unittest.TestCase):
     """Test the mathutil module
     """
@@ -103,6 +106,109 @@ class TestMathutil(unittest.TestCase):
         # with very high probabibility, one sample will be nonzero
         sampler.consider(np.ones((100,10)))
         self.assertGreater(sampler.get().sum(), 0)
+        # a stack of batches straddling the fill boundary
+        sampler = mathutil.ReservoirSampler(50)
+        data = np.arange(1000)[:, np.newaxis]
+        sampler.consider([data[:30], data[30:60], data[60:]])
+        self.assertEqual(sampler.num_considered(), 1000)
+        self.assertEqual(sampler.get().shape, (50, 1))
+        self.assertEqual(len(np.unique(sampler.get())), 50)
+        # with very high probability, some samples come after the first 60
+        self.assertGreater(sampler.get().max(), 60)
+    
+    def testreservoir_sampler_global(self):
+        # node i considers (i+1) * 100 features with value i
+        sampler = mathutil.ReservoirSampler(200)
+        for i in range(mpi.RANK + 1):
+            sampler.consider(np.ones((100, 2)) * mpi.RANK)
+        local = sampler.get_global(50 * mpi.SIZE)
+        self.assertLessEqual(local.shape[0], 200)
+        np.testing.assert_array_equal(local, mpi.RANK)
+        sizes = mpi.COMM.allgather(local.shape[0])
+        self.assertEqual(sum(sizes), 50 * mpi.SIZE)
+        # node 0 holds most of the features but has a small reservoir: the
+        # sample is limited to the keys node 0 is guaranteed to hold, so it
+        # is smaller than requested but node 0 is not underrepresented.
+        sampler = mathutil.ReservoirSampler(100)
+        sampler.consider(np.zeros((1000 if mpi.is_root() else 100, 2)))
+        sizes = mpi.COMM.allgather(sampler.get_global().shape[0])
+        self.assertLessEqual(sum(sizes), 100 * mpi.SIZE)
+        if mpi.SIZE > 1:
+            self.assertEqual(sizes[0], 100)
+            self.assertLess(sum(sizes[1:]), 100 * (mpi.SIZE - 1))
+    
+    def testfile_sampler(self):
+        prefix = '%s-%05d' % (_MATHUTIL_FILE_SAMPLER_TEST_PREFIX, mpi.RANK)
+        sizes = [3 * mpi.SIZE, 5 * mpi.SIZE, 7 * mpi.SIZE]
+        offsets = np.cumsum([0] + sizes)
+        for i, size in enumerate(sizes):
+            rows = np.arange(offsets[i], offsets[i+1])
+            np.save('%s-X-%05d-of-%05d.npy' % (prefix, i, len(sizes)),
+                    np.tile(rows[:, np.newaxis], (1, 2)).astype(np.float32))
+            np.save('%s-Y-%05d-of-%05d.npy' % (prefix, i, len(sizes)), rows)
+        # with max_open_files = 1 the parts are reopened as needed
+        for max_open_files in [64, 1]:
+            sampler = mathutil.FileSampler([prefix + '-X-*.npy',
+                                            prefix + '-Y-*.npy', None],
+                                           max_open_files = max_open_files)
+            for i in range(10):
+                X, Y, none = sampler.sample(10 * mpi.SIZE)
+                self.assertIsNone(none)
+                self.assertEqual(X.shape, (10, 2))
+                self.assertEqual(X.dtype, np.float32)
+                self.assertEqual(len(set(Y)), 10)
+                np.testing.assert_array_equal(X[:, 0], Y)
+                np.testing.assert_array_equal(X[:, 1], Y)
+                self.assertLessEqual(len(sampler._open_maps), max_open_files)
+
+    def testmpi_meancov(self):
+        # a large offset makes the naive computation lose precision
+        data = np.random.rand(1000, 10) + 1e4
+        data_copy = data.copy()
+        m, covmat = mathutil.mpi_meancov(data)
+        # the data should not be modified
+        np.testing.assert_array_equal(data, data_copy)
+        data_all = np.vstack(mpi.COMM.allgather(data))
+        np.testing.assert_array_almost_equal(m, data_all.mean(0))
+        np.testing.assert_array_almost_equal(
+                covmat, np.cov(data_all, rowvar = 0, bias = 1))
+        # blocks of different sizes from a generator
+        blocks = (data[start:start+n] for start, n in
+                  zip([0, 1, 100, 400], [1, 99, 300, 600]))
+        m_blocks, covmat_blocks = mathutil.mpi_meancov(blocks)
+        np.testing.assert_array_almost_equal(m_blocks, m)
+        np.testing.assert_array_almost_equal(covmat_blocks, covmat)
+
+    def testprefetch_sampler(self):
+        X = np.tile(np.arange(100)[:, np.newaxis], (1, 3))
+        Y = np.arange(100)
+        basic = mathutil.NdarraySampler([X, Y, None])
+        sampler = mathutil.PrefetchSampler(basic, 10 * mpi.SIZE)
+        buffers = set()
+        for i in range(20):
+            Xbatch, Ybatch, none = sampler.sample(10 * mpi.SIZE)
+            self.assertIsNone(none)
+            self.assertEqual(Xbatch.shape, (10, 3))
+            np.testing.assert_array_equal(Xbatch[:, 0], Ybatch)
+            buffers.add(id(Xbatch))
+        # the buffers are reused
+        self.assertLessEqual(len(buffers), 3)
+        self.assertRaises(ValueError, sampler.sample, 5)
+        sampler.close()
+        # the entries of a PostProcessSampler without a func are reused
+        post = mathutil.PostProcessSampler(basic, [None, lambda y: y * 2, None])
+        sampler = mathutil.PrefetchSampler(post, 10 * mpi.SIZE)
+        buffers = set()
+        for i in range(20):
+            Xbatch, Ybatch, none = sampler.sample(10 * mpi.SIZE)
+            np.testing.assert_array_equal(Xbatch[:, 0] * 2, Ybatch)
+            buffers.add(id(Xbatch))
+        self.assertLessEqual(len(buffers), 3)
+        sampler.close()
+        # the exceptions in the background thread are raised by sample()
+        sampler = mathutil.PrefetchSampler(basic, 1000 * mpi.SIZE)
+        self.assertRaises(ValueError, sampler.sample, 1000 * mpi.SIZE)
+        sampler.close()
         
         
 if __name__ == '__main__':
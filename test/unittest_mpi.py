@@ -6,6 +6,7 @@ import unittest
 
 _MPI_TEST_DIR = '/tmp/mpi_test_dir'
 _MPI_DUMP_TEST_FILE = '/tmp/iceberk.test.unittest_mpi.dump.npy'
+_MPI_TRACE_TEST_PREFIX = '/tmp/iceberk.test.unittest_mpi.trace'
 
 class TestMPI(unittest.TestCase):
     """Test the mpi module
@@ -37,6 +38,35 @@ class TestMPI(unittest.TestCase):
         num_presidents = mpi.COMM.allreduce(mpi.is_president())
         self.assertEqual(num_presidents, 1)
     
+    def testAllreduceScalar(self):
+        self.assertEqual(mpi.allreduce_scalar(1), mpi.SIZE)
+        self.assertAlmostEqual(mpi.allreduce_scalar(0.5), 0.5 * mpi.SIZE)
+        self.assertEqual(mpi.allreduce_scalar(mpi.RANK, op=max), mpi.SIZE - 1)
+        self.assertEqual(mpi.allreduce_scalar(mpi.RANK, op=min), 0)
+        self.assertEqual(mpi.allreduce_scalar(mpi.is_root()), 1)
+        # the nodes could pass different types of numbers
+        value = mpi.RANK if mpi.RANK % 2 else float(mpi.RANK)
+        self.assertEqual(mpi.allreduce_scalar(value),
+                         mpi.SIZE * (mpi.SIZE - 1) / 2)
+        self.assertEqual(mpi.allreduce_scalar(2 ** 60, op=max,
+                                              dtype=np.int64), 2 ** 60)
+        
+    def testBcastScalar(self):
+        self.assertEqual(mpi.bcast_scalar(mpi.RANK), 0)
+        self.assertEqual(mpi.bcast_scalar(float(mpi.RANK) + 0.5), 0.5)
+        self.assertTrue(mpi.bcast_scalar(mpi.is_root()))
+        self.assertEqual(mpi.bcast_scalar(2. if mpi.is_root() else 0), 2)
+        
+    def testBcastArray(self):
+        for mat in [np.random.rand(3, 4), np.arange(5), np.zeros(0)]:
+            mat = mpi.COMM.bcast(mat)
+            if mpi.is_root():
+                result = mpi.bcast_array(mat)
+            else:
+                result = mpi.bcast_array(None)
+            self.assertEqual(result.dtype, mat.dtype)
+            np.testing.assert_array_equal(mat, result)
+    
     def testIsRoot(self):
         if mpi.RANK == 0:
             self.assertTrue(mpi.is_root())
@@ -49,6 +79,39 @@ class TestMPI(unittest.TestCase):
         time.sleep(mpi.RANK)
         mpi.barrier()
         self.assertTrue(True)
+        # back to back barriers
+        for i in range(100):
+            mpi.barrier()
+    
+    def testMPI2Fallback(self):
+        # mpi4py defines the non-blocking collectives even for MPI-2
+        # libraries, where calling them raises NotImplementedError.
+        class MPI2Comm(object):
+            def __init__(self, comm):
+                self._comm = comm
+            def __getattr__(self, name):
+                return getattr(self._comm, name)
+            def Ibarrier(self):
+                raise NotImplementedError
+            def Iallreduce(self, *args, **kwargs):
+                raise NotImplementedError
+        comm = mpi.COMM
+        mpi.COMM = MPI2Comm(comm)
+        try:
+            mpi.barrier()
+            result = np.empty(3)
+            mpi.waitall([mpi.iallreduce(np.ones(3), result)])
+            np.testing.assert_array_equal(result, mpi.SIZE)
+        finally:
+            mpi.COMM = comm
+    
+    def testWait(self):
+        calls = []
+        def test():
+            calls.append(None)
+            return len(calls) > 1000
+        mpi._wait(test, 0.001, spin = 0.)
+        self.assertEqual(len(calls), 1001)
     
     def testDistribute(self):
         data_list = [np.ones(100), np.ones((100,2)), np.ones((100,2,3))]
@@ -61,6 +124,16 @@ class TestMPI(unittest.TestCase):
             total_number = mpi.COMM.allreduce(distributed.shape[0])
             self.assertEqual(total_number, data.shape[0])
     
+    def testDistributeNonContiguous(self):
+        mat = np.arange(600.).reshape(100, 6)
+        sources = [mat[:, ::2], mat.T.copy().T, mat[:, :1]]
+        segments = mpi.get_segments(mat.shape[0])
+        for source in sources:
+            distributed = mpi.distribute(source)
+            np.testing.assert_array_equal(
+                    distributed,
+                    source[segments[mpi.RANK]:segments[mpi.RANK+1]])
+    
     def testDistributeList(self):
         lengths = range(1, 5)
         for length in lengths:
@@ -83,6 +156,14 @@ class TestMPI(unittest.TestCase):
                                  (local_size * mpi.SIZE,) + mat.shape[1:])
             mat_read = mpi.load_matrix(_MPI_DUMP_TEST_FILE)
             self.assertEqual(mat.shape, mat_read.shape)
+            np.testing.assert_array_equal(mat, mat_read)
+        # a mismatch on one node should fail on all nodes instead of hanging
+        if mpi.SIZE > 1:
+            mat = np.random.rand(local_size, 2)
+            if mpi.RANK == mpi.SIZE - 1:
+                mat = mat.astype(np.float32)
+            self.assertRaises(ValueError, mpi.dump_matrix, mat,
+                              _MPI_DUMP_TEST_FILE)
         
     def testLoadMulti(self):
         testdir = os.path.dirname(__file__)
@@ -95,6 +176,86 @@ class TestMPI(unittest.TestCase):
                                              'dumploadmulti',
                                              'multiple_files'))
         np.testing.assert_array_equal(data1, data2)
+        data3 = mpi.load_matrix_multi(os.path.join(testdir,
+                                             'data',
+                                             'dumploadmulti',
+                                             'multiple_files'),
+                                      N = 10, mmap = True)
+        np.testing.assert_array_equal(data1, data3)
+    
+    def testLoadKeepsDtype(self):
+        mat = np.random.rand(2, 3).astype(np.float32)
+        mpi.dump_matrix(mat, _MPI_DUMP_TEST_FILE)
+        mat_read = mpi.load_matrix(_MPI_DUMP_TEST_FILE)
+        self.assertEqual(mat_read.dtype, np.float32)
+        np.testing.assert_array_equal(mat, mat_read)
+        mat_read = mpi.load_matrix(_MPI_DUMP_TEST_FILE, mmap = True)
+        self.assertEqual(mat_read.dtype, np.float32)
+        self.assertFalse(mat_read.flags.writeable)
+        np.testing.assert_array_equal(mat, mat_read)
+        
+    def testSharedBcast(self):
+        for dtype in [np.float64, np.float32, np.int]:
+            mat = mpi.COMM.bcast(np.random.rand(10, 3).astype(dtype))
+            if mpi.is_root():
+                result = mpi.shared_bcast(mat)
+            else:
+                result = mpi.shared_bcast(None)
+            self.assertEqual(result.dtype, mat.dtype)
+            self.assertFalse(result.flags.writeable)
+            np.testing.assert_array_equal(mat, result)
+        # reuse the memory with a key
+        num_windows = None
+        for size in [5, 3, 8, 8]:
+            mat = mpi.COMM.bcast(np.random.rand(size))
+            result = mpi.shared_bcast(mat, key = 'testSharedBcast')
+            np.testing.assert_array_equal(mat, result)
+            if num_windows is None:
+                num_windows = len(mpi._SHARED_WINDOWS)
+            self.assertEqual(len(mpi._SHARED_WINDOWS), num_windows)
+    
+    def testStealMap(self):
+        local_size = mpi.RANK + 1
+        descriptors = [(mpi.RANK, i) for i in range(local_size)]
+        for chunk_size in [1, 3]:
+            results = mpi.steal_map(lambda d: d[0] * 100 + d[1], descriptors,
+                                    chunk_size = chunk_size)
+            self.assertEqual(results,
+                             [mpi.RANK * 100 + i for i in range(local_size)])
+        processed = []
+        self.assertIsNone(mpi.steal_map(processed.append, descriptors,
+                                        gather = False))
+        self.assertEqual(mpi.COMM.allreduce(len(processed)),
+                         mpi.COMM.allreduce(local_size))
+    
+    def testTracing(self):
+        mpi.enable_tracing()
+        try:
+            mpi.COMM.allreduce(1)
+            mpi.COMM.Bcast(np.zeros(10))
+            # polls are summarized but kept out of the timeline
+            polling = hasattr(mpi.COMM, 'Iprobe')
+            if polling:
+                mpi.COMM.Iprobe(source = mpi.MPI.ANY_SOURCE, tag = 12345)
+        finally:
+            mpi.disable_tracing()
+        self.assertFalse(isinstance(mpi.COMM, mpi._TracingComm))
+        summary = mpi.trace_summary()
+        self.assertIn('allreduce@', summary)
+        self.assertIn('Bcast@', summary)
+        if polling:
+            self.assertIn('Iprobe@', summary)
+        self.assertIn('testTracing', summary)
+        events = mpi._TRACER.chrome_trace()['traceEvents']
+        self.assertEqual([e['name'] for e in events], ['allreduce', 'Bcast'])
+        self.assertEqual(events[1]['args']['bytes'], 80)
+        # the bytes of pickled objects are unknown, not 0
+        self.assertEqual(events[0]['args']['bytes'], None)
+        line = [l for l in summary.split('\n') if l.startswith('allreduce@')]
+        self.assertTrue(line[0].endswith('?'))
+        mpi._TRACER.dump(_MPI_TRACE_TEST_PREFIX)
+        self.assertTrue(os.path.exists(
+                '%s-%05d.json' % (_MPI_TRACE_TEST_PREFIX, mpi.RANK)))
     
     def testGetSegments(self):
         total = 100
@@ -1,7 +1,33 @@
-from iceberk import pipeline, datasets, mpi
+from iceberk import pipeline, datasets, mathutil, mpi
+import glob
 import numpy as np
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
 
+_PIPELINE_DUMP_TEST_FILE = '/tmp/iceberk.test.unittest_pipeline.dump'
+_PIPELINE_CHECKPOINT_DIR = '/tmp/iceberk.test.unittest_pipeline.checkpoint'
+# the script run by testCheckpointMultiprocess with mprun.py
+_PIPELINE_CHECKPOINT_SCRIPT = """
+import sys
+import numpy as np
+from iceberk import datasets, pipeline
+data = datasets.NdarraySet(np.random.rand(6, 16, 16, 3))
+conv = pipeline.ConvLayer([
+        pipeline.PatchExtractor([4, 4], 2),
+        pipeline.MeanvarNormalizer({'reg': 10}),
+        pipeline.SpatialPooler({'grid': (2, 2), 'method': 'ave'})])
+# the second run resumes from the checkpoint of the first one
+for i in range(2):
+    conv.process_dataset(data, as_2d = True, checkpoint = sys.argv[1],
+                         checkpoint_every = 2)
+"""
+
 class TestExtractor(unittest.TestCase):
     def setUp(self):
         self._sample_number = 1000
@@ -99,6 +125,16 @@ class TestDictTrainer(unittest.TestCase):
             covmat -= np.diag(np.diag(covmat))
             np.testing.assert_array_almost_equal(covmat, 0.)
         
+    def testTrainerSharedMemory(self):
+        # training again reuses the shared memory of the trainer
+        trainer = pipeline.PcaTrainer({})
+        trainer.train(self.test_patches)
+        num_windows = len(mpi._SHARED_WINDOWS)
+        for i in range(3):
+            W, b = trainer.train(self.test_patches)[0]
+            self.assertEqual(len(mpi._SHARED_WINDOWS), num_windows)
+        np.testing.assert_equal(W.shape, (36, 36))
+    
     def testZcaTrainer(self):
         trainer = pipeline.ZcaTrainer({})
         W, b = trainer.train(self.test_patches)[0]
@@ -112,6 +148,28 @@ class TestDictTrainer(unittest.TestCase):
             covmat -= np.diag(np.diag(covmat))
             np.testing.assert_array_almost_equal(covmat, 0.)
             
+    def testRandomizedPcaTrainer(self):
+        # data with a few strong directions
+        basis = mpi.bcast_array(np.linalg.qr(np.random.randn(36, 36))[0])
+        scales = np.ones(36) * 0.01
+        scales[:4] = [10., 5., 3., 2.]
+        patches = np.dot(np.random.randn(1000, 36) * scales, basis.T) + 1.
+        specs = {'num_components': 4}
+        trainer = pipeline.RandomizedPcaTrainer(specs)
+        (W, b), (eigval, eigvec, covmat) = trainer.train(patches)
+        self.assertEqual(W.shape, (36, 4))
+        self.assertEqual(b.shape, (36,))
+        np.testing.assert_array_less(eigval[1:], eigval[:-1])
+        # compare with the full PCA
+        eigval_full, eigvec_full = pipeline.PcaTrainer({}).train(patches)[1][:2]
+        np.testing.assert_array_almost_equal(eigval / eigval_full[::-1][:4],
+                                             1., 3)
+        np.testing.assert_array_almost_equal(
+                np.abs((eigvec * eigvec_full[:, ::-1][:, :4]).sum(0)), 1., 3)
+        # row blocks are not supported
+        self.assertRaises(TypeError, trainer.train,
+                          iter([patches[:500], patches[500:]]))
+        
     def testKmeansTrainer(self):
         specs = {'k': 100}
         trainer = pipeline.KmeansTrainer(specs)
@@ -229,6 +287,272 @@ class TestSpatialPooler(unittest.TestCase):
                     output = pooler.process(data)
                     self.assertEqual(output.shape, grid + (data.shape[-1],))
 
+class TestConvLayer(unittest.TestCase):
+    def setUp(self):
+        self.data = datasets.NdarraySet(np.random.rand(20, 16, 16, 3))
+        self.conv = pipeline.ConvLayer([
+                pipeline.PatchExtractor([4, 4], 2),
+                pipeline.MeanvarNormalizer({'reg': 10}),
+                pipeline.LinearEncoder({},
+                        trainer = pipeline.ZcaTrainer({'reg': 0.1})),
+                pipeline.ThresholdEncoder({'alpha': 0.25, 'twoside': True},
+                        trainer = pipeline.OMPTrainer({'k': 10})),
+                pipeline.SpatialPooler({'grid': (2, 2), 'method': 'ave'})])
+        self.conv.train(self.data, 200)
+
+    def testProcessBatch(self):
+        feat = self.conv.process_dataset(self.data, as_2d = True)
+        for batch_size in [1, 7, 20, 100]:
+            feat_batch = self.conv.process_dataset(self.data, as_2d = True,
+                                                   batch_size = batch_size)
+            self.assertEqual(feat.shape, feat_batch.shape)
+            np.testing.assert_array_almost_equal(feat, feat_batch)
+
+    def testProcessStealing(self):
+        path = os.path.join(os.path.dirname(__file__), 'data', 'twolayer')
+        data = datasets.TwoLayerDataset(path, ['png'], target_size = (16, 16))
+        feat = self.conv.process_dataset(data, as_2d = True)
+        feat_stolen = self.conv.process_dataset(data, as_2d = True,
+                                                steal = True)
+        self.assertEqual(feat.shape, feat_stolen.shape)
+        np.testing.assert_array_almost_equal(feat, feat_stolen)
+        # NdarraySet does not support descriptors
+        self.assertRaises(ValueError, self.conv.process_dataset, self.data,
+                          steal = True)
+
+    def testProcessWorkers(self):
+        feat = self.conv.process_dataset(self.data, as_2d = True)
+        self.conv._fixed_size = True
+        for batch_size in [None, 3]:
+            feat_threaded = self.conv.process_dataset(
+                    self.data, as_2d = True, batch_size = batch_size,
+                    num_workers = 4)
+            self.assertEqual(feat.shape, feat_threaded.shape)
+            np.testing.assert_array_almost_equal(feat, feat_threaded)
+
+    def testProcessToFile(self):
+        feat = self.conv.process_dataset(self.data, as_2d = True)
+        for batch_size in [None, 4]:
+            shape = self.conv.process_dataset_to_file(
+                    self.data, _PIPELINE_DUMP_TEST_FILE, as_2d = True,
+                    chunk_size = 7, batch_size = batch_size)
+            self.assertEqual(shape, feat.shape)
+            feat_file = mpi.load_matrix_multi(_PIPELINE_DUMP_TEST_FILE,
+                                              N = mpi.SIZE)
+            np.testing.assert_array_almost_equal(feat, feat_file)
+            mpi.barrier()
+        os.remove('%s-%05d-of-%05d.npy' % (_PIPELINE_DUMP_TEST_FILE,
+                                           mpi.RANK, mpi.SIZE))
+        mpi.barrier()
+        # shards of a run with a different number of nodes are removed
+        stale = '%s-%05d-of-%05d.npy' % (_PIPELINE_DUMP_TEST_FILE,
+                                         0, mpi.SIZE + 1)
+        if mpi.is_root():
+            np.save(stale, feat)
+        self.conv.process_dataset_to_file(self.data, _PIPELINE_DUMP_TEST_FILE,
+                                          as_2d = True)
+        self.assertFalse(os.path.exists(stale))
+        feat_file = mpi.load_matrix_multi(_PIPELINE_DUMP_TEST_FILE)
+        np.testing.assert_array_almost_equal(feat, feat_file)
+        mpi.barrier()
+        os.remove('%s-%05d-of-%05d.npy' % (_PIPELINE_DUMP_TEST_FILE,
+                                           mpi.RANK, mpi.SIZE))
+
+    def testProcessArena(self):
+        arena = mathutil.BufferArena()
+        for size in [16, 23, 18, 30, 16]:
+            image = np.random.rand(size, size + 3, 3)
+            feat = self.conv.process(image)
+            feat_arena = self.conv.process(image, arena = arena)
+            np.testing.assert_array_almost_equal(feat, feat_arena)
+        self.assertGreater(arena.nbytes(), 0)
+
+    def testProcessArenaNoAliasing(self):
+        # without a pooler, the output of the last component lives in the
+        # arena, and the returned features should not share memory with it.
+        conv = pipeline.ConvLayer([
+                pipeline.PatchExtractor([4, 4], 2),
+                pipeline.MeanvarNormalizer({'reg': 10})])
+        for fuse in [False, True]:
+            conv._fuse = fuse
+            arena = mathutil.BufferArena()
+            a = np.random.rand(16, 16, 3)
+            b = np.random.rand(16, 16, 3)
+            feat_a = conv.process(a, arena = arena)
+            feat_a_copy = feat_a.copy()
+            feat_b = conv.process(b, arena = arena)
+            self.assertFalse(np.may_share_memory(feat_a, feat_b))
+            np.testing.assert_array_equal(feat_a, feat_a_copy)
+            np.testing.assert_array_almost_equal(feat_b, conv.process(b))
+
+    def testCache(self):
+        conv2 = pipeline.ConvLayer([
+                pipeline.PatchExtractor([2, 2], 1),
+                pipeline.MeanvarNormalizer({'reg': 10}),
+                pipeline.ThresholdEncoder({'alpha': 0.25, 'twoside': True},
+                        trainer = pipeline.OMPTrainer({'k': 5})),
+                pipeline.SpatialPooler({'grid': (1, 1), 'method': 'max'})],
+                prev = self.conv)
+        # a small budget, so that some outputs are spilled to disk
+        cache = pipeline.LayerOutputCache(budget = 5000)
+        conv2.train(self.data, 50, cache = cache)
+        self.assertGreater(cache.nbytes(), 0)
+        output = self.conv.output(self.data, 0, cache)
+        self.assertFalse(output.flags.writeable)
+        np.testing.assert_array_almost_equal(
+                output, self.conv.process(self.data.image(0)))
+        feat = conv2.process_dataset(self.data, as_2d = True)
+        feat_cached = conv2.process_dataset(self.data, as_2d = True,
+                                            cache = cache)
+        np.testing.assert_array_almost_equal(feat, feat_cached)
+        cache.invalidate(self.conv)
+        self.assertEqual(cache.nbytes(), 0)
+        cache.close()
+
+    def testFusion(self):
+        self.conv._fuse = False
+        feat = self.conv.process_dataset(self.data, as_2d = True)
+        self.conv._fuse = True
+        block_bytes = pipeline._FUSION_BLOCK_BYTES
+        try:
+            # use small blocks so that each image is split into many blocks
+            for pipeline._FUSION_BLOCK_BYTES in [1, 5000, block_bytes]:
+                feat_fused = self.conv.process_dataset(self.data, as_2d = True)
+                np.testing.assert_array_almost_equal(feat, feat_fused)
+                self.conv._fixed_size = True
+                feat_fused = self.conv.process_dataset(self.data, as_2d = True)
+                np.testing.assert_array_almost_equal(feat, feat_fused)
+                self.conv._fixed_size = False
+        finally:
+            pipeline._FUSION_BLOCK_BYTES = block_bytes
+
+    def testFusionIgnoredOut(self):
+        class DoublingNormalizer(pipeline.Normalizer):
+            # a user normalizer that returns a new array instead of using out
+            def process(self, image, out = None):
+                return image * 2.
+        conv = pipeline.ConvLayer([
+                pipeline.PatchExtractor([4, 4], 2),
+                DoublingNormalizer({}),
+                pipeline.SpatialPooler({'grid': (2, 2), 'method': 'ave'})])
+        image = self.data.image(0)
+        conv._fuse = False
+        feat = conv.process(image)
+        conv._fuse = True
+        block_bytes = pipeline._FUSION_BLOCK_BYTES
+        try:
+            pipeline._FUSION_BLOCK_BYTES = 1
+            np.testing.assert_array_equal(feat, conv.process(image))
+        finally:
+            pipeline._FUSION_BLOCK_BYTES = block_bytes
+
+    def testPlan(self):
+        image = self.data.image(0)
+        feat = self.conv.process(image)
+        self.assertEqual(self.conv.output_shape(image.shape), feat.shape)
+        self.assertRaises(ValueError, self.conv.output_shape, (2, 2, 3))
+        convbuffer = self.conv.plan(image.shape)
+        self.assertEqual(len(convbuffer), len(self.conv) + 1)
+        for i in range(self.data.size()):
+            image = self.data.image(i)
+            np.testing.assert_array_almost_equal(
+                    self.conv.process(image),
+                    self.conv.process(image, convbuffer = convbuffer))
+        out = np.empty(np.prod(feat.shape))
+        result = self.conv._process_local(image, as_vector = True,
+                                          convbuffer = convbuffer, out = out)
+        self.assertIs(result, out)
+        np.testing.assert_array_almost_equal(
+                out, self.conv.process(image, as_vector = True))
+
+    def testProfiling(self):
+        feat = self.conv.process_dataset(self.data, as_2d = True)
+        profiler = self.conv.enable_profiling()
+        feat_profiled = self.conv.process_dataset(self.data, as_2d = True)
+        self.conv.disable_profiling()
+        np.testing.assert_array_almost_equal(feat, feat_profiled)
+        stats = profiler.stats()
+        self.assertEqual(len(stats), len(self.conv))
+        for name, stat in stats:
+            self.assertEqual(stat['calls'], self.data.size_total())
+            self.assertGreaterEqual(stat['p90'], stat['p50'])
+            self.assertGreaterEqual(stat['max'], stat['p99'])
+        self.assertIn('SpatialPooler', profiler.report())
+
+    def testCheckpoint(self):
+        if mpi.is_root():
+            shutil.rmtree(_PIPELINE_CHECKPOINT_DIR, ignore_errors = True)
+        mpi.barrier()
+        feat = self.conv.process_dataset(self.data, as_2d = True)
+        feat_checkpoint = self.conv.process_dataset(
+                self.data, as_2d = True,
+                checkpoint = _PIPELINE_CHECKPOINT_DIR, checkpoint_every = 3)
+        np.testing.assert_array_almost_equal(feat, feat_checkpoint)
+        mpi.barrier()
+        # remove some chunks as if the job had failed, and resume
+        if mpi.is_root():
+            chunks = sorted(glob.glob(os.path.join(_PIPELINE_CHECKPOINT_DIR,
+                                                   'chunk-*.npy')))
+            self.assertGreater(len(chunks), 1)
+            for fname in chunks[::2]:
+                os.remove(fname)
+        mpi.barrier()
+        feat_resumed = self.conv.process_dataset(
+                self.data, as_2d = True,
+                checkpoint = _PIPELINE_CHECKPOINT_DIR, checkpoint_every = 4)
+        np.testing.assert_array_almost_equal(feat, feat_resumed)
+        # the chunks of a different layer or dataset are not used
+        mpi.barrier()
+        self.assertRaises(ValueError, self.conv.process_dataset,
+                          datasets.NdarraySet(np.random.rand(20, 16, 16, 3)),
+                          as_2d = True, checkpoint = _PIPELINE_CHECKPOINT_DIR)
+        self.conv.set_dtype(np.float32)
+        try:
+            self.assertRaises(ValueError, self.conv.process_dataset,
+                              self.data, as_2d = True,
+                              checkpoint = _PIPELINE_CHECKPOINT_DIR)
+        finally:
+            self.conv.set_dtype(np.float64)
+
+    def testCheckpointMultiprocess(self):
+        # checkpointing involves collectives, so make sure that it does not
+        # deadlock with several nodes even when the tests run with one.
+        if mpi.SIZE > 1:
+            return
+        dirname = tempfile.mkdtemp(prefix = 'iceberk-test-checkpoint-')
+        try:
+            script = os.path.join(dirname, 'checkpoint.py')
+            with open(script, 'w') as fid:
+                fid.write(_PIPELINE_CHECKPOINT_SCRIPT)
+            root = os.path.dirname(os.path.abspath(pipeline.__file__))
+            env = dict(os.environ)
+            env['PYTHONPATH'] = os.pathsep.join(
+                    [os.path.dirname(root)] + sys.path)
+            process = subprocess.Popen(
+                    [sys.executable, os.path.join(root, 'mprun.py'), '-n', '2',
+                     script, os.path.join(dirname, 'checkpoint')], env = env,
+                    preexec_fn = os.setsid)
+            deadline = time.time() + 120
+            while process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if process.poll() is None:
+                # kill mprun.py together with the processes it started
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+                self.fail("The checkpointed run did not finish.")
+            self.assertEqual(process.returncode, 0)
+        finally:
+            shutil.rmtree(dirname, ignore_errors = True)
+
+    def testFloat32(self):
+        feat = self.conv.process_dataset(self.data, as_2d = True)
+        self.conv.set_dtype(np.float32)
+        feat_single = self.conv.process_dataset(self.data, as_2d = True)
+        self.assertEqual(feat_single.dtype, np.float32)
+        self.assertEqual(feat.shape, feat_single.shape)
+        np.testing.assert_allclose(feat, feat_single, rtol = 1e-3,
+                                   atol = 1e-4)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -2,6 +2,8 @@
 which are implemented in mathutil.py
 '''
 
+import random
+import threading
 import time
 
 class Timer:
@@ -64,3 +66,146 @@ class Timer:
             return self._format(time.time() - self._total)
         else:
             return time.time() - self._total
+
+
+class Profiler:
+    '''
+    class Profiler collects timing statistics of named code sections, such as
+    the components of a pipeline.ConvLayer (see ConvLayer.enable_profiling()).
+    For each name it keeps the number of calls, the cumulative wall time, a
+    bounded random sample of the wall times from which the percentiles are
+    computed, the input and output shapes, and the bytes newly allocated for
+    the outputs. It is thread-safe.
+    '''
+    def __init__(self, max_samples = 10000):
+        """Initializes a profiler.
+        
+        Input:
+            max_samples: (optional) the maximum number of wall times kept per
+                name to compute the percentiles. Default 10000.
+        """
+        self._max_samples = max_samples
+        self._lock = threading.Lock()
+        self.reset()
+    
+    def __getstate__(self):
+        # locks cannot be pickled
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+    
+    def reset(self):
+        """Clears all the statistics collected so far.
+        """
+        with self._lock:
+            self._stats = {}
+            self._order = []
+    
+    def record(self, name, elapsed, input = None, output = None,
+               allocated = 0):
+        """Records one call of the code section name.
+        
+        Input:
+            name: the name of the code section.
+            elapsed: the wall time of the call in seconds.
+            input, output: (optional) the input and output arrays, of which
+                the shapes are recorded.
+            allocated: (optional) the bytes allocated by the call.
+        """
+        with self._lock:
+            stat = self._stats.get(name)
+            if stat is None:
+                stat = {'calls': 0, 'total': 0., 'samples': [],
+                        'input_shapes': set(), 'output_shapes': set(),
+                        'bytes': 0}
+                self._stats[name] = stat
+                self._order.append(name)
+            stat['calls'] += 1
+            stat['total'] += elapsed
+            stat['bytes'] += allocated
+            # reservoir sampling keeps a uniform sample of the wall times
+            if len(stat['samples']) < self._max_samples:
+                stat['samples'].append(elapsed)
+            else:
+                idx = random.randint(0, stat['calls'] - 1)
+                if idx < self._max_samples:
+                    stat['samples'][idx] = elapsed
+            # only keep a few distinct shapes
+            if input is not None and len(stat['input_shapes']) < 4:
+                stat['input_shapes'].add(getattr(input, 'shape', None))
+            if output is not None and len(stat['output_shapes']) < 4:
+                stat['output_shapes'].add(getattr(output, 'shape', None))
+    
+    def stats(self, reduce = True):
+        """Returns the collected statistics as a list of (name, stat) tuples,
+        in the order the names were first recorded. Each stat is a dict with
+        keys 'calls', 'total', 'p50', 'p90', 'p99', 'max', 'input_shapes',
+        'output_shapes' and 'bytes'.
+        
+        Input:
+            reduce: (optional) if True, the statistics are reduced over all
+                the MPI nodes and every node gets the same result: counts,
+                times and bytes are summed, and the percentiles are computed
+                from the wall time samples of all nodes. Default True.
+        """
+        with self._lock:
+            local = [(name, dict(self._stats[name],
+                                 samples = list(self._stats[name]['samples'])))
+                     for name in self._order]
+        if reduce:
+            from iceberk import mpi
+            all_stats = mpi.COMM.allgather(local)
+        else:
+            all_stats = [local]
+        merged = {}
+        order = []
+        for node_stats in all_stats:
+            for name, stat in node_stats:
+                if name not in merged:
+                    merged[name] = {'calls': 0, 'total': 0., 'samples': [],
+                                    'input_shapes': set(),
+                                    'output_shapes': set(), 'bytes': 0}
+                    order.append(name)
+                target = merged[name]
+                for key in ['calls', 'total', 'bytes']:
+                    target[key] += stat[key]
+                target['samples'].extend(stat['samples'])
+                target['input_shapes'].update(stat['input_shapes'])
+                target['output_shapes'].update(stat['output_shapes'])
+        result = []
+        for name in order:
+            stat = merged[name]
+            samples = sorted(stat.pop('samples'))
+            for key, q in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99)]:
+                if samples:
+                    stat[key] = samples[min(int(q * len(samples)),
+                                            len(samples) - 1)]
+                else:
+                    stat[key] = 0.
+            stat['max'] = samples[-1] if samples else 0.
+            result.append((name, stat))
+        return result
+    
+    def report(self, reduce = True):
+        """Returns a human-readable table of the statistics, sorted by the
+        cumulative wall time. See stats() for the reduce option.
+        """
+        stats = self.stats(reduce)
+        total = sum(stat['total'] for _, stat in stats)
+        lines = ['%-32s %8s %10s %6s %10s %10s %10s %10s' % \
+                 ('name', 'calls', 'total(s)', '%', 'p50(ms)', 'p90(ms)',
+                  'p99(ms)', 'alloc(MB)')]
+        for name, stat in sorted(stats, key = lambda x: -x[1]['total']):
+            lines.append('%-32s %8d %10.3f %6.1f %10.3f %10.3f %10.3f %10.1f' \
+                    % (name, stat['calls'], stat['total'],
+                       stat['total'] * 100. / max(total, 1e-12),
+                       stat['p50'] * 1000., stat['p90'] * 1000.,
+                       stat['p99'] * 1000., stat['bytes'] / 1048576.))
+            lines.append('    input %s -> output %s' % \
+                    (', '.join(str(s) for s in stat['input_shapes']),
+                     ', '.join(str(s) for s in stat['output_shapes'])))
+        return '\n'.join(lines)
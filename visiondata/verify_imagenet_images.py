@@ -36,15 +36,18 @@ if mpi.is_root():
     logging.info("A total of %d images to check" % (len(files)))
 files = mpi.distribute_list(files)
 
-logging.info('Validating...')
-errornum = 0
-for i, filename in enumerate(files):
+def is_corrupted(filename):
     try:
         verify = Image.open(filename)
+        return False
     except Exception, e:
         logging.error(filename)
-        errornum += 1
-errornum = mpi.COMM.allreduce(errornum)
+        return True
+
+logging.info('Validating...')
+# the images have very different sizes, so we balance the work over the nodes
+errornum = sum(mpi.steal_map(is_corrupted, files))
+errornum = mpi.allreduce_scalar(errornum)
 if errornum == 0:
     logging.info("Done. No corrupted images found.")
 else: